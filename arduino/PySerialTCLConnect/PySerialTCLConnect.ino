@@ -30,6 +30,12 @@
 #include <TCL.h>
 #include <StringUtils.h>
 #include <ColorUtils.h>
+
+// Number of LEDs on the strand this arduino drives, it has to match the led
+// count sound2light uses for this serial port.  Every LED takes 3 bytes of
+// RAM for global_color_bytes.
+#define NUM_LEDS 50
+
 #include <TCLUtils.h>
 
 // Handy open source library functions for printing strings to serial without bloating
@@ -69,8 +75,8 @@
 // to have control over this b
  static char                 global_color_bytes[NUM_LEDS*3];
 
-// The number of valid color bytes that are currently in the global array
- static unsigned int         global_num_color_bytes = 0;
+// Unpacks the escaped color frames coming over serial into global_color_bytes
+ FrameDecoder                global_frame_decoder;
 
 // ------------------------------------------------------------------------
 // SETUP
@@ -98,7 +104,7 @@ void setup() {
       global_color_bytes[i] = 0;
     }
               
-    global_num_color_bytes = 0;
+    resetFrameDecoder(&global_frame_decoder);
 
 #if DEBUG_COLOR_SENDING_MODE
       global_handshake.handshakeMade = true;
@@ -144,7 +150,7 @@ void loop() {
     for (int i = 0; i < NUM_LEDS*3; i++) {
       global_color_bytes[i] = 0;
     }              
-    global_num_color_bytes = 0;
+    resetFrameDecoder(&global_frame_decoder);
     
 #if DEBUG_COLOR_SENDING_MODE
       global_handshake.handshakeMade = true;
@@ -177,49 +183,46 @@ void loop() {
         if (global_handshake.receivingColor) 
         {
 
-          if (Serial.available()) {
-
-              unsigned char headByte = Serial.read();
-              // The '*' char is special to indicate the beginning of a frame of
-              // data.  So only process the serial data that follows a '*'. I
-              // chose the '*' char arbitrarily (or did I fellow hitchhikers!?),
-              // but I did want it to be in the lower half of the 256 number
-              // range since the lights do not have a lot of range with lower
-              // byte values.  So you won't be able to tell the difference
-              // between 42 or 43.
-              if (headByte == 42) {
-
-                global_num_color_bytes = Serial.readBytes(global_color_bytes, 
-                                                          3*NUM_LEDS);
-
-                if (global_num_color_bytes == 3*NUM_LEDS) {
-
-                  TCL.sendEmptyFrame();
-                  for (int i = 0; i <= NUM_LEDS; i++) 
-                  {
-
-                    byte rchannel = global_color_bytes[3*i+0];
-                    byte gchannel = global_color_bytes[3*i+1];
-                    byte bchannel = global_color_bytes[3*i+2];
-
-                    Color outColor = 
-                    {
-                      float(rchannel)/255.0 , 
-                      float(gchannel)/255.0 ,            
-                      float(bchannel)/255.0 
-                    };
-
-                    sendColor(outColor);
-                  }
-                  
-
-                  // Flush the global_color_bytes
-                  global_num_color_bytes = 0;
-                  for (int i = 0; i < NUM_LEDS*3; i++) {
-                    global_color_bytes[i] = 0;
-                  } 
+          // Feed everything waiting on the serial port through the frame
+          // decoder.  A frame starts with the '*' char and any '*' or '}'
+          // inside the frame is escaped (see decodeFrameByte), so we never
+          // mistake a color for the start of a frame.  I chose the '*' char
+          // arbitrarily (or did I fellow hitchhikers!?).
+          while (Serial.available()) {
+
+            unsigned char inByte = Serial.read();
+            if (decodeFrameByte(&global_frame_decoder, inByte, 
+                                global_color_bytes)) {
+
+              TCL.sendEmptyFrame();
+
+              // The requesting program already calibrated raw colors, so
+              // they go straight out to the leds
+              if (global_handshake.rawColor) {
+                for (int i = 0; i < NUM_LEDS; i++) {
+                  TCL.sendColor(global_color_bytes[3*i+0],
+                                global_color_bytes[3*i+1],
+                                global_color_bytes[3*i+2]);
                 }
+                continue;
+              }
+
+              for (int i = 0; i < NUM_LEDS; i++) 
+              {
+
+                byte rchannel = global_color_bytes[3*i+0];
+                byte gchannel = global_color_bytes[3*i+1];
+                byte bchannel = global_color_bytes[3*i+2];
+
+                Color outColor = 
+                {
+                  float(rchannel)/255.0 , 
+                  float(gchannel)/255.0 ,            
+                  float(bchannel)/255.0 
+                };
 
+                sendColor(outColor);
+              }
             }
           }
 
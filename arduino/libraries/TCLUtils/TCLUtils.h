@@ -4,8 +4,11 @@
 #include <ColorUtils.h>
 #include <StringUtils.h>
 
-// There are 50 LEDs in my Total Control Lighting Strand
+// There are 50 LEDs in my Total Control Lighting Strand.  Define NUM_LEDS
+// before including TCLUtils.h (or with -DNUM_LEDS=...) for other strands.
+#ifndef NUM_LEDS
 #define NUM_LEDS 50
+#endif
 #define MAX_SERIAL_BUFFER_LENGTH 64
 
 // Helper Utilities to be added on top of TCL
@@ -150,6 +153,172 @@ void errorLoop() {
 // Functions and structs used to manage serial input and output to the 
 // Arduino
 
+//  - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+// COLOR FRAMES
+
+// Color frames look like '*' <frame type> <payload>.  A byte after the '*'
+// that is '*' (42) or '}' (125) is sent as '}' followed by the byte XORed
+// with 0x20, so a '*' always marks the start of a frame.  Numbers wider
+// than a byte are little endian.  The frame types are:
+//
+//   'F' full frame  : 3*NUM_LEDS color bytes
+//   'D' delta frame : <number of spans: 2 bytes> and then for every span
+//                     <first led: 2 bytes> <number of leds: 2 bytes>
+//                     <3 color bytes per led>
+//   'R' run length  : <number of runs: 2 bytes> and then for every run
+//                     <number of leds: 1 byte> <red> <green> <blue>
+//
+// Delta and run length frames only make sense on top of the colors already
+// received, so the color bytes are kept between frames.  The python side
+// sends a full frame every so often so we resync after a bad frame.
+
+#define FRAME_START       42
+#define FRAME_ESCAPE      125
+#define FRAME_ESCAPE_XOR  0x20
+
+#define FRAME_FULL        'F'
+#define FRAME_DELTA       'D'
+#define FRAME_RUNLENGTH   'R'
+
+struct FrameDecoder {
+   bool inFrame; // have we seen the '*' that starts the current frame
+   bool escaped; // was the last byte the escape byte
+   unsigned char frameType; // 0 until the frame type byte arrives
+   unsigned char header[4]; // the span or run header being read
+   unsigned char headerBytes; // number of header bytes read so far
+   bool haveCount; // has the number of spans or runs been read
+   unsigned int numSections; // spans or runs left in the frame
+   unsigned int writePos; // next color byte to write
+   unsigned int writeEnd; // end of the color bytes being written
+};
+
+void resetFrameDecoder(FrameDecoder* decoder)
+{
+  decoder->inFrame     = false;
+  decoder->escaped     = false;
+  decoder->frameType   = 0;
+  decoder->headerBytes = 0;
+  decoder->haveCount   = false;
+  decoder->numSections = 0;
+  decoder->writePos    = 0;
+  decoder->writeEnd    = 0;
+}
+
+// Handle one unescaped byte of a frame.  Returns true when the byte
+// completes the frame.
+
+bool decodeFramePayloadByte(FrameDecoder* decoder, unsigned char inByte,
+                            char* colorBytes)
+{
+  if (decoder->frameType == 0) {
+    decoder->frameType = inByte;
+    if (inByte == FRAME_FULL) {
+      decoder->haveCount = true;
+      decoder->writeEnd = 3*NUM_LEDS;
+    } else if (inByte != FRAME_DELTA && inByte != FRAME_RUNLENGTH) {
+      decoder->inFrame = false;
+    }
+    return false;
+  }
+
+  // color bytes of a full frame or of a delta span
+  if (decoder->writePos < decoder->writeEnd) {
+    colorBytes[decoder->writePos++] = inByte;
+    if (decoder->writePos < decoder->writeEnd) {
+      return false;
+    }
+    if (decoder->frameType == FRAME_FULL) {
+      return true;
+    }
+    decoder->numSections--;
+    return decoder->numSections == 0;
+  }
+
+  decoder->header[decoder->headerBytes++] = inByte;
+
+  if (!decoder->haveCount) {
+    if (decoder->headerBytes == 2) {
+      decoder->numSections = decoder->header[0] | (decoder->header[1] << 8);
+      decoder->haveCount = true;
+      decoder->headerBytes = 0;
+      return decoder->numSections == 0;
+    }
+    return false;
+  }
+
+  if (decoder->headerBytes < 4) {
+    return false;
+  }
+  decoder->headerBytes = 0;
+
+  if (decoder->frameType == FRAME_DELTA) {
+
+    unsigned int start = decoder->header[0] | (decoder->header[1] << 8);
+    unsigned int count = decoder->header[2] | (decoder->header[3] << 8);
+
+    if (count == 0 || start + count > NUM_LEDS) {
+      decoder->inFrame = false;
+      return false;
+    }
+
+    decoder->writePos = 3*start;
+    decoder->writeEnd = 3*(start + count);
+    return false;
+  }
+
+  // run length
+  unsigned int length = decoder->header[0];
+  if (decoder->writePos + 3*length > 3*NUM_LEDS) {
+    decoder->inFrame = false;
+    return false;
+  }
+
+  for (unsigned int i = 0; i < length; i++) {
+    colorBytes[decoder->writePos++] = decoder->header[1];
+    colorBytes[decoder->writePos++] = decoder->header[2];
+    colorBytes[decoder->writePos++] = decoder->header[3];
+  }
+  decoder->writeEnd = decoder->writePos;
+
+  decoder->numSections--;
+  return decoder->numSections == 0;
+}
+
+// Feed one byte read from serial into the decoder, updating the color
+// bytes in colorBytes.  Returns true when the byte completes a frame, at
+// which point colorBytes holds the 3*NUM_LEDS color bytes to display.
+
+bool decodeFrameByte(FrameDecoder* decoder, unsigned char inByte, 
+                     char* colorBytes)
+{
+  if (inByte == FRAME_START) {
+    resetFrameDecoder(decoder);
+    decoder->inFrame = true;
+    return false;
+  }
+
+  if (!decoder->inFrame) {
+    return false;
+  }
+
+  if (inByte == FRAME_ESCAPE) {
+    decoder->escaped = true;
+    return false;
+  }
+
+  if (decoder->escaped) {
+    inByte ^= FRAME_ESCAPE_XOR;
+    decoder->escaped = false;
+  }
+
+  if (decodeFramePayloadByte(decoder, inByte, colorBytes)) {
+    decoder->inFrame = false;
+    return true;
+  }
+
+  return false;
+}
+
 //  - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 // STRUCTS
 
@@ -157,6 +326,7 @@ struct HandShakeProtocol {
    String programName; // name of the program messaging the arduino
    bool handshakeMade; // bit on whether a handshake is successful
    bool receivingColor; // is the handshake in receiving color mode
+   bool rawColor; // are the received color bytes sent as they are
 };
 
 
@@ -164,6 +334,7 @@ void resetHandshake(HandShakeProtocol* protocol)
 {
   protocol->handshakeMade  = false;
   protocol->receivingColor = false;
+  protocol->rawColor       = false;
   protocol->programName    = "Unknown";
 }
 
@@ -196,18 +367,29 @@ void resetHandshake(HandShakeProtocol* protocol)
 //     lots of color data.  XXX: would be nice to be able to exit this
 //     mode via some serial message, but in practice, we tend to reset
 //     the firmware of  the arduino program when we open a new
-//     requesting program.
+//     requesting program.  Color corrects the colors again after a
+//     colorraw, for a program that does not calibrate them itself.
 //
 //   * returns tcl:colorbeginreceived:<program name>\n
 
+//   - tcl:colorraw!
+
+//     The same as colorbegin, except that the color bytes are sent to the
+//     leds as they are, without the gamma, black point and white point
+//     correction of sendColor.  The requesting program corrects the colors
+//     with its own calibration before sending them, which saves all of the
+//     float math per led per frame.
+//
+//   * returns tcl:colorrawreceived:<program name>\n
+
 
 //  So to behave as a valid TLC python program, you need to send the
 //  following serial messages:
 //  "tcl:handextended:<program name>!"
 //  "tcl:handreceived:<program name>!"
-//  "tcl:colorbegin!"
+//  "tcl:colorbegin!" (or "tcl:colorraw!")
 //  and then you can send color data as 3*NUM_LEDS bytes (3 bytes for red green and
-//  blue channel).  You need to proceed the frame of bytes with a '*' char
+//  blue channel), or as delta or run length frames (see COLOR FRAMES above).
 
 void processSerialInstruction(HandShakeProtocol* handshake)
 {
@@ -251,9 +433,18 @@ void processSerialInstruction(HandShakeProtocol* handshake)
       if (serialInstruction.equals("colorbegin")) {
 
         handshake->receivingColor = true;
+        handshake->rawColor = false;
 
         Serial.print("tcl:colorbeginreceived:" + String(handshake->programName) + "\n");
       }
+
+      if (serialInstruction.equals("colorraw")) {
+
+        handshake->receivingColor = true;
+        handshake->rawColor = true;
+
+        Serial.print("tcl:colorrawreceived:" + String(handshake->programName) + "\n");
+      }
       
     }
 
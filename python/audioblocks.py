@@ -0,0 +1,268 @@
+#!/usr/bin/python
+
+import time
+import Queue
+import threading
+import numpy
+
+import audiosource
+
+# ------------------------------------------------------------------------
+# AUDIO BLOCKS
+
+# The frame loop polls the audio source once a frame, on the frame clock.
+# pyo computes the audio on its own clock, in blocks of 1024 samples (43 a
+# second), so a frame can read the same block as the frame before it, or a
+# block can go by without any frame reading it, and every read costs the
+# same whether there was new audio or not.
+#
+# Driven by audio blocks instead, the source calls back after every block
+# (see AudioSource.setBlockCallback).  The callback only copies the block's
+# band amplitudes (and samples, for the flux beat engine) into a queue, an
+# analysis thread runs SoundToColorProcessor.analyze() on every block in
+# the queue, in order and exactly once, as soon as it arrives, and the
+# frame loop only runs render() and output(), taking the beats found since
+# the last frame.
+#
+# Sources that do not run on their own clock (the file and array sources)
+# are played at the speed of the audio by a thread of their own, one hop
+# at a time.
+
+# Key functions:
+
+#   AudioBlockDriver(processor):
+#     Drive the processor by audio blocks.  Use start() instead of the
+#     processor's start() and run(scheduler) instead of scheduler.run().
+
+#   AudioBlockDriver.stats( ) / report( ):
+#     Blocks received, analyzed and dropped because the queue was full, and
+#     how long blocks waited to be analyzed.
+
+# Queued blocks, a little under 1.5 seconds of audio at 1024 samples.  Once
+# full, new blocks are dropped and counted.
+MAX_QUEUED_BLOCKS = 64
+
+# Number of recent blocks the wait statistics are taken over
+NUM_STATS_BLOCKS = 300
+
+# The frame rate the energy beat engine's history length was tuned at
+TUNED_FPS = 30.
+
+# An audio source for the processor to read that hands out the blocks of
+# the source it wraps one by one from a queue.  read() waits for the next
+# block.
+
+class BlockQueueSource(audiosource.AudioSource):
+
+    def __init__(self, source, withSamples=False,
+                 maxblocks=MAX_QUEUED_BLOCKS):
+
+        audiosource.AudioSource.__init__(self, source.numbands)
+
+        self.source = source
+        self.samplerate = source.samplerate
+        self.hopsize = source.hopsize
+        self.withSamples = withSamples
+        self.queue = Queue.Queue(maxblocks)
+        self.running = False
+        self.clock = None
+
+        # the samples and arrival time of the block read last
+        self.samples = None
+        self.arrivedAt = None
+
+        self.blocksReceived = 0
+        self.blocksDropped = 0
+
+        # blocks put in the queue and taken out by read(), the queue can
+        # hold a None as well that only wakes read() up
+        self.blocksQueued = 0
+        self.blocksTaken = 0
+
+    def start(self, outputAudio=False):
+
+        self.source.start(outputAudio)
+
+        # take the first samples now, so the source starts recording them
+        if self.withSamples:
+            self.samples = self.source.newSamples()
+
+        self.running = True
+        if not self.source.setBlockCallback(self._onBlock):
+            self.clock = threading.Thread(target=self._runClock,
+                                          name="AudioBlockClock")
+            self.clock.daemon = True
+            self.clock.start()
+
+    def _onBlock(self):
+
+        # Called from the audio thread, so only copy the block
+        if not self.running:
+            return
+
+        left, right = self.source.read()
+        samples = None
+        if self.withSamples:
+            samples = numpy.array(self.source.newSamples())
+
+        self.blocksReceived += 1
+        try:
+            self.queue.put_nowait((time.time(), numpy.array(left),
+                                   numpy.array(right), samples))
+            self.blocksQueued += 1
+        except Queue.Full:
+            self.blocksDropped += 1
+
+    def _runClock(self):
+
+        # Play a source without a clock of its own at the speed of its audio
+        blockSeconds = float(self.hopsize) / self.samplerate
+        nextBlock = time.time()
+
+        while self.running and not self.source.isFinished():
+            nextBlock += blockSeconds
+            self._onBlock()
+
+            wait = nextBlock - time.time()
+            if wait > 0.:
+                time.sleep(wait)
+
+        # wake up the analysis once the audio ran out
+        self._wake()
+
+    def _wake(self):
+
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+
+    def read(self):
+
+        # Wait for the next block.  Once stopped or out of audio, silence.
+        # The wait has no timeout: python 2 waits with a timeout by sleeping
+        # in steps of up to 50ms, which would hold up every block by half
+        # of that on average.  stop() and the end of the audio put a None
+        # in the queue to wake it up instead.
+        block = None
+        if self.running:
+            block = self.queue.get()
+
+        if block is None:
+            self.samples = numpy.zeros([2, 0]) if self.withSamples else None
+            return numpy.zeros(self.numbands), numpy.zeros(self.numbands)
+
+        self.blocksTaken += 1
+        self.arrivedAt, left, right, self.samples = block
+        return left, right
+
+    def newSamples(self):
+        return self.samples
+
+    def isFinished(self):
+
+        # Out of audio once the source is, and every block it queued was
+        # read.  A None left in the queue does not count.
+        return (self.source.isFinished() and
+                not (self.clock and self.clock.is_alive()) and
+                self.blocksTaken == self.blocksQueued)
+
+    def stop(self):
+
+        # Stop taking blocks and wake up a read() that is waiting
+        self.running = False
+
+        if self.clock:
+            self.clock.join()
+        self._wake()
+
+    def shutdown(self):
+        self.source.shutdown()
+
+    def gui(self, namespace):
+        self.source.gui(namespace)
+
+class AudioBlockDriver(object):
+
+    def __init__(self, processor):
+
+        self.processor = processor
+        self.blocks = BlockQueueSource(processor.audiosource,
+                                       processor.beatengine == 'flux')
+        self.analysis = None
+        self.running = False
+
+        # how long each of the last NUM_STATS_BLOCKS blocks waited in the
+        # queue before being analyzed
+        self.blocksAnalyzed = 0
+        self.waits = numpy.zeros(NUM_STATS_BLOCKS)
+
+    def start(self, outputAudio=False):
+
+        # The processor reads the blocks from then on.  Its energy history
+        # holds NUM_AVERAGE_SAMPLES frames, keep it as many seconds long in
+        # blocks.
+        processor = self.processor
+        blockSeconds = float(self.blocks.hopsize) / self.blocks.samplerate
+        processor.NUM_AVERAGE_SAMPLES = max(1, int(round(
+            processor.NUM_AVERAGE_SAMPLES / (TUNED_FPS * blockSeconds))))
+
+        processor.audiosource = self.blocks
+        processor.start(outputAudio)
+
+        self.running = True
+        self.analysis = threading.Thread(target=self._runAnalysis,
+                                         name="AudioBlockAnalysis")
+        self.analysis.daemon = True
+        self.analysis.start()
+
+    def _runAnalysis(self):
+
+        while self.running and not self.blocks.isFinished():
+            self.processor.analyze()
+
+            if self.blocks.arrivedAt is not None:
+                self.waits[self.blocksAnalyzed % self.waits.shape[0]] = (
+                    time.time() - self.blocks.arrivedAt)
+                self.blocksAnalyzed += 1
+                self.blocks.arrivedAt = None
+
+    def run(self, scheduler, numframes=None):
+
+        # Render and output on the frame clock until interrupted or the
+        # audio runs out
+        try:
+            scheduler.run(self.processor, numframes,
+                          shouldStop=self.blocks.isFinished,
+                          update=self.processor.render)
+        finally:
+            self.stop()
+
+    def stop(self):
+
+        self.running = False
+        self.blocks.stop()
+        if self.analysis and self.analysis.ident is not None:
+            self.analysis.join(1.)
+
+    def stats(self):
+
+        numblocks = min(self.blocksAnalyzed, self.waits.shape[0])
+        waits = self.waits[:numblocks] if numblocks else numpy.zeros(1)
+
+        return {
+            'received': self.blocks.blocksReceived,
+            'analyzed': self.blocksAnalyzed,
+            'dropped': self.blocks.blocksDropped,
+            'waitmean': numpy.mean(waits),
+            'waitp99': numpy.percentile(waits, 99),
+        }
+
+    def report(self):
+
+        stats = self.stats()
+        stats['waitmean'] *= 1000.
+        stats['waitp99'] *= 1000.
+        return ("blocks received: %(received)i  analyzed: %(analyzed)i  "
+                "dropped: %(dropped)i  wait mean/p99: "
+                "%(waitmean).2f/%(waitp99).2fms" % stats)
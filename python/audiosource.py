@@ -0,0 +1,415 @@
+#!/usr/bin/python
+
+import math
+import wave
+import numpy
+
+# ------------------------------------------------------------------------
+# AUDIO SOURCES
+
+# An audio source is what SoundToColorProcessor listens to.  Every call to
+# read() returns a (left, right) pair of arrays holding the amplitude of
+# each frequency band over the most recent stretch of audio.  These are the
+# per band amplitudes that the beat detection in _processBeat consumes.
+#
+# Sources that have samples keep their samplerate and the hopsize in
+# samples that the audio moves on by between reads (or blocks).
+
+# Key functions:
+
+#   start(outputAudio=True or False) :
+#     Called once before the first read() to get the audio flowing.
+
+#   read( ):
+#     Returns the (left, right) band amplitudes for the next frame.
+
+#   newSamples( ):
+#     The raw [numchannels, numsamples] samples that arrived since the last
+#     call, for beat engines that work on samples (see onsetdetection.py).
+#     None for sources that only have band amplitudes.
+
+#   setBlockCallback(callback):
+#     Have callback() called from the audio thread every time the source
+#     has computed a new block of audio, so read() and newSamples() return
+#     every block exactly once (see audioblocks.py).  Returns False for
+#     sources that do not run on their own clock.
+
+#   isFinished( ):
+#     True once a source that reads from a file or array has no audio left.
+#     Live sources never finish.
+
+#   shutdown( ):
+#     Called to close down whatever the source opened.
+
+class AudioSource(object):
+
+    def __init__(self, numbands=16):
+        self.numbands = numbands
+
+    def start(self, outputAudio=False):
+        pass
+
+    def read(self):
+        raise NotImplementedError("%s does not implement read()" %
+                                  self.__class__.__name__)
+
+    def newSamples(self):
+        return None
+
+    def setBlockCallback(self, callback):
+        return False
+
+    def isFinished(self):
+        return False
+
+    def shutdown(self):
+        pass
+
+# ------------------------------------------------------------------------
+# PYO LIVE INPUT
+
+# Live input through a pyo server listening to the soundflower device.
+# The audio is split into frequency bands by pyo and each band runs through
+# an envelope follower that is averaged over 1024 samples.
+#
+# pyo computes the audio in blocks of BUFFER_SIZE samples.  With a block
+# callback, pyo calls it before computing every block, when the followers
+# hold the values of the block before.
+#
+# The raw samples for newSamples() are only recorded once it is first
+# called, into a circular table of SAMPLE_TABLE_SECONDS per channel (this
+# needs pyo's TableFill, pyo 0.9.1 or newer).
+#
+# Building the source does nothing but remember the devices: pyo is only
+# imported, and the audio devices looked up and the server booted, by
+# start().
+
+class PyoAudioSource(AudioSource):
+
+    SAMPLE_TABLE_SECONDS = .5
+    SAMPLE_RATE = 44100
+    BUFFER_SIZE = 1024
+
+    def __init__(self, numbands=16, inputDeviceName='Soundflower (2ch)',
+                 outputDeviceName='Built-in Output'):
+
+        AudioSource.__init__(self, numbands)
+
+        self.samplerate = self.SAMPLE_RATE
+        self.hopsize = self.BUFFER_SIZE
+        self.inputDeviceName = inputDeviceName
+        self.outputDeviceName = outputDeviceName
+
+        self.server = None
+        self.sampletables = None
+
+    def _bootServer(self):
+
+        # requires pyo: https://code.google.com/p/pyo/
+        import pyo
+
+        # This is the pyo sound server that will be grabbing color from the
+        # soundflower input.
+        self.server = pyo.Server(sr=self.samplerate, nchnls=2,
+                                 buffersize=self.BUFFER_SIZE)
+
+        self.inputDeviceIdx = -1;
+        self.outputDeviceIdx = -1;
+
+        inputDeviceName = self.inputDeviceName
+        outputDeviceName = self.outputDeviceName
+
+        inputs, outputs = pyo.pa_get_devices_infos()
+        for idx,info in inputs.iteritems():
+            if inputDeviceName == info.get('name', None):
+                print "Found input device ( %(inputDeviceName)s ]: %(idx)i " % locals()
+                self.inputDeviceIdx = idx
+
+        for idx,info in outputs.iteritems():
+            if outputDeviceName == info.get('name', None):
+                print "Found input device [ %(outputDeviceName)s ]: %(idx)i " % locals()
+                self.outputDeviceIdx = idx
+
+        self.server.setInputDevice(self.inputDeviceIdx)
+        self.server.setOutputDevice(self.outputDeviceIdx)
+
+        self.server.boot()
+
+    def start(self, outputAudio=False):
+        # Fire up the pyo sound server and prepare the audio inputs so that
+        # it is split up into frequency bands.
+
+        import pyo
+
+        if self.server is None:
+            self._bootServer()
+        self.server.start()
+
+        self.leftinput = pyo.Input(chnl=1)
+        self.rightinput = pyo.Input(chnl=0)
+
+        self.leftbands = pyo.BandSplit(self.leftinput,
+            num=self.numbands, min=20, max=18000)
+        self.rightbands = pyo.BandSplit(self.rightinput,
+            num=self.numbands, min=20, max=18000)
+
+        self.leftinstamp = pyo.Average( pyo.Follower( self.leftbands ), size=self.BUFFER_SIZE )
+        self.rightinstamp = pyo.Average( pyo.Follower( self.rightbands ), size=self.BUFFER_SIZE )
+
+        if outputAudio:
+            self.leftinput.out(chnl=1)
+            self.rightinput.out(chnl=0)
+
+    def read(self):
+        return (numpy.array(self.leftinstamp.get(all=True)),
+                numpy.array(self.rightinstamp.get(all=True)))
+
+    def newSamples(self):
+
+        import pyo
+
+        if self.sampletables is None:
+            self.sampletables = [pyo.NewTable(self.SAMPLE_TABLE_SECONDS)
+                                 for channel in range(2)]
+            self.samplefills = [pyo.TableFill(channelinput, table)
+                                for channelinput, table in
+                                zip([self.leftinput, self.rightinput],
+                                    self.sampletables)]
+            self.samplepos = self.samplefills[0].getCurrentPos()
+
+        # everything written into the tables since the last call, oldest
+        # sample first
+        pos = self.samplefills[0].getCurrentPos()
+        size = self.sampletables[0].getSize()
+        indices = (self.samplepos + numpy.arange((pos - self.samplepos) %
+                                                 size)) % size
+        self.samplepos = pos
+
+        return numpy.array([numpy.array(table.getTable())[indices]
+                            for table in self.sampletables])
+
+    def setBlockCallback(self, callback):
+        self.server.setCallback(callback)
+        return True
+
+    def shutdown(self):
+        if self.server:
+            self.server.stop()
+
+    def gui(self, namespace):
+        self.server.gui(namespace)
+
+# ------------------------------------------------------------------------
+# BAND ANALYSIS
+
+# Pure numpy replacement for pyo's BandSplit -> Follower -> Average chain.
+# A whole window of samples for every channel goes through one windowed FFT
+# and the power of the bins is summed into numbands log spaced frequency
+# bands with a single matrix product.
+#
+# The band power is turned into the average absolute amplitude of the band
+# (what an envelope follower settles at), scaled so that a sine wave gives
+# the same value as the pyo chain.
+
+class BandEnergyAnalyzer(object):
+
+    def __init__(self, samplerate=44100, windowsize=4096, numbands=16,
+                 minfreq=20., maxfreq=18000.):
+
+        self.samplerate = samplerate
+        self.windowsize = windowsize
+        self.numbands = numbands
+
+        self.window = numpy.hanning(windowsize)
+
+        freqs = numpy.fft.rfftfreq(windowsize, 1./samplerate)
+        edges = numpy.logspace(math.log10(minfreq), math.log10(maxfreq),
+                               numbands + 1)
+
+        # 1 where an fft bin belongs to a band.  Low bands can be narrower
+        # than a bin, so a band without any bins uses the bin closest to
+        # its center.
+        self.bandweights = numpy.zeros([numbands, freqs.shape[0]])
+        for band in range(numbands):
+            inband = (freqs >= edges[band]) & (freqs < edges[band + 1])
+            if inband.any():
+                self.bandweights[band][inband] = 1.
+            else:
+                center = math.sqrt(edges[band] * edges[band + 1])
+                self.bandweights[band][numpy.argmin(abs(freqs - center))] = 1.
+
+        # Parseval's theorem gives the mean square of the band from the
+        # power of its bins, and the average absolute value of a sine wave
+        # is 2 * sqrt(2) / pi of its root mean square.
+        self.powerscale = 2. / (windowsize * numpy.sum(self.window * self.window))
+        self.amplitudescale = 2. * math.sqrt(2.) / math.pi
+
+    def analyze(self, samples):
+
+        # samples is a [numchannels, windowsize] array, returns a
+        # [numchannels, numbands] array of band amplitudes.
+        spectrum = numpy.fft.rfft(samples * self.window, axis=-1)
+        power = spectrum.real * spectrum.real + spectrum.imag * spectrum.imag
+
+        bandpower = numpy.dot(power, self.bandweights.T)
+        return self.amplitudescale * numpy.sqrt(self.powerscale * bandpower)
+
+# ------------------------------------------------------------------------
+# OFFLINE SOURCES
+
+# Base class for sources that have the raw samples at hand.  Every read()
+# moves forward by hopsize samples (1/30th of a second by default, one
+# frame) and analyzes the last windowsize samples.  Nothing waits on the
+# clock, so these sources run as fast as the analysis can go.
+
+class BlockAudioSource(AudioSource):
+
+    def __init__(self, samplerate=44100, numbands=16, hopsize=None,
+                 windowsize=4096):
+
+        AudioSource.__init__(self, numbands)
+
+        self.samplerate = samplerate
+        self.hopsize = hopsize or int(samplerate / 30)
+        self.analyzer = BandEnergyAnalyzer(samplerate, windowsize, numbands)
+
+        # the last windowsize samples of the left and right channel
+        self.samples = numpy.zeros([2, windowsize])
+        self.finished = False
+
+    def _readBlock(self, numframes):
+
+        # Returns up to numframes of [numframes, numchannels] float samples
+        # or an empty array once the audio runs out.
+        raise NotImplementedError("%s does not implement _readBlock()" %
+                                  self.__class__.__name__)
+
+    def readSamples(self):
+
+        # Move forward by one hop and return the window of samples that
+        # ends there.  Once the audio runs out, silence is shifted in.
+        block = self._readBlock(self.hopsize)
+        if block.shape[0] < self.hopsize:
+            self.finished = True
+
+        hop = min(self.hopsize, self.samples.shape[1])
+        self.samples[:, :-hop] = self.samples[:, hop:]
+        self.samples[:, -hop:] = 0.
+
+        if block.shape[0]:
+            block = block[-hop:]
+            if block.shape[1] == 1:
+                block = numpy.repeat(block, 2, axis=1)
+
+            self.samples[:, self.samples.shape[1] - hop:
+                            self.samples.shape[1] - hop + block.shape[0]] = block[:, :2].T
+
+        return self.samples
+
+    def read(self):
+        left, right = self.analyzer.analyze(self.readSamples())
+        return left, right
+
+    def newSamples(self):
+
+        # the hop the last read() moved forward by
+        hop = min(self.hopsize, self.samples.shape[1])
+        return self.samples[:, -hop:]
+
+    def isFinished(self):
+        return self.finished
+
+# Reads a WAV file, or a headerless file of raw PCM samples when rawformat
+# is given.  rawformat is a numpy dtype string for one sample (e.g. '<i2'
+# for 16 bit little endian) and rawchannels the number of interleaved
+# channels.  Samples are streamed from disk one hop at a time.
+
+class WaveFileAudioSource(BlockAudioSource):
+
+    def __init__(self, filename, rawformat=None, rawchannels=2,
+                 rawsamplerate=44100, **kwargs):
+
+        self.filename = filename
+        self.wavefile = None
+        self.rawfile = None
+
+        if rawformat:
+            self.dtype = numpy.dtype(rawformat)
+            self.numchannels = rawchannels
+            samplerate = rawsamplerate
+            self.rawfile = open(filename, 'rb')
+        else:
+            self.wavefile = wave.open(filename, 'rb')
+            self.numchannels = self.wavefile.getnchannels()
+            samplerate = self.wavefile.getframerate()
+
+            samplewidth = self.wavefile.getsampwidth()
+            if samplewidth == 1:
+                self.dtype = numpy.dtype('u1')
+            elif samplewidth in (2, 4):
+                self.dtype = numpy.dtype('<i%d' % samplewidth)
+            else:
+                raise Exception("Unsupported sample width [ %i ] in [ %s ]" %
+                                (samplewidth, filename))
+
+        BlockAudioSource.__init__(self, samplerate, **kwargs)
+
+    def _readBlock(self, numframes):
+
+        if self.wavefile:
+            data = self.wavefile.readframes(numframes)
+        else:
+            data = self.rawfile.read(numframes * self.numchannels *
+                                     self.dtype.itemsize)
+
+        # drop a trailing partial frame
+        framesize = self.numchannels * self.dtype.itemsize
+        data = data[:len(data) - len(data) % framesize]
+
+        block = numpy.frombuffer(data, dtype=self.dtype).reshape(
+            -1, self.numchannels).astype(float)
+
+        # scale integer samples into the [-1, 1] range
+        if self.dtype.kind == 'u':
+            block = block / (2 ** (8 * self.dtype.itemsize - 1)) - 1.
+        elif self.dtype.kind == 'i':
+            block /= 2 ** (8 * self.dtype.itemsize - 1)
+
+        return block
+
+    def shutdown(self):
+        if self.wavefile:
+            self.wavefile.close()
+        if self.rawfile:
+            self.rawfile.close()
+
+# Plays back audio already in memory.  samples is either a [numframes] mono
+# array or a [numframes, numchannels] array of floats in the [-1, 1] range.
+# Set loop to start over at the beginning when the audio runs out.
+
+class ArrayAudioSource(BlockAudioSource):
+
+    def __init__(self, samples, samplerate=44100, loop=False, **kwargs):
+
+        BlockAudioSource.__init__(self, samplerate, **kwargs)
+
+        self.audio = numpy.asarray(samples, dtype=float)
+        if self.audio.ndim == 1:
+            self.audio = self.audio.reshape(-1, 1)
+
+        self.position = 0
+        self.loop = loop
+
+    def _readBlock(self, numframes):
+
+        if self.loop and self.position >= self.audio.shape[0]:
+            self.position = 0
+
+        block = self.audio[self.position:self.position + numframes]
+        self.position += block.shape[0]
+
+        if self.loop and block.shape[0] < numframes and self.audio.shape[0]:
+            block = numpy.concatenate(
+                (block, self._readBlock(numframes - block.shape[0])))
+
+        return block
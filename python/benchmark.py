@@ -0,0 +1,1037 @@
+#!/usr/bin/python
+
+# Headless benchmark of the sound2color / sound2light frame pipeline.
+#
+# Runs SoundToColorProcessor and SoundToLightProcessor against synthetic band
+# amplitudes and a mock serial port (no audio server, terminal or arduino
+# needed) and reports frames/sec and p50/p99 frame times for every stage of
+# a frame:
+#
+#   update  : beat detection and rendering of the colorarray
+#   publish : handing the colorarray to the serial writer threads
+#   encode  : turning the colorarray into encoded color frames (--sync)
+#   send    : TCLSerialManager.SendColorBytes on the mock serial ports (--sync)
+#   frame   : all of the above
+#
+# The light processor splits its leds across --strips mock serial ports.  It
+# also reports the average encoded frame size and, when using the serial
+# writer threads, how many frames they wrote and dropped and their average
+# write latency.
+#
+# With --emulate the light processor talks to emulated arduinos on ptys
+# instead (see tclemulator.py), through the real serial handshake and at a
+# modelled baud rate, and what the arduinos showed is reported too.  The
+# colors are calibrated on the host and sent in raw color mode, unless
+# --calibration firmware leaves the color correction to the arduinos.
+#
+# With --metrics the stages are also timed into a metrics.Metrics, which
+# shows what the instrumentation costs, and the prometheus text of the last
+# run is written to the file given.
+#
+# With --effects the processors draw that list of effect layers (see
+# effects.py) instead of the beat pulse alone.  Repeat it to see how the
+# update stage grows with the layers.
+#
+# With --sink e131 or --sink artnet the light processor sends its frames
+# over udp to a netoutput.PixelReceiver on the loopback interface instead,
+# split into universes of 170 leds, and the frames received are reported.
+#
+# With --fps the frames are paced by a framescheduler.FrameScheduler at that
+# rate instead of running flat out, and its jitter statistics are reported.
+#
+# With --latency the beat engines are compared instead: a click track is
+# analyzed by each engine and for every click the time from the click until
+# the frame that shows a beat for it is measured.  That is the latency from
+# the audio to the colorarray, what the serial link adds comes on top.
+#
+# With --blocks a click track is played in real time by a source with its
+# own clock, like pyo, and polling it every frame is compared with driving
+# the analysis by its audio blocks (see audioblocks.py): how many blocks
+# were analyzed twice or never, the click latency and the cpu time used.
+#
+# Beat density, led count, strip count, band count and beat capacity can each
+# be given a list of values and every combination is run.  With --thresholds
+# the run fails (exit code 1) when a stage is slower than allowed, for
+# example:
+#
+#   ./benchmark.py --leds 50,300 --thresholds benchmark_thresholds.json
+#
+# With --check-allocations every combination instead runs a few thousand
+# frames after a warm up and checks that the frame loop does not grow: no
+# buffer of a frame (the colorarray, beats, encoder buffers, ...) moved, no
+# more python objects are alive than before, the peak memory of the
+# process did not grow and, where tracemalloc is there (python 3), under
+# a byte of memory per frame stayed allocated.  Fails with exit code 1 if
+# it did.
+
+import gc
+import sys
+import time
+import json
+import resource
+import argparse
+import threading
+import itertools
+import numpy
+
+import audioblocks
+import audiosource
+import calibration
+import effects
+import framecodec
+import framescheduler
+import metrics
+import netoutput
+import sound2color
+import sound2light
+
+# ------------------------------------------------------------------------
+# SYNTHETIC INPUT
+
+# Audio source that makes up band amplitudes instead of listening to audio.
+# Every band sits at a quiet noise floor and jumps up with a probability of
+# beatdensity per frame, which the beat detection picks up as a beat.
+
+class SyntheticBandSource(audiosource.AudioSource):
+
+    FLOOR_AMPLITUDE = .01
+    BEAT_AMPLITUDE = .02
+
+    def __init__(self, numbands=16, beatdensity=.2, seed=0):
+
+        audiosource.AudioSource.__init__(self, numbands)
+        self.beatdensity = beatdensity
+        self.random = numpy.random.RandomState(seed)
+
+    def read(self):
+
+        beats = self.random.random_sample(self.numbands) < self.beatdensity
+        amplitudes = numpy.where(beats, SyntheticBandSource.BEAT_AMPLITUDE,
+                                 SyntheticBandSource.FLOOR_AMPLITUDE)
+        noise = self.random.uniform(.9, 1.1, [2, self.numbands])
+        return amplitudes * noise[0], amplitudes * noise[1]
+
+# ------------------------------------------------------------------------
+# MOCK SERIAL PORT
+
+# Stands in for a serial.Serial connected to the PySerialTCLConnect
+# firmware.  It answers the handshake messages and swallows color frames.
+# When baudrate is set, bytes drain out at that rate (10 bits per byte) and
+# outWaiting() reports what has not been sent yet, like a real port.
+
+class MockSerial(object):
+
+    def __init__(self, baudrate=0):
+
+        self.baudrate = baudrate
+        self.timeout = None
+        self.replies = ""
+        self.lock = threading.Lock()
+        self.bytesWritten = 0
+        self.drainedAt = time.time()
+
+    def __str__(self):
+        return "MockSerial(baudrate=%i)" % self.baudrate
+
+    def writable(self):
+        return True
+
+    def isOpen(self):
+        return True
+
+    def outWaiting(self):
+
+        if not self.baudrate:
+            return 0
+
+        return int(max(0., self.drainedAt - time.time()) * self.baudrate / 10.)
+
+    def write(self, data):
+
+        self.bytesWritten += len(data)
+
+        if self.baudrate:
+            self.drainedAt = (max(self.drainedAt, time.time()) +
+                              len(data) * 10. / self.baudrate)
+
+        # color frames come in as buffers, messages as strings
+        if not isinstance(data, str) or not data.startswith("tcl:"):
+            return len(data)
+
+        tokens = data.rstrip("!").split(":")
+        if tokens[1] == "handextended":
+            self.program = tokens[2]
+            self._reply("tcl:handreceived:%s\n" % self.program)
+        elif tokens[1] == "status":
+            self._reply("tcl:handshakeconfirmed:1\n"
+                        "tcl:handshakeprogram:%s\n" % self.program)
+        elif tokens[1] == "colorbegin":
+            self._reply("tcl:colorbeginreceived:%s\n" % self.program)
+        elif tokens[1] == "colorraw":
+            self._reply("tcl:colorrawreceived:%s\n" % self.program)
+
+        return len(data)
+
+    def _reply(self, reply):
+        with self.lock:
+            self.replies += reply
+
+    def flush(self):
+
+        # wait for everything written to drain out
+        if self.baudrate:
+            time.sleep(max(0., self.drainedAt - time.time()))
+
+    def inWaiting(self):
+        return len(self.replies)
+
+    def read(self, size=1):
+
+        # like a real port, wait up to the timeout when nothing came in
+        if not self.replies and self.timeout:
+            time.sleep(self.timeout)
+
+        with self.lock:
+            data, self.replies = self.replies[:size], self.replies[size:]
+        return data
+
+    def close(self):
+        pass
+
+# ------------------------------------------------------------------------
+# BENCHMARKED PROCESSORS
+
+# The processors run headless, the terminal view needs a real terminal and
+# is not part of what we measure.
+
+def splitLeds(numleds, numstrips):
+
+    # Split numleds as evenly as possible into numstrips strips
+    stripleds = [numleds // numstrips] * numstrips
+    stripleds[-1] += numleds % numstrips
+    return stripleds
+
+def makeProcessor(kind, numleds, numbands, capacity, beatdensity, baudrate,
+                  compression, asyncOutput, numstrips=1, emulate=False,
+                  calibrationMode='host', effectLayers=None, sink='serial'):
+
+    # Build a processor class for the requested number of bands and beat
+    # capacity, driving numleds leds.  The light processor splits them
+    # across numstrips mock serial ports, or emulated arduinos on ptys when
+    # emulate is set.  With calibrationMode 'host' the colors are calibrated
+    # with the default profile before they are sent, with 'firmware' the
+    # arduinos correct them.  effectLayers is a --effects list of layers
+    # drawn instead of the beat pulse alone, see effects.py.  With a sink
+    # of e131 or artnet the light processor sends to udp pixel strips
+    # instead, received by a netoutput.PixelReceiver on the loopback
+    # interface.  Returns the processor, the emulators and the receiver.
+    baseclass = {'color': sound2color.SoundToColorProcessor,
+                 'light': sound2light.SoundToLightProcessor}[kind]
+    procclass = type(baseclass.__name__, (baseclass,),
+                     {'NUM_FREQUENCY_BANDS': numbands,
+                      'BEAT_CAPACITY': capacity})
+
+    source = SyntheticBandSource(numbands, beatdensity)
+    emulators = []
+    receiver = None
+
+    if kind == 'light' and sink != 'serial':
+        receiver = netoutput.PixelReceiver(numleds, sink, port=0)
+        receiver.start()
+
+        # the strips' universes follow each other
+        sinks = []
+        universe = receiver.universe
+        for leds in splitLeds(numleds, numstrips):
+            sinks.append(netoutput.UDPPixelStrip(leds, sink, "127.0.0.1",
+                                                 universe, receiver.port))
+            universe += len(sinks[-1].universes)
+
+        processor = procclass(source, asyncOutput=asyncOutput,
+                              headless=True, sinks=sinks)
+
+    elif kind == 'light':
+        stripleds = splitLeds(numleds, numstrips)
+        if emulate:
+            # tclemulator subclasses pyserial's Serial, so it is only
+            # imported when emulating
+            import tclemulator
+
+            emulators = [tclemulator.TCLFirmwareEmulator(leds,
+                                                         baudrate or 115200)
+                         for leds in stripleds]
+            for emulator in emulators:
+                emulator.start()
+            sconnects = [emulator.openSerial(sound2light.READ_TIMEOUT)
+                         for emulator in emulators]
+        else:
+            sconnects = [MockSerial(baudrate) for i in range(numstrips)]
+
+        profile = (calibration.CalibrationProfile()
+                   if calibrationMode == 'host' else None)
+        processor = procclass(source, sconnect=sconnects,
+                              compression=compression,
+                              asyncOutput=asyncOutput, headless=True,
+                              numleds=stripleds, calibrationProfile=profile)
+    else:
+        processor = procclass(source, headless=True, numleds=numleds)
+
+    if effectLayers:
+        processor.effects = effects.parseEffects(effectLayers)
+
+    processor.start()
+    return processor, emulators, receiver
+
+# ------------------------------------------------------------------------
+# BENCHMARK
+
+def writerStats(strips):
+
+    # Add up the serial writer counters of all of the strips
+    allstats = [strip.serialwriter.stats() for strip in strips]
+
+    stats = {}
+    for key in ['published', 'written', 'dropped', 'bytes']:
+        stats[key] = sum(writer[key] for writer in allstats)
+    stats['maxlatency'] = max(writer['maxlatency'] for writer in allstats)
+    stats['avglatency'] = numpy.mean([writer['avglatency']
+                                      for writer in allstats])
+    return stats
+
+def emulatorStats(emulators):
+
+    # Add up what the emulated arduinos saw
+    allstats = [emulator.stats() for emulator in emulators]
+
+    stats = {}
+    for key in ['received', 'dropped', 'started', 'shown']:
+        stats[key] = sum(emulated[key] for emulated in allstats)
+    stats['fps'] = min(emulated['fps'] for emulated in allstats)
+    stats['maxlatency'] = max(emulated['maxlatency'] for emulated in allstats)
+    stats['avglatency'] = numpy.mean([emulated['avglatency']
+                                      for emulated in allstats])
+    return stats
+
+def runBenchmark(kind, numleds, numbands, capacity, beatdensity, numframes,
+                 baudrate, compression='auto', asyncOutput=True, fps=None,
+                 numstrips=1, emulate=False, calibrationMode='host',
+                 metricsFile=None, effectLayers=None, sink='serial'):
+
+    processor, emulators, receiver = makeProcessor(
+        kind, numleds, numbands, capacity, beatdensity, baudrate, compression,
+        asyncOutput, numstrips, emulate, calibrationMode, effectLayers, sink)
+    strips = getattr(processor, 'strips', [])
+    serialwriter = strips and getattr(strips[0], 'serialwriter', None)
+
+    # fill up the energy history so that beat detection is running
+    for i in range(processor.NUM_AVERAGE_SAMPLES):
+        processor.update()
+
+    if kind == 'color':
+        stages = ['update', 'frame']
+    elif serialwriter:
+        stages = ['update', 'publish', 'frame']
+    elif receiver:
+        stages = ['update', 'send', 'frame']
+    else:
+        stages = ['update', 'encode', 'send', 'frame']
+
+    timings = dict((stage, numpy.zeros(numframes)) for stage in stages)
+    livebeats = 0
+    framebytes = 0
+    framessent = numframes
+
+    scheduler = None
+    if fps:
+        scheduler = framescheduler.FrameScheduler(fps=fps)
+
+    frameMetrics = None
+    if metricsFile:
+        frameMetrics = metrics.Metrics()
+        processor.setMetrics(frameMetrics)
+        if scheduler:
+            scheduler.setMetrics(frameMetrics)
+
+    start = time.time()
+    for frame in range(numframes):
+
+        if scheduler:
+            scheduler.waitForFrame()
+
+        t0 = time.time()
+        processor.update()
+        t1 = time.time()
+        timings['update'][frame] = t1 - t0
+
+        if serialwriter:
+            processor._sendColors()
+            timings['publish'][frame] = time.time() - t1
+
+        elif receiver:
+            processor._sendColors()
+            timings['send'][frame] = time.time() - t1
+
+        else:
+            for strip in strips:
+                t2 = time.time()
+                colorData = strip.EncodeColors(processor.colorarray)
+                t3 = time.time()
+                strip.serialmgr.SendColorBytes(colorData)
+                framebytes += len(colorData)
+
+                timings['encode'][frame] += t3 - t2
+                timings['send'][frame] += time.time() - t3
+
+        timings['frame'][frame] = time.time() - t0
+        if scheduler:
+            scheduler.frameDone(timings['frame'][frame],
+                                processor.outputPeriod())
+        livebeats += numpy.count_nonzero(processor.beatwave[:, 1] > 0.)
+
+    elapsed = time.time() - start
+    processor.shutdown()
+
+    if frameMetrics:
+        frameMetrics.writeTextfile(metricsFile)
+
+    emulatedstats = emulatorStats(emulators) if emulators else None
+    for emulator in emulators:
+        emulator.stop()
+
+    # let the last packets arrive
+    receivedstats = None
+    if receiver:
+        time.sleep(.2)
+        receivedstats = receiver.stats()
+        receiver.stop()
+        framebytes = sum(strip.bytesSent for strip in strips)
+
+    if serialwriter:
+        writerstats = writerStats(strips)
+        framebytes = writerstats['bytes']
+        framessent = writerstats['written']
+    else:
+        framessent *= max(len(strips), 1)
+
+    result = {
+        'processor': kind,
+        'leds': numleds,
+        'strips': len(strips),
+        'bands': numbands,
+        'capacity': capacity,
+        'density': beatdensity,
+        'frames': numframes,
+        'fps': numframes / elapsed,
+        'livebeats': livebeats / float(numframes),
+        'sink': sink if kind == 'light' else None,
+        'compression': (compression if kind == 'light' and sink == 'serial'
+                        else None),
+        'calibration': calibrationMode if kind == 'light' else None,
+        'effects': effectLayers,
+        'framebytes': framebytes / float(max(framessent, 1)),
+        'writer': writerstats if serialwriter else None,
+        'scheduler': scheduler.stats() if scheduler else None,
+        'emulator': emulatedstats,
+        'received': receivedstats,
+        'stages': {},
+    }
+    for stage in stages:
+        result['stages'][stage] = {
+            'p50': 1000. * numpy.percentile(timings[stage], 50),
+            'p99': 1000. * numpy.percentile(timings[stage], 99),
+        }
+
+    return result
+
+# ------------------------------------------------------------------------
+# LATENCY
+
+# Clicks must show up within this many seconds to count as found
+MAX_LATENCY = .25
+
+def clickTrack(seconds, samplerate=44100, interval=.5, seed=0):
+
+    # Quiet noise and a low hum with a click every interval seconds, give
+    # or take a little so the clicks do not line up with the frames.  A
+    # click is a burst of noise that dies out over 20 ms.  Returns the
+    # [numsamples, 2] samples and the times of the clicks.
+    random = numpy.random.RandomState(seed)
+    numsamples = int(seconds * samplerate)
+    times = numpy.arange(numsamples) / float(samplerate)
+
+    samples = .005 * random.standard_normal([numsamples, 2])
+    samples += .05 * numpy.sin(2. * numpy.pi * 110. * times)[:, numpy.newaxis]
+
+    clicklength = int(.05 * samplerate)
+    envelope = numpy.exp(-numpy.arange(clicklength) / (.02 * samplerate))
+
+    # leave the engines 2 seconds to settle
+    clicktimes = numpy.arange(2., seconds - 1., interval)
+    clicktimes += random.uniform(0., interval / 2., clicktimes.shape[0])
+
+    for clicktime in clicktimes:
+        start = int(clicktime * samplerate)
+        samples[start:start + clicklength] += (
+            .5 * envelope[:, numpy.newaxis] *
+            random.standard_normal([clicklength, 2]))
+
+    return samples, clicktimes
+
+def runLatency(beatengine, numbands, fps=30., seconds=30.):
+
+    samplerate = 44100
+    samples, clicktimes = clickTrack(seconds, samplerate)
+
+    source = audiosource.ArrayAudioSource(samples, samplerate,
+                                          numbands=numbands,
+                                          hopsize=int(samplerate / fps))
+    procclass = type('SoundToColorProcessor',
+                     (sound2color.SoundToColorProcessor,),
+                     {'NUM_FREQUENCY_BANDS': numbands})
+    processor = procclass(source, headless=True, beatengine=beatengine)
+    processor.start()
+
+    # after every update the source has read up to the end of its hop
+    beattimes = []
+    frame = 0
+    while not source.isFinished():
+        processor.update()
+        frame += 1
+        if processor.beatamps.any():
+            beattimes.append(frame * source.hopsize / float(samplerate))
+
+    processor.shutdown()
+
+    result = matchClicks(numpy.array(beattimes), clicktimes)
+    result.update({'engine': beatengine, 'fps': fps})
+    return result
+
+def matchClicks(beattimes, clicktimes):
+
+    # The first beat within MAX_LATENCY of every click is the click's, the
+    # beats that belong to no click are false beats
+    latencies = []
+    matched = numpy.zeros(beattimes.shape[0], dtype=bool)
+    for clicktime in clicktimes:
+        found = numpy.flatnonzero((beattimes >= clicktime) &
+                                  (beattimes < clicktime + MAX_LATENCY))
+        if found.shape[0]:
+            latencies.append(beattimes[found[0]] - clicktime)
+            matched[found] = True
+
+    found = len(latencies)
+    latencies = numpy.array(latencies) if found else numpy.zeros(1)
+    return {
+        'clicks': clicktimes.shape[0],
+        'found': found,
+        'falsebeats': int(numpy.count_nonzero(~matched)),
+        'mean': 1000. * numpy.mean(latencies),
+        'p50': 1000. * numpy.percentile(latencies, 50),
+        'p99': 1000. * numpy.percentile(latencies, 99),
+    }
+
+def printLatency(result):
+
+    print ("latency engine=%(engine)-7s fps=%(fps).0f found=%(found)i/"
+           "%(clicks)i falsebeats=%(falsebeats)i mean=%(mean).1fms "
+           "p50=%(p50).1fms p99=%(p99).1fms" % result)
+
+# ------------------------------------------------------------------------
+# AUDIO BLOCKS
+
+# Plays samples on its own clock like pyo does: every BLOCK_SIZE samples a
+# new block is computed when its audio has had time to arrive, and read()
+# returns the band amplitudes of the newest block, however many blocks went
+# by since the last read.  Counts how many times every block was read.
+
+class LiveArraySource(audiosource.AudioSource):
+
+    BLOCK_SIZE = 1024
+
+    def __init__(self, samples, samplerate=44100, numbands=16):
+
+        audiosource.AudioSource.__init__(self, numbands)
+
+        self.samplerate = samplerate
+        self.hopsize = self.BLOCK_SIZE
+        self.arraysource = audiosource.ArrayAudioSource(
+            samples, samplerate, numbands=numbands, hopsize=self.BLOCK_SIZE)
+        self.numblocks = -(-len(samples) // self.BLOCK_SIZE)
+
+        self.lock = threading.Lock()
+        self.callback = None
+        self.running = False
+        self.startedAt = None
+
+        self.left = numpy.zeros(numbands)
+        self.right = numpy.zeros(numbands)
+        self.pendingSamples = []
+        self.blocksComputed = 0
+        self.reads = numpy.zeros(self.numblocks, dtype=int)
+
+    def start(self, outputAudio=False):
+
+        self.running = True
+        self.startedAt = time.time()
+        thread = threading.Thread(target=self._run, name="LiveArraySource")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+
+        blockSeconds = float(self.BLOCK_SIZE) / self.samplerate
+        while self.running and not self.arraysource.isFinished():
+
+            wait = (self.startedAt + (self.blocksComputed + 1) * blockSeconds
+                    - time.time())
+            if wait > 0.:
+                time.sleep(wait)
+
+            left, right = self.arraysource.read()
+            with self.lock:
+                self.left, self.right = left, right
+                self.pendingSamples.append(
+                    self.arraysource.newSamples().copy())
+                self.blocksComputed += 1
+
+            if self.callback:
+                self.callback()
+
+    def read(self):
+
+        with self.lock:
+            if self.blocksComputed:
+                self.reads[self.blocksComputed - 1] += 1
+            return self.left.copy(), self.right.copy()
+
+    def newSamples(self):
+
+        with self.lock:
+            samples = (numpy.concatenate(self.pendingSamples, axis=1)
+                       if self.pendingSamples else numpy.zeros([2, 0]))
+            self.pendingSamples = []
+        return samples
+
+    def setBlockCallback(self, callback):
+        self.callback = callback
+        return True
+
+    def isFinished(self):
+        return self.blocksComputed >= self.numblocks
+
+    def shutdown(self):
+        self.running = False
+
+def runBlocks(mode, beatengine, numbands, fps=30., seconds=10.):
+
+    # Play a click track in real time and either poll it every frame or
+    # drive the processor by its blocks (see audioblocks.py), and count the
+    # blocks analyzed more than once or never, the click latency from the
+    # audio arriving until a frame shows it, and the cpu time used
+    samplerate = 44100
+    samples, clicktimes = clickTrack(seconds, samplerate)
+
+    source = LiveArraySource(samples, samplerate, numbands)
+    procclass = type('SoundToColorProcessor',
+                     (sound2color.SoundToColorProcessor,),
+                     {'NUM_FREQUENCY_BANDS': numbands})
+    processor = procclass(source, headless=True, beatengine=beatengine)
+    scheduler = framescheduler.FrameScheduler(fps=fps, adaptive=False)
+
+    driver = None
+    if mode == 'blocks':
+        driver = audioblocks.AudioBlockDriver(processor)
+        driver.start()
+        step = processor.render
+    else:
+        processor.start()
+        step = processor.update
+
+    cpustart = time.clock()
+    beattimes = []
+    try:
+        while not source.isFinished():
+            scheduler.waitForFrame()
+            start = time.time()
+            step()
+            if processor.beatamps.any():
+                beattimes.append(time.time() - source.startedAt)
+            scheduler.frameDone(time.time() - start)
+    finally:
+        if driver:
+            driver.stop()
+        processor.shutdown()
+
+    cpuseconds = time.clock() - cpustart
+
+    result = matchClicks(numpy.array(beattimes), clicktimes)
+    result.update({
+        'mode': mode,
+        'engine': beatengine,
+        'fps': fps,
+        'blocks': source.numblocks,
+        'twice': int(numpy.sum(numpy.maximum(source.reads - 1, 0))),
+        'skipped': int(numpy.count_nonzero(source.reads == 0)),
+        'cpu': cpuseconds / seconds,
+    })
+    return result
+
+def printBlocks(result):
+
+    print ("blocks mode=%(mode)-6s engine=%(engine)-6s fps=%(fps).0f "
+           "blocks=%(blocks)i twice=%(twice)i skipped=%(skipped)i "
+           "found=%(found)i/%(clicks)i falsebeats=%(falsebeats)i "
+           "mean=%(mean).1fms p99=%(p99).1fms cpu=%(cpu).3f" % result)
+
+# ------------------------------------------------------------------------
+# ALLOCATIONS
+
+# Frames run before the buffers are checked, on top of filling the energy
+# history, so that every buffer built on first use exists
+WARMUP_FRAMES = 100
+
+def frameBuffers(processor):
+
+    # The addresses of the buffers a frame works in, by name
+    buffers = {
+        'colorarray': processor.colorarray,
+        'perpitcharray': processor.perpitcharray,
+        'beatwave': processor.beatwave,
+        'beatcolors': processor.beatcolors,
+        'bands': processor.bands,
+        'beatamps': processor.beatamps,
+        'hits': processor.beatwavebuffers.hits,
+    }
+
+    for idx, strip in enumerate(getattr(processor, 'strips', [])):
+        encoder = (strip.frameencoder if hasattr(strip, 'frameencoder')
+                   else strip.serialmgr.frameencoder)
+        buffers['strip%i.colorbytes' % idx] = encoder.colorbytes
+        buffers['strip%i.payload' % idx] = encoder.payload
+
+    return dict((name, array.ctypes.data) for name, array in buffers.items())
+
+def runAllocations(kind, numleds, numbands, capacity, beatdensity, numframes,
+                   compression='auto', effectLayers=None, sink='serial'):
+
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    processor, emulators, receiver = makeProcessor(
+        kind, numleds, numbands, capacity, beatdensity, 0, compression,
+        False, effectLayers=effectLayers, sink=sink)
+    strips = getattr(processor, 'strips', [])
+
+    def frame():
+        processor.update()
+        processor.output()
+
+    for i in range(processor.NUM_AVERAGE_SAMPLES + WARMUP_FRAMES):
+        frame()
+
+    # The serial readers only listen for the arduinos' replies and the
+    # receiver only counts what arrives, but their threads' objects would
+    # be counted too
+    for strip in strips:
+        if hasattr(strip, 'serialmgr'):
+            strip.serialmgr.StopReader()
+    if receiver:
+        receiver.stop()
+
+    # Count what is left once the frames are done, with the garbage
+    # collector out of the way.  The peak memory is taken after counting
+    # the objects, which takes a list of all of them.
+    addresses = frameBuffers(processor)
+    gc.collect()
+    gc.disable()
+    try:
+        if tracemalloc:
+            tracemalloc.start()
+            frame()
+            traced = tracemalloc.get_traced_memory()[0]
+
+        objects = len(gc.get_objects())
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        for i in range(numframes):
+            frame()
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss
+        objects = len(gc.get_objects()) - objects
+        if tracemalloc:
+            traced = tracemalloc.get_traced_memory()[0] - traced
+            tracemalloc.stop()
+    finally:
+        gc.enable()
+
+    moved = sorted(name for name, address in frameBuffers(processor).items()
+                   if addresses[name] != address)
+
+    processor.shutdown()
+
+    failures = []
+    if moved:
+        failures.append("buffers moved: %s" % ", ".join(moved))
+    if objects > 0:
+        failures.append("%i more python objects" % objects)
+    if maxrss > 0:
+        failures.append("peak memory grew by %ikB" % maxrss)
+    if tracemalloc and traced >= numframes:
+        failures.append("%.1f bytes per frame stayed allocated" %
+                        (traced / float(numframes)))
+
+    return {
+        'processor': kind,
+        'leds': numleds,
+        'bands': numbands,
+        'capacity': capacity,
+        'density': beatdensity,
+        'frames': numframes,
+        'effects': effectLayers,
+        'sink': sink if kind == 'light' else None,
+        'moved': moved,
+        'objects': objects,
+        'maxrss': maxrss,
+        'traced': traced if tracemalloc else None,
+        'failures': failures,
+    }
+
+def printAllocations(result):
+
+    print ("allocations %(processor)-6s leds=%(leds)-5i bands=%(bands)-3i "
+           "capacity=%(capacity)-6i density=%(density)-5.2f "
+           "frames=%(frames)i objects=%(objects)+i maxrss=%(maxrss)+ikB" %
+           result),
+
+    if result['traced'] is not None:
+        print "traced=%+iB" % result['traced'],
+    else:
+        print "traced=n/a",
+
+    print "moved=%s" % (",".join(result['moved']) or "none"),
+    if result['effects']:
+        print "effects=%(effects)s" % result,
+    print
+
+    for failure in result['failures']:
+        print "  ALLOCATION: %s" % failure
+
+def checkThresholds(result, thresholds):
+
+    # thresholds maps a stage name to its highest allowed p99 in
+    # milliseconds, and "fps" to the lowest allowed frames/sec.  Returns a
+    # list of the failures.
+    failures = []
+
+    minfps = thresholds.get('fps')
+    if minfps is not None and result['fps'] < minfps:
+        failures.append("fps %.1f < %.1f" % (result['fps'], minfps))
+
+    for stage, timing in result['stages'].items():
+        maxp99 = thresholds.get(stage)
+        if maxp99 is not None and timing['p99'] > maxp99:
+            failures.append("%s p99 %.3fms > %.3fms" %
+                            (stage, timing['p99'], maxp99))
+
+    return failures
+
+def printResult(result, failures):
+
+    print ("%(processor)-6s leds=%(leds)-5i bands=%(bands)-3i "
+           "capacity=%(capacity)-6i density=%(density)-5.2f "
+           "livebeats=%(livebeats)-7.1f fps=%(fps)-8.1f" % result),
+
+    if result['effects']:
+        print "effects=%(effects)s" % result,
+
+    if result['compression']:
+        print ("strips=%(strips)i %(compression)s calibration=%(calibration)s "
+               "bytes/frame=%(framebytes)-7.1f" % result),
+
+    if result['received']:
+        print ("sink=%s strips=%i bytes/frame=%.1f received=%i/%i frames "
+               "invalid=%i" % (result['sink'], result['strips'],
+                               result['framebytes'],
+                               result['received']['frames'],
+                               result['frames'],
+                               result['received']['invalid'])),
+
+    if result['writer']:
+        print ("written=%(written)i dropped=%(dropped)i "
+               "latency=%(avglatency).4fs" % result['writer']),
+
+    if result['emulator']:
+        print ("shown=%(shown)i/%(started)i shownfps=%(fps).1f "
+               "rxdropped=%(dropped)i ledlatency=%(avglatency).4fs" %
+               result['emulator']),
+
+    if result['scheduler']:
+        print ("target=%(targetfps).1f skipped=%(skipped)i "
+               "jitter=%(jittermean).4fs/%(jitterp99).4fs" %
+               result['scheduler']),
+
+    for stage in ['update', 'publish', 'encode', 'send', 'frame']:
+        if stage in result['stages']:
+            timing = result['stages'][stage]
+            print "%s p50=%.3fms p99=%.3fms " % (stage, timing['p50'],
+                                                 timing['p99']),
+    print
+
+    for failure in failures:
+        print "  REGRESSION: %s" % failure
+
+def parseList(text, cast):
+    return [cast(value) for value in text.split(",")]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the sound2light "
+                                     "frame pipeline without audio or hardware")
+    parser.add_argument("--processors", default="color,light",
+                        help="comma separated processors to run: color, light")
+    parser.add_argument("--leds", default="50,300",
+                        help="comma separated led counts")
+    parser.add_argument("--strips", default="1",
+                        help="comma separated numbers of serial ports the "
+                        "light processor splits its leds across")
+    parser.add_argument("--bands", default="16",
+                        help="comma separated frequency band counts")
+    parser.add_argument("--capacity", default="300",
+                        help="comma separated beat capacities")
+    parser.add_argument("--density", default=".05,.5",
+                        help="comma separated beat probabilities per band "
+                        "per frame")
+    parser.add_argument("--frames", type=int, default=300,
+                        help="number of frames measured per run")
+    parser.add_argument("--baud", type=int, default=0,
+                        help="baud rate modelled by the mock serial port "
+                        "(0 sends instantly)")
+    parser.add_argument("--emulate", action="store_true",
+                        help="send to emulated arduinos on ptys (see "
+                        "tclemulator.py) instead of mock serial ports, at "
+                        "--baud or 115200 baud")
+    parser.add_argument("--sink", default="serial",
+                        choices=['serial'] + netoutput.PROTOCOLS,
+                        help="send the light processor's frames to mock "
+                        "serial ports, or over udp in E1.31 or Art-Net to a "
+                        "receiver on the loopback interface (see "
+                        "netoutput.py)")
+    parser.add_argument("--compression", default="auto",
+                        choices=framecodec.COMPRESSION_MODES,
+                        help="color frame compression of the light processor")
+    parser.add_argument("--calibration", default="host",
+                        choices=['host', 'firmware'],
+                        help="calibrate the colors on the host and send them "
+                        "in raw color mode, or let the firmware do it")
+    parser.add_argument("--effects", action="append",
+                        help="draw these effect layers instead of the beat "
+                        "pulse alone, eg fire,pulse:add (see effects.py), "
+                        "repeat to compare several")
+    parser.add_argument("--sync", action="store_true",
+                        help="send frames from the render loop instead of "
+                        "the serial writer thread")
+    parser.add_argument("--fps", type=float,
+                        help="pace the frames with the frame scheduler at "
+                        "this rate instead of running flat out")
+    parser.add_argument("--latency", action="store_true",
+                        help="compare the latency of the beat engines on a "
+                        "click track instead, at --fps or 30 frames/sec")
+    parser.add_argument("--blocks", action="store_true",
+                        help="compare polling a live source every frame "
+                        "with analyzing each of its audio blocks as they "
+                        "arrive instead, on 10 seconds of a click track "
+                        "played in real time, at --fps or 30 frames/sec")
+    parser.add_argument("--check-allocations", action="store_true",
+                        help="check that frames do not grow memory or move "
+                        "their buffers instead, over --frames frames after "
+                        "a warm up")
+    parser.add_argument("--thresholds",
+                        help="json file of per stage p99 limits in ms and a "
+                        "minimum fps")
+    parser.add_argument("--metrics",
+                        help="time the stages into metrics as well and "
+                        "write the prometheus text of the last run here")
+    parser.add_argument("--json", help="write all results to this json file")
+    args = parser.parse_args()
+
+    if args.latency:
+        results = [runLatency(beatengine, parseList(args.bands, int)[0],
+                              args.fps or 30.)
+                   for beatengine in sound2color.SoundToColorProcessor.BEAT_ENGINES]
+        for result in results:
+            printLatency(result)
+
+        if args.json:
+            with open(args.json, "w") as jsonfile:
+                json.dump(results, jsonfile, indent=2)
+        sys.exit(0)
+
+    if args.blocks:
+        results = [runBlocks(mode, beatengine, parseList(args.bands, int)[0],
+                             args.fps or 30.)
+                   for beatengine in sound2color.SoundToColorProcessor.BEAT_ENGINES
+                   for mode in ['poll', 'blocks']]
+        for result in results:
+            printBlocks(result)
+
+        if args.json:
+            with open(args.json, "w") as jsonfile:
+                json.dump(results, jsonfile, indent=2)
+        sys.exit(0)
+
+    if args.check_allocations:
+        results = []
+        for (kind, numleds, numbands, capacity, beatdensity,
+                effectLayers) in itertools.product(
+                    parseList(args.processors, str), parseList(args.leds, int),
+                    parseList(args.bands, int), parseList(args.capacity, int),
+                    parseList(args.density, float), args.effects or [None]):
+
+            result = runAllocations(kind, numleds, numbands, capacity,
+                                    beatdensity, args.frames,
+                                    args.compression, effectLayers, args.sink)
+            printAllocations(result)
+            results.append(result)
+
+        if args.json:
+            with open(args.json, "w") as jsonfile:
+                json.dump(results, jsonfile, indent=2)
+        sys.exit(1 if any(result['failures'] for result in results) else 0)
+
+    thresholds = {}
+    if args.thresholds:
+        with open(args.thresholds) as thresholdsfile:
+            thresholds = json.load(thresholdsfile)
+
+    results = []
+    numfailures = 0
+
+    for (kind, numleds, numstrips, numbands, capacity, beatdensity,
+            effectLayers) in itertools.product(
+                parseList(args.processors, str), parseList(args.leds, int),
+                parseList(args.strips, int), parseList(args.bands, int),
+                parseList(args.capacity, int),
+                parseList(args.density, float), args.effects or [None]):
+
+        if kind == 'color' and numstrips != 1:
+            continue
+
+        result = runBenchmark(kind, numleds, numbands, capacity, beatdensity,
+                              args.frames, args.baud, args.compression,
+                              not args.sync, args.fps, numstrips,
+                              args.emulate, args.calibration, args.metrics,
+                              effectLayers, args.sink)
+        failures = checkThresholds(result, thresholds)
+        result['failures'] = failures
+
+        printResult(result, failures)
+        results.append(result)
+        numfailures += len(failures)
+
+    if args.json:
+        with open(args.json, "w") as jsonfile:
+            json.dump(results, jsonfile, indent=2)
+
+    sys.exit(1 if numfailures else 0)
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import numpy
+
+# ------------------------------------------------------------------------
+# CALIBRATION
+
+# The PySerialTCLConnect firmware turns every color byte into the light
+# output of its led with plspace in ColorUtils.h:
+#
+#   byte(constrain(255 * pow(mapf(c / 255, 0, 1, min, max), gamma), 0, 255))
+#
+# with a gamma, black point (min) and white point (max) per channel.  That
+# is float math for every channel of every led of every frame, on an AVR
+# with no FPU.
+#
+# A CalibrationProfile holds the same 3 numbers per channel on the host.
+# Since there are only 256 possible color bytes, the whole conversion bakes
+# into a 256 entry lookup table per channel, which is applied to all of the
+# quantized colors of a frame with one numpy.take.  The frames are then sent
+# after tcl:colorraw! instead of tcl:colorbegin!, and the firmware sends the
+# bytes it receives straight to the leds.
+#
+# Profiles are saved as json:
+#
+#   {"gamma": [3.6, 3.6, 3.6], "min": [0.0, 0.0, 0.0], "max": [1.0, 1.0, 1.0]}
+#
+# The firmware's calibration mode (switch 1 high) prints the values of the
+# potentiometers every loop.  Run ./calibration.py <serial port> while tuning
+# them, and the last values printed are saved as the profile when you hit
+# ctrl-c.
+
+# Key functions:
+
+#   CalibrationProfile.lookupTables( ):
+#     The [3, 256] uint8 table of the light output of every channel byte.
+
+#   CalibrationProfile.apply(colorbytes):
+#     Look up a flat array of r, g, b color bytes in place.
+
+#   loadProfile(path) / saveProfile(profile, path):
+#     Read and write profile json files.
+
+#   parseCalibrateLine(line):
+#     The profile printed by the firmware's calibrateLoop, or None.
+
+# The firmware's defaults, see ColorUtils.h
+DEFAULT_GAMMA = 3.6
+DEFAULT_MIN = 0.
+DEFAULT_MAX = 1.
+
+# where sound2light looks for the calibration profile
+PROFILE_FILE = os.path.expanduser("~/.sound2light_calibration.json")
+
+class CalibrationProfile(object):
+
+    def __init__(self, gammas=None, mins=None, maxs=None):
+
+        self.gammas = self._channels(gammas, DEFAULT_GAMMA, "gamma")
+        self.mins = self._channels(mins, DEFAULT_MIN, "min")
+        self.maxs = self._channels(maxs, DEFAULT_MAX, "max")
+
+        self.tables = None
+
+        # offset of each channel's table in the flattened tables, repeated
+        # for every led as needed by apply
+        self.offsets = numpy.zeros(0, dtype=numpy.intp)
+
+    def __str__(self):
+        return "gamma %s min %s max %s" % (self.gammas, self.mins, self.maxs)
+
+    def _channels(self, values, default, name):
+
+        if values is None:
+            return [default] * 3
+
+        if not isinstance(values, (list, tuple)):
+            return [float(values)] * 3
+
+        if len(values) != 3:
+            raise Exception("Calibration [ %s ] needs a value for red, green "
+                            "and blue, got %s" % (name, values))
+
+        return [float(value) for value in values]
+
+    def lookupTables(self):
+
+        # The same math as plspace and sendColor, in single precision floats
+        # like the AVR, and truncated into a byte like byte() does
+        if self.tables is None:
+
+            colors = numpy.arange(256, dtype=numpy.float32) / 255.
+            mins = numpy.array(self.mins, dtype=numpy.float32)[:, None]
+            maxs = numpy.array(self.maxs, dtype=numpy.float32)[:, None]
+            gammas = numpy.array(self.gammas, dtype=numpy.float32)[:, None]
+
+            mapped = numpy.maximum((maxs - mins) * colors + mins, 0.)
+            output = numpy.clip(255. * numpy.power(mapped, gammas), 0., 255.)
+            self.tables = output.astype(numpy.uint8)
+
+        return self.tables
+
+    def apply(self, colorbytes):
+
+        # colorbytes is a flat uint8 array of r, g, b bytes, every byte is
+        # looked up in the table of its channel
+        numbytes = colorbytes.shape[0]
+        if self.offsets.shape[0] != numbytes:
+            self.offsets = numpy.tile(numpy.arange(3) * 256,
+                                      numbytes // 3).astype(numpy.intp)
+
+        numpy.take(self.lookupTables().ravel(), self.offsets + colorbytes,
+                   out=colorbytes)
+        return colorbytes
+
+    def asDict(self):
+        return {'gamma': self.gammas, 'min': self.mins, 'max': self.maxs}
+
+def loadProfile(path=PROFILE_FILE):
+
+    # The profile saved at path, or the firmware's defaults when there is
+    # none
+    try:
+        with open(path) as profilefile:
+            values = json.load(profilefile)
+    except IOError:
+        return CalibrationProfile()
+    except ValueError, e:
+        raise Exception("Unable to read calibration [ %s ]: %s" %
+                        (path, str(e)))
+
+    return CalibrationProfile(values.get('gamma'), values.get('min'),
+                              values.get('max'))
+
+def saveProfile(profile, path=PROFILE_FILE):
+
+    with open(path, "w") as profilefile:
+        json.dump(profile.asDict(), profilefile, indent=2)
+
+def parseCalibrateLine(line):
+
+    # calibrateLoop prints
+    #   Color Channel:\t0 | Gammas:\tr\tg\tb | Mins:\tr\tg\tb | Maxs:\tr\tg\tb
+    values = {}
+    for section in line.split("|"):
+        label, _, numbers = section.partition(":")
+        try:
+            values[label.strip()] = [float(number)
+                                     for number in numbers.split()]
+        except ValueError:
+            return None
+
+    for label in ['Gammas', 'Mins', 'Maxs']:
+        if len(values.get(label, [])) != 3:
+            return None
+
+    return CalibrationProfile(values['Gammas'], values['Mins'],
+                              values['Maxs'])
+
+if __name__ == "__main__":
+
+    # Listen to an arduino in calibration mode and save the last profile it
+    # printed
+    import serial
+
+    if len(sys.argv) < 2:
+        print "usage: %s <serial port> [profile json]" % sys.argv[0]
+        sys.exit(1)
+
+    path = sys.argv[2] if len(sys.argv) > 2 else PROFILE_FILE
+    sconnect = serial.Serial(sys.argv[1], 115200, bytesize=serial.EIGHTBITS,
+                             timeout=1.)
+
+    profile = None
+    try:
+        while True:
+            parsed = parseCalibrateLine(sconnect.readline())
+            if parsed is not None:
+                profile = parsed
+                print "\r%s" % profile,
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sconnect.close()
+
+    print
+    if profile is None:
+        print "No calibration read, is switch 1 flipped to calibration mode?"
+        sys.exit(1)
+
+    saveProfile(profile, path)
+    print "Saved calibration [ %s ] to [ %s ]" % (profile, path)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+import argparse
+
+import audiosource
+import framecodec
+
+# ------------------------------------------------------------------------
+# COMMAND LINE
+
+# The command line shared by sound2color.py and sound2light.py.  The flags
+# pick the parts a run is made of: where the audio comes from, how beats
+# are found, what is drawn, where the colors go and how the frame loop is
+# driven.  Only the modules of the parts picked are imported, and nothing
+# touches the audio, the terminal or the serial ports before the processor
+# starts, so --help and a bad flag come back right away.
+#
+#   ./sound2light.py --headless --flux --effects fire,pulse:add
+#   ./sound2light.py --sink e131:10.0.0.50 --metrics
+#   ./sound2color.py --wave song.wav --blocks
+
+# Key functions:
+
+#   makeParser(lights):
+#     The argparse parser, with the serial and network flags when lights.
+
+#   main(processorclass, lights, argv):
+#     Build, start and run a processor of processorclass from the flags in
+#     argv (sys.argv by default) until interrupted.
+
+def makeParser(lights=False):
+
+    parser = argparse.ArgumentParser(description="Turn the beats of the "
+        "live audio into colors%s" % (" on the lights" if lights else ""))
+
+    parser.add_argument("--headless", action="store_true",
+                        help="no terminal view")
+    parser.add_argument("--leds", type=int,
+                        help="leds per strip (or sink)")
+    parser.add_argument("--fps", type=float, default=30.,
+                        help="frames per second to aim for")
+
+    audio = parser.add_argument_group("audio")
+    audio.add_argument("--wave", metavar="FILE",
+                       help="analyze a wave file instead of the live input")
+    audio.add_argument("--input-device", default='Soundflower (2ch)',
+                       help="audio device of the live input")
+    audio.add_argument("--output-device", default='Built-in Output',
+                       help="audio device --play-audio plays to")
+    audio.add_argument("--play-audio", action="store_true",
+                       help="pipe the live input to the output device")
+
+    processing = parser.add_argument_group("processing")
+    processing.add_argument("--flux", action="store_true",
+                            help="find beats by spectral flux onsets, see "
+                            "onsetdetection.py")
+    processing.add_argument("--effects", metavar="LAYERS",
+                            help="draw effect layers, eg "
+                            "fire,pulse:add,vu:screen:.5, see effects.py")
+    processing.add_argument("--blocks", action="store_true",
+                            help="analyze every audio block as it arrives, "
+                            "see audioblocks.py")
+    processing.add_argument("--pipeline", action="store_true",
+                            help="analyze, render and output in processes "
+                            "of their own, see framepipeline.py")
+
+    parser.add_argument("--metrics", action="store_true",
+                        help="serve the frame timings on "
+                        "http://localhost:PORT/metrics, see metrics.py")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="port of --metrics (default 9101)")
+
+    if lights:
+        output = parser.add_argument_group("lights")
+        output.add_argument("--port", action="append", dest="ports",
+                            metavar="DEVICE", help="serial port of a strip "
+                            "instead of searching the usbserial ports, "
+                            "once per strip")
+        output.add_argument("--sink", action="append", dest="sinks",
+                            metavar="PROTOCOL[:HOST[:UNIVERSE]]",
+                            help="send to a networked pixel controller, eg "
+                            "e131:10.0.0.50 or artnet, see netoutput.py")
+        output.add_argument("--compression", default='auto',
+                            choices=framecodec.COMPRESSION_MODES,
+                            help="frame compression of the serial strips")
+        output.add_argument("--calibration", metavar="FILE", nargs="?",
+                            const=True, help="color correct here instead of "
+                            "on the arduinos, with the calibration profile "
+                            "FILE (default ~/.sound2light_calibration.json), "
+                            "see calibration.py")
+        output.add_argument("--sync", action="store_true",
+                            help="send from the frame loop instead of a "
+                            "serial writer thread per strip")
+
+    return parser
+
+def _makeSource(processorclass, args):
+
+    if args.wave:
+        return audiosource.WaveFileAudioSource(args.wave,
+            numbands=processorclass.NUM_FREQUENCY_BANDS)
+
+    return audiosource.PyoAudioSource(
+        numbands=processorclass.NUM_FREQUENCY_BANDS,
+        inputDeviceName=args.input_device,
+        outputDeviceName=args.output_device)
+
+def _makeProcessor(processorclass, lights, args, source):
+
+    kwargs = {}
+    if args.flux:
+        kwargs['beatengine'] = 'flux'
+
+    if not lights:
+        return processorclass(source, headless=args.headless,
+                              numleds=args.leds, **kwargs)
+
+    if args.sinks:
+        import netoutput
+        kwargs['sinks'] = [netoutput.parseSink(sink, args.leds or
+                                               processorclass.NUM_LEDS)
+                           for sink in args.sinks]
+
+    if args.calibration is True:
+        import calibration
+        kwargs['calibrationProfile'] = calibration.PROFILE_FILE
+    elif args.calibration:
+        kwargs['calibrationProfile'] = args.calibration
+
+    return processorclass(source, sconnect=args.ports,
+                          compression=args.compression,
+                          asyncOutput=not args.sync,
+                          headless=args.headless, numleds=args.leds,
+                          **kwargs)
+
+def main(processorclass, lights=False, argv=None):
+
+    parser = makeParser(lights)
+    args = parser.parse_args(argv)
+
+    if args.pipeline and (args.flux or args.blocks or args.metrics or
+                          args.metrics_port):
+        parser.error("--pipeline finds beats with the energy beat engine "
+                     "on the frame clock and does not time its stages, it "
+                     "does not go with --flux, --blocks or --metrics")
+
+    if args.pipeline:
+
+        # Analysis, rendering and the output each run in their own
+        # process, see framepipeline.py.  The serial ports are found and
+        # shaken hands with before the processes start.
+        import framepipeline
+
+        processor = _makeProcessor(processorclass, lights, args,
+            audiosource.AudioSource(processorclass.NUM_FREQUENCY_BANDS))
+        if lights:
+            processor.connect()
+
+        if args.effects:
+            import effects
+            processor.effects = effects.parseEffects(args.effects)
+
+        pipeline = framepipeline.FramePipeline(processor,
+            lambda: _makeSource(processorclass, args), fps=args.fps,
+            outputAudio=args.play_audio)
+
+        try:
+            pipeline.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print pipeline.stats()
+        return
+
+    import framescheduler
+
+    processor = _makeProcessor(processorclass, lights, args,
+                               _makeSource(processorclass, args))
+
+    # Draw effect layers, eg --effects fire,pulse:add,vu:screen:.5
+    if args.effects:
+        import effects
+        processor.effects = effects.parseEffects(args.effects)
+
+    # Analyze every audio block once as it arrives, on its own thread, and
+    # only render on the frame clock, see audioblocks.py
+    driver = None
+    if args.blocks:
+        import audioblocks
+        driver = audioblocks.AudioBlockDriver(processor)
+        driver.start(outputAudio=args.play_audio)
+    else:
+        processor.start(outputAudio=args.play_audio)
+
+    # Over serial we are bound by the baudrate, at best 30 fps when sending
+    # full frames of 3 bytes * 50 LED colors.  Delta and run length frames
+    # are usually much smaller, since most LEDs are black or unchanged from
+    # the last frame, so the link mostly keeps up with --fps.  The scheduler
+    # never goes faster than --fps, it only slows down (to 10 fps at the
+    # least) while the serial writers or the frame work cannot keep up.
+    scheduler = framescheduler.FrameScheduler(fps=args.fps)
+    server = None
+
+    # Serve the frame timings on http://localhost:9101/metrics by default
+    if args.metrics:
+        import metrics
+        frameMetrics = metrics.Metrics()
+        processor.setMetrics(frameMetrics)
+        scheduler.setMetrics(frameMetrics)
+        server = metrics.serveHTTP(frameMetrics, args.metrics_port or
+                                   metrics.HTTP_PORT)
+
+    try:
+        if driver:
+            driver.run(scheduler)
+        else:
+            scheduler.run(processor,
+                          shouldStop=processor.audiosource.isFinished)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        processor.shutdown()
+        if server:
+            server.shutdown()
+        print scheduler.report()
+        if driver:
+            print driver.report()
@@ -0,0 +1,358 @@
+#!/usr/bin/python
+
+import numpy
+
+import sound2color
+
+# ------------------------------------------------------------------------
+# EFFECT LAYERS
+
+# The travelling beat pulse that SoundToColorProcessor draws by default is
+# one effect.  An EffectStack draws several of them over each other: every
+# layer renders the whole strip into its own [numleds, 3] slice of one
+# preallocated [numlayers, numleds, 3] array, with a handful of array
+# operations and no loop over leds, and the stack then blends the layers
+# into the colorarray.
+#
+# Each layer has a blend mode and an opacity between 0 and 1:
+#
+#   normal     the layer covers what is under it
+#   add        the layer's colors are added to what is under it
+#   screen     like add, but brightens less as the colors near white
+#   multiply   what is under the layer is darkened by the layer's colors
+#   max        the brightest of the layer and what is under it
+#
+# The layers are listed from the bottom up.  Consecutive layers with the
+# same blend mode are blended in one reduction over the layer axis of the
+# array (a weighted sum for normal and add, a product for screen and
+# multiply, a maximum for max) rather than one layer after the other, so a
+# show of a few blend modes costs a few array passes however many layers
+# it has.
+#
+# Like the beat pulse, layers move by a fixed step every frame rather than
+# by the clock, so shows look the same rendered offline as they do live.
+# Layers that follow the music read the band amplitudes and beats of the
+# processor's last update (processor.bands and processor.beatamps).
+#
+# Turn it on with --effects and a comma separated list of layers, each as
+# name[:blend[:opacity]], for example:
+#
+#   ./sound2light.py --effects fire,pulse:add,vu:screen:.5
+
+# Key functions:
+
+#   EffectLayer.render(processor, out):
+#     Draw the layer for the processor's current frame into out, a
+#     [numleds, 3] float array of 0-255 colors.  Subclass it to add effects.
+
+#   EffectStack(layers):
+#     The layers, from the bottom up.  Hand it to a processor by setting
+#     processor.effects.
+
+#   EffectStack.render(processor, out):
+#     Render every layer and blend them into out.
+
+#   parseEffects(text, seed):
+#     The EffectStack described by a --effects list.  With a seed the layers
+#     that draw at random (fire) draw the same every time.
+
+BLEND_MODES = ['normal', 'add', 'screen', 'multiply', 'max']
+
+class EffectLayer(object):
+
+    def __init__(self, blend='normal', opacity=1.):
+
+        if blend not in BLEND_MODES:
+            raise Exception("Unknown blend mode [ %s ], use one of %s" %
+                            (blend, BLEND_MODES))
+
+        self.blend = blend
+        self.opacity = float(opacity)
+
+    def __str__(self):
+        return "%s:%s:%g" % (self.name, self.blend, self.opacity)
+
+    def render(self, processor, out):
+        raise NotImplementedError
+
+# ------------------------------------------------------------------------
+# LEVEL UTILITIES
+
+# Leds are numbered out from the center of the strip, mirrored like the
+# beat pulse: returns the distance of every led from the center and how
+# many distances there are.
+def mirroredcells(numleds):
+
+    center = numleds // 2
+    leds = numpy.arange(numleds)
+    cells = numpy.where(leds >= center, leds - center, center - 1 - leds)
+    return cells, max(center, numleds - center)
+
+# Follows the amplitude of every band, rising fast and falling slowly, and
+# scales it by the loudest it has been lately so that quiet and loud music
+# both fill the 0 to 1 range.
+class LevelFollower(object):
+
+    ATTACK = .6
+    RELEASE = .15
+    PEAK_DECAY = .995
+    PEAK_FLOOR = 1e-4
+
+    def __init__(self, numbands):
+
+        self.levels = numpy.zeros(numbands)
+        self.peaks = numpy.zeros(numbands)
+
+    def update(self, bands):
+
+        amps = numpy.abs(bands).mean(axis=0)
+
+        rates = numpy.where(amps > self.levels, self.ATTACK, self.RELEASE)
+        self.levels += rates * (amps - self.levels)
+        self.peaks = numpy.maximum(self.levels, self.peaks * self.PEAK_DECAY)
+
+        return self.levels / numpy.maximum(self.peaks, self.PEAK_FLOOR)
+
+# ------------------------------------------------------------------------
+# LAYERS
+
+# The beat pulse SoundToColorProcessor draws on its own: beats travel out
+# from the center, colored by pitch.  This layer moves the beats along, so
+# without it beats are found but never shown, and with 2 of them the beats
+# move twice as fast.
+
+class PulseLayer(EffectLayer):
+
+    name = 'pulse'
+
+    def render(self, processor, out):
+
+        kernelweight = 3. * (1. / float(processor.NUM_FREQUENCY_BANDS))
+        sound2color.renderbeatwave(processor.beatwave, processor.beatcolors,
+                                   out, processor.perpitcharray, kernelweight,
+                                   processor.beatpool.order(),
+                                   processor.beatwavebuffers)
+
+# Flames rising out from the center of the strip.  Every frame each cell
+# cools a little at random and hands its heat outwards, and sparks light up
+# at the center as often and as hot as the bass is loud, with a burst on
+# every bass beat.  Heat is colored with the fire ramp.
+
+class FireLayer(EffectLayer):
+
+    name = 'fire'
+
+    COOLING = .06
+    SPARKING = .1
+    SPARK_CELLS = 3
+
+    def __init__(self, blend='normal', opacity=1., seed=None):
+
+        EffectLayer.__init__(self, blend, opacity)
+
+        self.random = numpy.random.RandomState(seed)
+        self.ramp = sound2color.colorramptable('fireramp')
+        self.heat = None
+
+    def _resize(self, processor, numleds):
+
+        self.cells, numcells = mirroredcells(numleds)
+        self.heat = numpy.zeros(numcells)
+        self.risen = numpy.zeros(numcells)
+        self.levels = LevelFollower(processor.NUM_FREQUENCY_BANDS)
+
+        # the bass is the lowest quarter of the bands
+        self.bassbands = max(1, processor.NUM_FREQUENCY_BANDS // 4)
+
+    def render(self, processor, out):
+
+        if self.heat is None or self.cells.shape[0] != out.shape[0]:
+            self._resize(processor, out.shape[0])
+
+        heat = self.heat
+        bass = self.levels.update(processor.bands)[:self.bassbands].mean()
+        beat = processor.beatamps[:self.bassbands].max()
+
+        # cool down, then every cell takes on the heat of the 2 cells closer
+        # to the center
+        heat -= self.random.random_sample(heat.shape[0]) * self.COOLING
+        numpy.maximum(heat, 0., out=heat)
+
+        self.risen[2:] = (heat[1:-1] + 2. * heat[:-2]) / 3.
+        self.risen[:2] = heat[:2]
+        heat[...] = self.risen
+
+        # new sparks near the center
+        sparks = min(self.SPARK_CELLS, heat.shape[0])
+        chance = self.SPARKING + bass + (1. if beat > 0. else 0.)
+        lit = self.random.random_sample(sparks) < chance
+        heat[:sparks][lit] = numpy.minimum(
+            1., heat[:sparks][lit] + .4 + .6 * self.random.random_sample(
+                numpy.count_nonzero(lit)) * max(bass, .5))
+
+        # cold cells are black
+        colors = self.ramp.lookup(heat)
+        colors *= sound2color.smoothstep(heat, 0., .3)[:, numpy.newaxis]
+        out[...] = colors[self.cells]
+
+# A rainbow scrolling out from the center, faster on beats, as bright as
+# the music is loud.
+
+class RainbowLayer(EffectLayer):
+
+    name = 'rainbow'
+
+    # hue steps per frame, the extra step on a beat of strength 1, and how
+    # many times the hues go round over half of the strip
+    SPEED = .005
+    BEAT_SPEED = .03
+    SPREAD = 1.
+    MIN_BRIGHTNESS = .2
+
+    # offsets of red, green and blue around the hue circle
+    HUE_OFFSETS = numpy.array([0., 4., 2.])
+
+    def __init__(self, blend='normal', opacity=1.):
+
+        EffectLayer.__init__(self, blend, opacity)
+
+        self.phase = 0.
+        self.cells = None
+
+    def render(self, processor, out):
+
+        if self.cells is None or self.cells.shape[0] != out.shape[0]:
+            cells, numcells = mirroredcells(out.shape[0])
+            self.cells = cells * (self.SPREAD / numcells)
+            self.levels = LevelFollower(processor.NUM_FREQUENCY_BANDS)
+
+        loudness = self.levels.update(processor.bands).mean()
+        self.phase = (self.phase + self.SPEED +
+                      self.BEAT_SPEED * processor.beatamps.max()) % 1.
+
+        # hue to rgb for every led at once
+        hues = (self.phase - self.cells) % 1.
+        out[...] = numpy.clip(numpy.abs(
+            (6. * hues[:, numpy.newaxis] + self.HUE_OFFSETS) % 6. - 3.) - 1.,
+            0., 1.)
+        out *= 255. * max(loudness, self.MIN_BRIGHTNESS)
+
+# A vu meter of every band: the strip is split into a segment per band,
+# from the bass at the center to the highs at both ends, each colored like
+# the band's beats and as bright as the band is loud.
+
+class VULayer(EffectLayer):
+
+    name = 'vu'
+
+    def __init__(self, blend='normal', opacity=1.):
+
+        EffectLayer.__init__(self, blend, opacity)
+        self.ledbands = None
+
+    def render(self, processor, out):
+
+        numbands = processor.NUM_FREQUENCY_BANDS
+        if self.ledbands is None or self.ledbands.shape[0] != out.shape[0]:
+            cells, numcells = mirroredcells(out.shape[0])
+            self.ledbands = cells * numbands // numcells
+            self.levels = LevelFollower(numbands)
+
+        levels = self.levels.update(processor.bands)
+        out[...] = processor.beatcolors[self.ledbands]
+        out *= levels[self.ledbands, numpy.newaxis]
+
+LAYERS = dict((layer.name, layer)
+              for layer in [PulseLayer, FireLayer, RainbowLayer, VULayer])
+
+# ------------------------------------------------------------------------
+# COMPOSITING
+
+class EffectStack(object):
+
+    def __init__(self, layers):
+
+        self.layers = list(layers)
+        self.buffer = numpy.zeros([len(self.layers), 0, 3])
+
+        # runs of consecutive layers with the same blend mode, as
+        # (blend, first, last + 1)
+        self.runs = []
+        for idx, layer in enumerate(self.layers):
+            if self.runs and self.runs[-1][0] == layer.blend:
+                self.runs[-1][2] = idx + 1
+            else:
+                self.runs.append([layer.blend, idx, idx + 1])
+
+    def __str__(self):
+        return ",".join(str(layer) for layer in self.layers)
+
+    def render(self, processor, out):
+
+        if self.buffer.shape[1] != out.shape[0]:
+            self.buffer = numpy.zeros([len(self.layers), out.shape[0], 3],
+                                      dtype=out.dtype)
+
+        for layer, layerout in zip(self.layers, self.buffer):
+            layer.render(processor, layerout)
+
+        self.composite(self.buffer, out)
+
+    def composite(self, layercolors, out):
+
+        opacities = numpy.array([layer.opacity for layer in self.layers])
+        out.fill(0.)
+
+        for blend, first, last in self.runs:
+
+            colors = layercolors[first:last]
+            alphas = opacities[first:last]
+
+            if blend == 'normal':
+                # every layer shows as much as the layers over it let
+                # through, and what is under the run as much as all of them
+                through = numpy.cumprod((1. - alphas)[::-1])[::-1]
+                weights = alphas * numpy.append(through[1:], 1.)
+                out *= through[0]
+                out += numpy.tensordot(weights, colors, axes=1)
+
+            elif blend == 'add':
+                out += numpy.tensordot(alphas, colors, axes=1)
+
+            elif blend == 'max':
+                numpy.maximum(out, numpy.max(
+                    colors * alphas[:, numpy.newaxis, numpy.newaxis], axis=0),
+                    out=out)
+
+            elif blend == 'multiply':
+                out *= numpy.prod(1. - alphas[:, numpy.newaxis, numpy.newaxis]
+                                  * (1. - colors / 255.), axis=0)
+
+            elif blend == 'screen':
+                # 1 - (1 - under) * (1 - layer), for every layer
+                out -= 255.
+                out *= numpy.prod(1. - alphas[:, numpy.newaxis, numpy.newaxis]
+                                  * colors / 255., axis=0)
+                out += 255.
+
+        numpy.clip(out, 0., 255., out=out)
+
+def parseEffects(text, seed=None):
+
+    layers = []
+    for spec in text.split(","):
+
+        fields = spec.strip().split(":")
+        if fields[0] not in LAYERS:
+            raise Exception("Unknown effect [ %s ], use any of %s" %
+                            (fields[0], sorted(LAYERS)))
+
+        blend = fields[1] if len(fields) > 1 else 'normal'
+        opacity = float(fields[2]) if len(fields) > 2 else 1.
+        layers.append(LAYERS[fields[0]](blend, opacity))
+
+        # every random layer gets a seed of its own
+        if seed is not None and hasattr(layers[-1], 'random'):
+            layers[-1].random.seed(seed + len(layers) - 1)
+
+    return EffectStack(layers)
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+import numpy
+
+# ------------------------------------------------------------------------
+# COLOR FRAMES
+
+# Color frames sent to the PySerialTCLConnect firmware look like:
+#
+#   '*' <frame type> <payload>
+#
+# The '*' byte (42) marks the start of a frame.  A byte after it that
+# happens to be '*' or the escape byte '}' (125) is sent as the escape byte
+# followed by the byte XORed with 0x20.  So '*' never shows up inside a
+# frame and the firmware can always find the start of the next one, while
+# every byte still arrives exactly as it was sent.
+#
+# There are 3 frame types.  Numbers wider than a byte are little endian.
+#
+#   'F' full frame  : 3 * NUM_LEDS color bytes
+#
+#   'D' delta frame : <number of spans: 2 bytes> and then for every span
+#                     <first led: 2 bytes> <number of leds: 2 bytes>
+#                     <3 color bytes per led>
+#                     Only the leds in the spans change.
+#
+#   'R' run length  : <number of runs: 2 bytes> and then for every run
+#                     <number of leds: 1 byte> <red> <green> <blue>
+#                     The runs cover all the leds from the first one on.
+
+FRAME_START = 42
+FRAME_ESCAPE = 125
+FRAME_ESCAPE_XOR = 0x20
+
+FRAME_FULL = ord('F')
+FRAME_DELTA = ord('D')
+FRAME_RUNLENGTH = ord('R')
+
+# Compression modes of the encoder.  'delta' and 'runlength' fall back to a
+# full frame when that is smaller, 'auto' picks the smallest of all three.
+COMPRESSION_MODES = ['full', 'delta', 'runlength', 'auto']
+
+# How often a full frame is sent no matter what, so the firmware resyncs
+# after a corrupted or lost frame.
+KEYFRAME_INTERVAL = 30
+
+def _spanRanges(starts, counts):
+
+    # For spans of counts items beginning at starts, returns the index of
+    # every item and its position within its span.
+    total = numpy.sum(counts)
+    within = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts,
+                                                counts)
+    return numpy.repeat(starts, counts) + within, within
+
+# Turns a float colorarray into the bytes of an escaped color frame.  All
+# of the work is done with array operations on buffers that are allocated
+# once, and the encoded frame is returned as a memoryview of the encoder's
+# own bytearray, ready to be written to the serial port.  The view is only
+# valid until the next call to encode.  Full frames are quantized, escaped
+# and written without allocating anything the size of a frame, delta and
+# run length frames need a few arrays the size of their spans and runs.
+#
+# The encoder remembers the last frame it encoded, which is what delta and
+# run length frames are built against, so every encoded frame has to be
+# sent.  Call forceKeyframe() to make the next frame a full one.
+#
+# With a calibration (a calibration.CalibrationProfile) the quantized colors
+# are looked up in its tables before they are compressed, so the frames
+# carry the bytes the leds should show, for the firmware's raw color mode.
+
+class ColorFrameEncoder(object):
+
+    def __init__(self, numleds, compression='full',
+                 keyframeInterval=KEYFRAME_INTERVAL, calibration=None):
+
+        if compression not in COMPRESSION_MODES:
+            raise Exception("Unknown compression [ %s ], use one of %s" %
+                            (compression, COMPRESSION_MODES))
+
+        self.numleds = numleds
+        self.numbytes = 3 * numleds
+        self.compression = compression
+        self.keyframeInterval = keyframeInterval
+        self.calibration = calibration
+
+        # quantized color bytes of this frame and the frame sent before it
+        self.colorbytes = numpy.zeros(self.numbytes, dtype=numpy.uint8)
+        self.previous = numpy.zeros([numleds, 3], dtype=numpy.uint8)
+        self.framesSinceKeyframe = None
+
+        # No compressed frame is ever sent when it is bigger than a full
+        # frame, so that is the largest payload.  In the worst case every
+        # payload byte needs escaping.
+        self.payload = numpy.zeros(1 + self.numbytes, dtype=numpy.uint8)
+        self.buffer = bytearray(1 + 2 * self.payload.shape[0])
+        self.framebytes = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        self.framebytes[0] = FRAME_START
+
+        self.offsets = numpy.arange(1, self.payload.shape[0] + 1)
+        self.work = numpy.zeros(self.numbytes, dtype=numpy.float32)
+
+        # work buffers of stuff(): which payload bytes need escaping, where
+        # every byte goes and the bytes with the escaped ones XORed
+        self.special = numpy.zeros(self.payload.shape[0], dtype=bool)
+        self.escapes = numpy.zeros(self.payload.shape[0], dtype=bool)
+        self.positions = numpy.zeros(self.payload.shape[0], dtype=numpy.intp)
+        self.stuffed = numpy.zeros(self.payload.shape[0], dtype=numpy.uint8)
+
+        # the type of the last frame encoded
+        self.frameType = None
+
+    def forceKeyframe(self):
+        self.framesSinceKeyframe = None
+
+    def quantize(self, colorarray):
+
+        # Floor and clamp every color into a byte, then calibrate it
+        numpy.floor(colorarray.ravel(), out=self.work)
+        numpy.clip(self.work, 0, 255, out=self.work)
+        numpy.copyto(self.colorbytes, self.work, casting='unsafe')
+
+        if self.calibration is not None:
+            self.calibration.apply(self.colorbytes)
+
+        return self.colorbytes
+
+    def stuff(self, payload):
+
+        # Write the escaped frame for payload into the frame buffer and
+        # return a view of it
+        numbytes = payload.shape[0]
+
+        special = numpy.equal(payload, FRAME_START,
+                              out=self.special[:numbytes])
+        special |= numpy.equal(payload, FRAME_ESCAPE,
+                               out=self.escapes[:numbytes])
+        if not special.any():
+            self.framebytes[1:numbytes + 1] = payload
+            return memoryview(self.buffer)[:numbytes + 1]
+
+        # Every escape pushes the bytes after it one position further
+        positions = numpy.cumsum(special, out=self.positions[:numbytes])
+        numescapes = positions[-1]
+        positions += self.offsets[:numbytes]
+
+        stuffed = numpy.multiply(special, FRAME_ESCAPE_XOR,
+                                 out=self.stuffed[:numbytes], casting='unsafe')
+        stuffed ^= payload
+
+        # The escape byte goes right before every byte, and every byte that
+        # is not escaped then overwrites the escape before it with itself
+        # (the one before the first byte is the frame start)
+        positions -= 1
+        self.framebytes[positions] = FRAME_ESCAPE
+        positions += 1
+        self.framebytes[positions] = stuffed
+        self.framebytes[0] = FRAME_START
+        return memoryview(self.buffer)[:numbytes + 1 + numescapes]
+
+    def _fullPayload(self, colors):
+
+        self.payload[0] = FRAME_FULL
+        self.payload[1:] = colors.ravel()
+        return self.payload
+
+    def _deltaSpans(self, colors):
+
+        # Spans of leds that changed since the previous frame.  Spans only
+        # 1 led apart are merged, since a span header costs more than
+        # resending 1 led.
+        changed = numpy.zeros(self.numleds + 2, dtype=bool)
+        changed[1:-1] = numpy.any(colors != self.previous, axis=1)
+
+        edges = numpy.flatnonzero(changed[1:] != changed[:-1])
+        starts, ends = edges[::2], edges[1::2]
+        if starts.shape[0] == 0:
+            return starts, ends
+
+        merge = (starts[1:] - ends[:-1]) <= 1
+        starts = starts[numpy.concatenate(([True], ~merge))]
+        ends = ends[numpy.concatenate((~merge, [True]))]
+        return starts, ends - starts
+
+    def _deltaPayload(self, colors, starts, counts):
+
+        size = 3 + 4 * starts.shape[0] + 3 * numpy.sum(counts)
+        payload = self.payload[:size]
+
+        payload[0] = FRAME_DELTA
+        payload[1] = starts.shape[0] & 0xff
+        payload[2] = starts.shape[0] >> 8
+
+        # where each span header goes in the payload
+        headers = 3 + numpy.cumsum(4 + 3 * counts) - (4 + 3 * counts)
+        payload[headers] = starts & 0xff
+        payload[headers + 1] = starts >> 8
+        payload[headers + 2] = counts & 0xff
+        payload[headers + 3] = counts >> 8
+
+        leds, within = _spanRanges(starts, counts)
+        dest = numpy.repeat(headers + 4, counts) + 3 * within
+        payload[dest[:, numpy.newaxis] + numpy.arange(3)] = colors[leds]
+        return payload
+
+    def _runs(self, colors):
+
+        # Runs of leds with the same color, split so no run is over 255 leds
+        newrun = numpy.ones(self.numleds, dtype=bool)
+        newrun[1:] = numpy.any(colors[1:] != colors[:-1], axis=1)
+
+        starts = numpy.flatnonzero(newrun)
+        lengths = numpy.diff(numpy.append(starts, self.numleds))
+
+        pieces = (lengths + 254) // 255
+        _, within = _spanRanges(starts, pieces)
+        runstarts = numpy.repeat(starts, pieces) + 255 * within
+        runlengths = numpy.minimum(255, numpy.repeat(starts + lengths, pieces) -
+                                   runstarts)
+        return runstarts, runlengths
+
+    def _runLengthPayload(self, colors, runstarts, runlengths):
+
+        numruns = runstarts.shape[0]
+        payload = self.payload[:3 + 4 * numruns]
+
+        payload[0] = FRAME_RUNLENGTH
+        payload[1] = numruns & 0xff
+        payload[2] = numruns >> 8
+
+        runs = payload[3:].reshape(numruns, 4)
+        runs[:, 0] = runlengths
+        runs[:, 1:] = colors[runstarts]
+        return payload
+
+    def compress(self, colorbytes):
+
+        # Build the smallest payload the compression mode allows for
+        # colorbytes and remember them as the previous frame
+        colors = colorbytes.reshape(self.numleds, 3)
+
+        fullsize = 1 + self.numbytes
+        keyframe = (self.framesSinceKeyframe is None or
+                    self.framesSinceKeyframe + 1 >= self.keyframeInterval)
+
+        choice, size = 'full', fullsize
+        if not keyframe and self.compression in ('delta', 'auto'):
+            starts, counts = self._deltaSpans(colors)
+            deltasize = 3 + 4 * starts.shape[0] + 3 * numpy.sum(counts)
+            if deltasize < size:
+                choice, size = 'delta', deltasize
+
+        if not keyframe and self.compression in ('runlength', 'auto'):
+            runstarts, runlengths = self._runs(colors)
+            runsize = 3 + 4 * runstarts.shape[0]
+            if runsize < size:
+                choice, size = 'runlength', runsize
+
+        if choice == 'delta':
+            payload = self._deltaPayload(colors, starts, counts)
+        elif choice == 'runlength':
+            payload = self._runLengthPayload(colors, runstarts, runlengths)
+        else:
+            payload = self._fullPayload(colors)
+
+        if choice == 'full':
+            self.framesSinceKeyframe = 0
+        else:
+            self.framesSinceKeyframe += 1
+
+        self.frameType = payload[0]
+        self.previous[...] = colors
+        return payload
+
+    def encode(self, colorarray):
+        return self.stuff(self.compress(self.quantize(colorarray)))
+
+# Decodes the bytes of escaped color frames back into color bytes, the same
+# way the firmware does.  Bytes can be fed in any sized pieces.  colorbytes
+# holds the current color of every led, and every frame that completes is
+# returned as a copy of it.
+
+class ColorFrameDecoder(object):
+
+    def __init__(self, numleds):
+
+        self.numbytes = 3 * numleds
+        self.colorbytes = bytearray(self.numbytes)
+        self.inFrame = False
+        self.escaped = False
+
+    def _startFrame(self):
+
+        self.inFrame = True
+        self.escaped = False
+        self.frameType = None
+        self.header = bytearray()
+        self.numSections = None
+        self.writePos = 0
+        self.writeEnd = 0
+
+    def _decodeByte(self, inByte):
+
+        # Handle one unescaped byte of a frame, returns True when the byte
+        # completes the frame
+        if self.frameType is None:
+            self.frameType = inByte
+            if inByte == FRAME_FULL:
+                self.writeEnd = self.numbytes
+            elif inByte not in (FRAME_DELTA, FRAME_RUNLENGTH):
+                self.inFrame = False
+            return False
+
+        if self.writePos < self.writeEnd:
+            self.colorbytes[self.writePos] = inByte
+            self.writePos += 1
+            if self.writePos < self.writeEnd:
+                return False
+            if self.frameType == FRAME_FULL:
+                return True
+            self.numSections -= 1
+            return self.numSections == 0
+
+        self.header.append(inByte)
+
+        if self.numSections is None:
+            if len(self.header) == 2:
+                self.numSections = self.header[0] | self.header[1] << 8
+                self.header = bytearray()
+                return self.numSections == 0
+            return False
+
+        if len(self.header) < 4:
+            return False
+
+        if self.frameType == FRAME_DELTA:
+            start = self.header[0] | self.header[1] << 8
+            count = self.header[2] | self.header[3] << 8
+            self.writePos, self.writeEnd = 3 * start, 3 * (start + count)
+            if count == 0 or self.writeEnd > self.numbytes:
+                self.inFrame = False
+        else:
+            length = self.header[0]
+            end = self.writePos + 3 * length
+            if end > self.numbytes:
+                self.inFrame = False
+                return False
+            self.colorbytes[self.writePos:end] = self.header[1:4] * length
+            self.writePos = self.writeEnd = end
+            self.numSections -= 1
+
+        self.header = bytearray()
+        return self.inFrame and self.numSections == 0
+
+    def decode(self, data):
+
+        frames = []
+        for inByte in bytearray(data):
+
+            if inByte == FRAME_START:
+                self._startFrame()
+                continue
+
+            if not self.inFrame:
+                continue
+
+            if inByte == FRAME_ESCAPE:
+                self.escaped = True
+                continue
+
+            if self.escaped:
+                inByte ^= FRAME_ESCAPE_XOR
+                self.escaped = False
+
+            if self._decodeByte(inByte):
+                frames.append(bytearray(self.colorbytes))
+                self.inFrame = False
+
+        return frames
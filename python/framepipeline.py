@@ -0,0 +1,246 @@
+#!/usr/bin/python
+
+import time
+import multiprocessing
+import numpy
+
+import audiosource
+import framescheduler
+import sharedframes
+import sound2color
+
+# ------------------------------------------------------------------------
+# FRAME PIPELINE
+
+# Runs the frame loop as 3 processes instead of one, so every stage gets its
+# own core and a slow stage only holds up itself:
+#
+#   analysis : reads the band amplitudes from the audio source fps times a
+#              second and writes them into a ring of band frames.
+#   render   : reads every band frame in order, runs the beat detection and
+#              rendering of a headless processor on it and writes the
+#              colorarray and perpitcharray into a ring of color frames.
+#   output   : takes the newest color frame and hands it to the output
+#              processor's output() (terminal view, serial strips, ...).
+#
+# The stages only share memory through sharedframes.SharedFrameRing, so
+# nothing is pickled per frame.  If rendering falls behind the analysis by
+# more than the ring holds, the oldest band frames are skipped; the output
+# stage always shows the newest color frame and skips the ones it missed.
+#
+# The output processor is built (but not started) by the caller, so it can
+# find its serial ports and shake hands before the processes fork.  Hand it
+# an audio source that does nothing, such as audiosource.AudioSource(), since
+# it never analyzes any audio itself.  makeSource is called in the analysis
+# process to build the real audio source, so e.g. the pyo server is only
+# ever booted there.
+
+# Key functions:
+
+#   run( ):
+#     Start the 3 processes and wait until the audio runs out or we are
+#     interrupted, then stop them.
+
+#   start( ) / wait( ) / stop( ):
+#     The same in steps.
+
+#   stats( ):
+#     Frames analyzed, rendered and output, and band frames the render
+#     stage skipped.
+
+# A source that reads band frames written by the analysis stage.  Every read
+# returns the next band frame, waiting for it if needed.  Once the analysis
+# stage is done and every frame was read, it is finished and reads return
+# silence.
+
+class SharedBandSource(audiosource.AudioSource):
+
+    def __init__(self, ring, numbands=16):
+
+        audiosource.AudioSource.__init__(self, numbands)
+
+        self.ring = ring
+        self.bands = numpy.zeros([2, numbands])
+        self.seq = 0
+        self.skipped = 0
+        self.finished = False
+
+    def read(self):
+
+        while not self.finished:
+
+            closed = self.ring.isClosed()
+
+            seq = self.ring.readNext(self.seq, self.bands)
+            if seq:
+                self.skipped += seq - self.seq - 1
+                self.seq = seq
+                break
+
+            if closed:
+                self.finished = True
+                self.bands[...] = 0.
+                break
+
+            time.sleep(sharedframes.POLL_SECONDS)
+
+        return self.bands[0], self.bands[1]
+
+    def isFinished(self):
+        return self.finished
+
+class FramePipeline(object):
+
+    def __init__(self, output, makeSource, fps=30., numslots=8,
+                 renderclass=sound2color.SoundToColorProcessor,
+                 outputAudio=False):
+
+        self.output = output
+        self.makeSource = makeSource
+        self.fps = fps
+        self.outputAudio = outputAudio
+
+        numbands = output.NUM_FREQUENCY_BANDS
+        numleds = output.colorarray.shape[0]
+
+        # band frames hold the left and right band amplitudes, color frames
+        # the colorarray, perpitcharray and the index of the color ramp
+        self.bandring = sharedframes.SharedFrameRing([[2, numbands]],
+                                                     numslots)
+        self.colorring = sharedframes.SharedFrameRing(
+            [[numleds, 3], [numbands, numleds], [1]], numslots)
+
+        self.renderer = renderclass(SharedBandSource(self.bandring, numbands),
+                                    headless=True, numleds=numleds)
+        self.renderer.effects = output.effects
+
+        self.stopEvent = multiprocessing.Event()
+        self.framesOutput = multiprocessing.RawValue('l', 0)
+        self.bandsSkipped = multiprocessing.RawValue('l', 0)
+        self.processes = []
+
+    def _runAnalysis(self):
+
+        source = self.makeSource()
+        scheduler = framescheduler.FrameScheduler(self.fps, adaptive=False)
+        bands = numpy.zeros([2, self.output.NUM_FREQUENCY_BANDS])
+
+        try:
+            source.start(self.outputAudio)
+
+            while not self.stopEvent.is_set() and not source.isFinished():
+                scheduler.waitForFrame()
+                bands[0], bands[1] = source.read()
+                self.bandring.write(bands)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.bandring.close()
+            source.shutdown()
+
+    def _runRender(self):
+
+        renderer = self.renderer
+        rampindex = numpy.zeros(1)
+
+        try:
+            renderer.start()
+
+            while not self.stopEvent.is_set():
+                renderer.update()
+                if renderer.audiosource.isFinished():
+                    break
+
+                rampindex[0] = renderer.colorramps.index(
+                    renderer.colorramp.name)
+                self.colorring.write(renderer.colorarray,
+                                     renderer.perpitcharray, rampindex)
+                self.bandsSkipped.value = renderer.audiosource.skipped
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.colorring.close()
+            renderer.shutdown()
+
+    def _runOutput(self):
+
+        output = self.output
+        rampindex = numpy.zeros(1)
+        seq = 0
+
+        try:
+            output.start()
+
+            while not self.stopEvent.is_set():
+
+                closed = self.colorring.isClosed()
+
+                newseq = self.colorring.readLatest(seq, output.colorarray,
+                                                   output.perpitcharray,
+                                                   rampindex)
+                if newseq:
+                    seq = newseq
+                    output.colorramp = sound2color.colorramptable(
+                        output.colorramps[int(rampindex[0])])
+                    output.output()
+                    self.framesOutput.value += 1
+
+                elif closed:
+                    break
+
+                else:
+                    time.sleep(sharedframes.POLL_SECONDS)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            output.shutdown()
+
+    def start(self):
+
+        self.processes = [
+            multiprocessing.Process(target=self._runAnalysis,
+                                    name="analysis"),
+            multiprocessing.Process(target=self._runRender, name="render"),
+            multiprocessing.Process(target=self._runOutput, name="output"),
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def wait(self):
+
+        # Join with a timeout so a KeyboardInterrupt still gets through
+        while any(process.is_alive() for process in self.processes):
+            for process in self.processes:
+                process.join(.1)
+
+    def stop(self, timeout=2.):
+
+        self.stopEvent.set()
+
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def run(self):
+
+        self.start()
+        try:
+            self.wait()
+        finally:
+            self.stop()
+
+    def stats(self):
+        return {
+            'analyzed': self.bandring.head(),
+            'rendered': self.colorring.head(),
+            'output': self.framesOutput.value,
+            'skipped': self.bandsSkipped.value,
+        }
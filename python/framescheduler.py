@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+import time
+import numpy
+
+# ------------------------------------------------------------------------
+# FRAME SCHEDULER
+
+# Paces the update()/output() loop of a processor against absolute frame
+# deadlines instead of sleeping a fixed time after every frame, so the time
+# the work takes does not stretch the frame period.
+#
+# When the loop falls behind by one or more whole frames, those deadlines
+# are skipped instead of run back to back, and output() is skipped for the
+# late frame so update() catches up with the audio first.
+#
+# With adaptive on, the target frame rate drops below fps when the work or
+# the output link (see SoundToColorProcessor.outputPeriod) cannot keep up
+# with it, keeping a little headroom, but never below minfps.  It climbs
+# back up to fps once they can.
+
+# Key functions:
+
+#   run(processor, numframes=None, shouldStop=None, update=None):
+#     Run update() and output() on the processor at the scheduled rate.  Give
+#     update to call it instead of processor.update, eg processor.render when
+#     the audio is analyzed on another thread.
+
+#   waitForFrame( ) / frameDone(worktime, linkperiod):
+#     The same pacing for a hand written loop.  waitForFrame() returns the
+#     number of frame deadlines that were missed.
+
+#   setMetrics(metrics):
+#     Export the frame lateness, missed deadlines, skipped outputs, output
+#     time and the measured work and link times to a metrics.Metrics.
+
+#   stats( ) / report( ):
+#     Achieved and target frame rate, skipped frames and the jitter (how
+#     late frames start against their deadline) as a dict or one line.
+
+class FrameScheduler(object):
+
+    # how much slower than the measured frame cost to aim for
+    HEADROOM = 1.2
+
+    # how quickly the measured costs follow new measurements
+    SMOOTHING = .05
+
+    # number of recent frames the jitter statistics are taken over
+    NUM_STATS_FRAMES = 300
+
+    def __init__(self, fps=30., minfps=10., adaptive=True):
+
+        self.period = 1. / fps
+        self.minperiod = 1. / fps
+        self.maxperiod = 1. / minfps
+        self.adaptive = adaptive
+
+        self.nextDeadline = None
+        self.workTime = 0.
+        self.linkPeriod = 0.
+
+        self.framesRun = 0
+        self.framesSkipped = 0
+        self.outputsSkipped = 0
+        self.firstFrameAt = None
+        self.lastFrameAt = None
+
+        # lateness of the last NUM_STATS_FRAMES frames
+        self.lateness = numpy.zeros(FrameScheduler.NUM_STATS_FRAMES)
+
+        self.metrics = None
+
+    def setMetrics(self, metrics):
+
+        self.metrics = metrics
+        self.latenessTimes = metrics.histogram("frame_lateness_seconds",
+                                               "How late frames start against "
+                                               "their deadline")
+        self.lateCounter = metrics.counter("frames_late_total", "Frame "
+                                           "deadlines missed and skipped")
+        self.outputsSkippedCounter = metrics.counter(
+            "outputs_skipped_total", "Frames not output to catch up")
+        self.outputTimes = metrics.histogram("stage_seconds", "Seconds each "
+                                             "stage of a frame takes",
+                                             {'stage': 'output'})
+        self.workGauge = metrics.gauge("work_seconds", "Average seconds of "
+                                       "work per frame")
+        self.linkGauge = metrics.gauge("link_seconds", "Seconds the slowest "
+                                       "output link needs per frame")
+        self.targetGauge = metrics.gauge("target_fps", "Frame rate the "
+                                         "scheduler aims for")
+
+    def waitForFrame(self):
+
+        now = time.time()
+        if self.nextDeadline is None:
+            self.nextDeadline = now
+            self.firstFrameAt = now
+
+        if self.nextDeadline > now:
+            time.sleep(self.nextDeadline - now)
+
+        start = time.time()
+        late = start - self.nextDeadline
+
+        self.lateness[self.framesRun % self.lateness.shape[0]] = late
+        self.framesRun += 1
+        self.lastFrameAt = start
+
+        # skip the deadlines we are already past instead of trying to run
+        # them all back to back
+        missed = int(late // self.period)
+        self.framesSkipped += missed
+        self.nextDeadline += (missed + 1) * self.period
+
+        if self.metrics:
+            self.latenessTimes.observe(late)
+            if missed:
+                self.lateCounter.inc(missed)
+
+        return missed
+
+    def frameDone(self, worktime, linkperiod=0.):
+
+        # Tell the scheduler how long the work of the frame took and how
+        # long the output link needs per frame
+        alpha = FrameScheduler.SMOOTHING
+        self.workTime += alpha * (worktime - self.workTime)
+        self.linkPeriod = linkperiod
+
+        if self.adaptive:
+            target = FrameScheduler.HEADROOM * max(self.workTime, self.linkPeriod)
+            target = min(self.maxperiod, max(self.minperiod, target))
+            self.period += alpha * (target - self.period)
+
+        if self.metrics:
+            self.workGauge.set(self.workTime)
+            self.linkGauge.set(self.linkPeriod)
+            self.targetGauge.set(1. / self.period)
+
+    def run(self, processor, numframes=None, shouldStop=None, update=None):
+
+        update = update or processor.update
+
+        frame = 0
+        while numframes is None or frame < numframes:
+
+            if shouldStop and shouldStop():
+                break
+
+            missed = self.waitForFrame()
+
+            start = time.time()
+            update()
+
+            if missed:
+                self.outputsSkipped += 1
+                if self.metrics:
+                    self.outputsSkippedCounter.inc()
+            else:
+                if self.metrics:
+                    outputStart = time.time()
+                processor.output()
+                if self.metrics:
+                    self.outputTimes.observe(time.time() - outputStart)
+
+            self.frameDone(time.time() - start, processor.outputPeriod())
+            frame += 1
+
+    def stats(self):
+
+        numframes = min(self.framesRun, self.lateness.shape[0])
+        lateness = self.lateness[:numframes] if numframes else numpy.zeros(1)
+
+        elapsed = (self.lastFrameAt or 0.) - (self.firstFrameAt or 0.)
+        return {
+            'fps': (self.framesRun - 1) / elapsed if elapsed > 0. else 0.,
+            'targetfps': 1. / self.period,
+            'frames': self.framesRun,
+            'skipped': self.framesSkipped,
+            'outputsskipped': self.outputsSkipped,
+            'worktime': self.workTime,
+            'linkperiod': self.linkPeriod,
+            'jittermean': numpy.mean(lateness),
+            'jitterstd': numpy.std(lateness),
+            'jitterp99': numpy.percentile(lateness, 99),
+        }
+
+    def report(self):
+
+        stats = self.stats()
+        for key in ['worktime', 'linkperiod', 'jittermean', 'jitterstd',
+                    'jitterp99']:
+            stats[key] *= 1000.
+
+        return ("fps: %(fps).1f (target %(targetfps).1f)  frames: %(frames)i  "
+                "skipped: %(skipped)i  work: %(worktime).2fms  "
+                "link: %(linkperiod).2fms  jitter mean/std/p99: "
+                "%(jittermean).2f/%(jitterstd).2f/%(jitterp99).2fms" % stats)
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+import os
+import time
+import bisect
+import threading
+
+# ------------------------------------------------------------------------
+# METRICS
+
+# Counters, gauges and latency histograms of the frame loop, kept in the
+# processes that run it and exported in the prometheus text format, either
+# as a file rewritten every few seconds (for the node exporter's textfile
+# collector, or just to look at) or from a small http server on localhost.
+#
+# Nothing is measured unless a Metrics is handed to a processor with
+# setMetrics() (and to a framescheduler.FrameScheduler), until then the hot
+# path only pays for checking that self.metrics is None.  With metrics on,
+# every stage timing costs a couple of time.time() calls and a bisect into
+# the bucket bounds.  Every metric is only updated by the one thread that
+# owns it (the render loop, or a strip's serial writer), so updates take no
+# locks.
+#
+# The metrics of a processor tell a CPU bound install from a link bound one:
+#
+#   stage_seconds{stage=...}     how long beat detection, rendering, update,
+#                                output, encoding and sending take per frame
+#   frames_total                 frames rendered, and frames_per_second
+#   frames_late_total            frame deadlines the scheduler missed
+#   work_seconds / link_seconds  what the scheduler measured the frame work
+#                                and the slowest serial link to need
+#   serial_bytes_total{port=...} bytes sent, and serial_bytes_per_second
+#   serial_frames_dropped_total  frames the serial writers never sent
+#   handshake_seconds{port=...}  how long the handshake with an arduino took
+
+# Key functions:
+
+#   Metrics.histogram(name, help, labels) / counter(...) / gauge(...):
+#     The metric with that name and labels, created the first time.
+
+#   Metrics.render( ) / writeTextfile(path):
+#     The prometheus text of all of the metrics.
+
+#   TextfileExporter(metrics, path, interval):
+#     Thread that rewrites path every interval seconds.
+
+#   serveHTTP(metrics, port):
+#     Serve the metrics on http://localhost:port/metrics from a thread.
+
+PREFIX = "sound2light"
+
+# Bucket bounds in seconds for the stage timings, from 50us up to 1s
+STAGE_BUCKETS = [.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025,
+                 .05, .1, .25, .5, 1.]
+
+# How many seconds counters with a rate average it over
+RATE_SECONDS = 1.
+
+HTTP_PORT = 9101
+TEXTFILE_INTERVAL = 5.
+
+def _formatLabels(labels, extra=()):
+
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                             for key, value in pairs)
+
+class Counter(object):
+
+    def __init__(self, labels, rate=False):
+
+        self.labels = labels
+        self.rate = rate
+        self.value = 0.
+
+        # the value at the start of the current and the last window, for
+        # the rate
+        self.windowStart = time.time()
+        self.windowValue = 0.
+        self.lastRate = None
+
+    def inc(self, amount=1):
+
+        self.value += amount
+
+        if self.rate:
+            now = time.time()
+            if now - self.windowStart >= RATE_SECONDS:
+                self.lastRate = ((self.value - self.windowValue) /
+                                 (now - self.windowStart))
+                self.windowStart, self.windowValue = now, self.value
+
+    def perSecond(self):
+
+        # the rate over the last window, or over the current one when it is
+        # the first or has gone on for long, so it falls to 0 when nothing
+        # was counted for a while
+        elapsed = time.time() - self.windowStart
+        if self.lastRate is None or elapsed >= 2. * RATE_SECONDS:
+            return (self.value - self.windowValue) / max(elapsed, 1e-6)
+
+        return self.lastRate
+
+class Gauge(object):
+
+    def __init__(self, labels):
+
+        self.labels = labels
+        self.value = 0.
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(object):
+
+    def __init__(self, labels, buckets=STAGE_BUCKETS):
+
+        self.labels = labels
+        self.buckets = list(buckets)
+
+        # counts per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics(object):
+
+    def __init__(self, prefix=PREFIX):
+
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        # name -> (type, help, {labels: metric}), in the order created
+        self.families = {}
+        self.order = []
+
+    def _metric(self, kind, name, help, labels, create):
+
+        labels = tuple(sorted((labels or {}).items()))
+
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = (kind, help, {})
+                self.order.append(name)
+
+            family = self.families[name]
+            if family[0] != kind:
+                raise Exception("Metric [ %s ] is a %s, not a %s" %
+                                (name, family[0], kind))
+
+            if labels not in family[2]:
+                family[2][labels] = create(labels)
+
+            return family[2][labels]
+
+    def counter(self, name, help, labels=None, rate=False):
+
+        # With rate, name_per_second is exported as well
+        return self._metric('counter', name, help, labels,
+                            lambda labels: Counter(labels, rate))
+
+    def gauge(self, name, help, labels=None):
+        return self._metric('gauge', name, help, labels, Gauge)
+
+    def histogram(self, name, help, labels=None, buckets=STAGE_BUCKETS):
+        return self._metric('histogram', name, help, labels,
+                            lambda labels: Histogram(labels, buckets))
+
+    def render(self):
+
+        with self.lock:
+            families = [(name, self.families[name][0], self.families[name][1],
+                         sorted(self.families[name][2].items()))
+                        for name in self.order]
+
+        lines = []
+        for name, kind, help, members in families:
+
+            fullname = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (fullname, help))
+            lines.append("# TYPE %s %s" % (fullname, kind))
+
+            for labels, metric in members:
+
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + ["+Inf"],
+                                            list(metric.counts)):
+                        cumulative += count
+                        lines.append("%s_bucket%s %i" % (
+                            fullname, _formatLabels(labels, [('le', bound)]),
+                            cumulative))
+                    lines.append("%s_sum%s %r" % (fullname,
+                                                  _formatLabels(labels),
+                                                  metric.sum))
+                    lines.append("%s_count%s %i" % (fullname,
+                                                    _formatLabels(labels),
+                                                    metric.count))
+                else:
+                    lines.append("%s%s %r" % (fullname, _formatLabels(labels),
+                                              float(metric.value)))
+
+            # the rates of the counters that keep one
+            rates = [metric for labels, metric in members
+                     if kind == 'counter' and metric.rate]
+            if rates:
+                ratename = "%s_per_second" % fullname.replace("_total", "")
+                lines.append("# HELP %s %s per second" % (ratename, help))
+                lines.append("# TYPE %s gauge" % ratename)
+                for metric in rates:
+                    lines.append("%s%s %r" % (ratename,
+                                              _formatLabels(metric.labels),
+                                              metric.perSecond()))
+
+        return "\n".join(lines) + "\n"
+
+    def writeTextfile(self, path):
+
+        # Write to a temporary file and move it over path, so readers never
+        # see half a file
+        temppath = path + ".tmp"
+        with open(temppath, "w") as textfile:
+            textfile.write(self.render())
+        os.rename(temppath, path)
+
+# Rewrites the textfile every interval seconds, and once more when stopped
+
+class TextfileExporter(threading.Thread):
+
+    def __init__(self, metrics, path, interval=TEXTFILE_INTERVAL):
+
+        threading.Thread.__init__(self, name="TextfileExporter")
+        self.daemon = True
+
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopEvent = threading.Event()
+
+    def run(self):
+
+        while not self.stopEvent.wait(self.interval):
+            self._write()
+
+    def _write(self):
+
+        try:
+            self.metrics.writeTextfile(self.path)
+        except (IOError, OSError), e:
+            print "Unable to write metrics [ %s ]: %s" % (self.path, str(e))
+
+    def stop(self, timeout=1.):
+
+        self.stopEvent.set()
+        if self.ident is not None:
+            self.join(timeout)
+        self._write()
+
+def serveHTTP(metrics, port=HTTP_PORT, host="127.0.0.1"):
+
+    # Serve the metrics from a daemon thread, returns the server so it can
+    # be shut down
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # the terminal belongs to the view
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever,
+                              name="MetricsHTTPServer")
+    thread.daemon = True
+    thread.start()
+
+    return server
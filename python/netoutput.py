@@ -0,0 +1,469 @@
+#!/usr/bin/python
+
+import sys
+import time
+import uuid
+import socket
+import struct
+import threading
+import numpy
+
+import framecodec
+
+# ------------------------------------------------------------------------
+# NETWORK OUTPUT
+
+# Sends the colors to networked pixel controllers over udp instead of to an
+# arduino over a 115200 baud serial link, in one of the two protocols those
+# controllers speak:
+#
+#   e131     E1.31 (streaming ACN, sACN) on port 5568
+#   artnet   Art-Net ArtDmx on port 6454
+#
+# Both carry DMX universes of 512 channels, so a frame is split into
+# universes of LEDS_PER_UNIVERSE leds (3 channels each), numbered up from
+# the first universe.  Every universe's packet is built once, headers and
+# all, in one [universes, packet bytes] array, so a frame only copies its
+# colors into the data of all of the packets in one go, stamps the
+# sequence numbers and hands every packet to sendto.  After the packets of
+# a frame a synchronization packet (E1.31 universe sync or ArtSync) tells
+# the controllers to show all of the universes at once, so a frame never
+# tears across them.  Unless given a host, E1.31 universes go to their
+# multicast groups and Art-Net to the broadcast address.
+#
+# A UDPPixelStrip is an output sink like sound2light.TCLStrip: it has a
+# start led and numleds and SendColors, OutputPeriod, SetMetrics, Start and
+# Close, so SoundToLightProcessor drives it like a strip behind a serial
+# port (pass it in sinks).  Sending a udp packet never waits on the link, so
+# it needs no writer thread.
+#
+# A PixelReceiver listens for either protocol and puts frames back
+# together, to test a strip against on the loopback interface:
+#
+#   ./netoutput.py e131        prints what it receives every second
+#   ./benchmark.py --sink e131 --leds 1000 --processors light
+
+# Key functions:
+
+#   UDPPixelStrip(numleds, protocol, host, universe, port, calibration):
+#     Send numleds leds from the first universe on.
+
+#   UDPPixelStrip.SendColors(colorarray):
+#     Send the strip's segment of the colorarray.
+
+#   parseSink(text, numleds):
+#     The UDPPixelStrip described by protocol[:host[:universe]], for --sink.
+
+#   PixelReceiver(numleds, protocol, universe, host, port):
+#     Thread that receives the strip's frames.  stats() has its counters and
+#     colorbytes the last complete frame.
+
+PROTOCOLS = ['e131', 'artnet']
+
+LEDS_PER_UNIVERSE = 170
+
+E131_PORT = 5568
+ARTNET_PORT = 6454
+
+DEFAULT_PORTS = {'e131': E131_PORT, 'artnet': ARTNET_PORT}
+
+# E1.31 universes are numbered from 1, Art-Net port addresses from 0
+FIRST_UNIVERSES = {'e131': 1, 'artnet': 0}
+
+SOURCE_NAME = "sound2light"
+
+# E1.31 header fields, see ANSI E1.26 and E1.31
+E131_HEADER = struct.Struct("!HH12sHI16sHI64sBHBBHHBBHHHB")
+E131_SYNC = struct.Struct("!HH12sHI16sHIBHH")
+ACN_IDENTIFIER = "ASC-E1.17\x00\x00\x00"
+VECTOR_ROOT_E131_DATA = 0x4
+VECTOR_ROOT_E131_EXTENDED = 0x8
+VECTOR_E131_DATA_PACKET = 0x2
+VECTOR_E131_EXTENDED_SYNCHRONIZATION = 0x1
+E131_PRIORITY = 100
+
+# offset of the sequence number and of the data in an E1.31 data packet,
+# and of the sequence number in a sync packet
+E131_SEQUENCE_OFFSET = 111
+E131_DATA_OFFSET = 126
+E131_SYNC_SEQUENCE_OFFSET = 44
+
+# Art-Net header fields
+ARTNET_HEADER = struct.Struct("<8sH")
+ARTNET_ID = "Art-Net\x00"
+ARTNET_VERSION = 14
+OP_DMX = 0x5000
+OP_SYNC = 0x5200
+
+ARTNET_SEQUENCE_OFFSET = 12
+ARTNET_DATA_OFFSET = 18
+
+def _flagsLength(length):
+    # the high 4 bits of every ACN pdu length are its flags, always 0x7
+    return 0x7000 | length
+
+def e131Packet(universe, numchannels, cid, syncUniverse=0):
+
+    # An E1.31 data packet for numchannels channels, with sequence number
+    # and data left at 0
+    length = E131_DATA_OFFSET + numchannels
+    header = E131_HEADER.pack(
+        0x10, 0, ACN_IDENTIFIER, _flagsLength(length - 16),
+        VECTOR_ROOT_E131_DATA, cid,
+        _flagsLength(length - 38), VECTOR_E131_DATA_PACKET,
+        SOURCE_NAME, E131_PRIORITY, syncUniverse, 0, 0, universe,
+        _flagsLength(length - 115), 0x02, 0xa1, 0, 1, numchannels + 1, 0)
+
+    return header + "\x00" * numchannels
+
+def e131SyncPacket(syncUniverse, cid, sequence=0):
+
+    return E131_SYNC.pack(
+        0x10, 0, ACN_IDENTIFIER, _flagsLength(E131_SYNC.size - 16),
+        VECTOR_ROOT_E131_EXTENDED, cid,
+        _flagsLength(E131_SYNC.size - 38),
+        VECTOR_E131_EXTENDED_SYNCHRONIZATION, sequence, syncUniverse, 0)
+
+def artnetPacket(universe, numchannels):
+
+    # An ArtDmx packet, Art-Net wants an even number of channels.  The
+    # universe is little endian like the opcode, the rest is big endian.
+    numchannels += numchannels % 2
+    return (ARTNET_HEADER.pack(ARTNET_ID, OP_DMX) +
+            struct.pack("!HBB", ARTNET_VERSION, 0, 0) +
+            struct.pack("<H", universe) + struct.pack("!H", numchannels) +
+            "\x00" * numchannels)
+
+def artnetSyncPacket():
+    return ARTNET_HEADER.pack(ARTNET_ID, OP_SYNC) + struct.pack(
+        "!HBB", ARTNET_VERSION, 0, 0)
+
+def e131MulticastGroup(universe):
+    return "239.255.%i.%i" % (universe >> 8, universe & 0xff)
+
+# ------------------------------------------------------------------------
+# UDP PIXEL STRIPS
+
+class UDPPixelStrip(object):
+
+    def __init__(self, numleds, protocol='e131', host=None, universe=None,
+                 port=None, calibration=None, sync=True):
+
+        if protocol not in PROTOCOLS:
+            raise Exception("Unknown pixel protocol [ %s ], use one of %s" %
+                            (protocol, PROTOCOLS))
+
+        self.numleds = numleds
+        self.start = 0
+        self.protocol = protocol
+        self.host = host
+        self.port = port or DEFAULT_PORTS[protocol]
+        self.universe = (FIRST_UNIVERSES[protocol] if universe is None
+                         else universe)
+        self.metrics = None
+
+        numuniverses = -(-numleds // LEDS_PER_UNIVERSE)
+        self.universes = range(self.universe, self.universe + numuniverses)
+        self.numchannels = [3 * min(LEDS_PER_UNIVERSE,
+                                    numleds - idx * LEDS_PER_UNIVERSE)
+                            for idx in range(numuniverses)]
+
+        # the colors are quantized (and calibrated) like the serial frames
+        self.frameencoder = framecodec.ColorFrameEncoder(numleds, 'full',
+                                                         calibration=calibration)
+
+        # every universe's packet, each row padded to the longest one, the
+        # length of every packet and where it goes
+        if protocol == 'e131':
+            cid = uuid.uuid4().bytes
+            syncUniverse = self.universes[-1] if sync else 0
+            packets = [e131Packet(universe, channels, cid, syncUniverse)
+                       for universe, channels in zip(self.universes,
+                                                     self.numchannels)]
+            self.syncPacket = (bytearray(e131SyncPacket(syncUniverse, cid))
+                               if sync else None)
+            self.sequenceOffset = E131_SEQUENCE_OFFSET
+            self.dataOffset = E131_DATA_OFFSET
+            self.addresses = [(host or e131MulticastGroup(universe),
+                               self.port) for universe in self.universes]
+            self.syncAddress = (host or e131MulticastGroup(syncUniverse),
+                                self.port)
+        else:
+            packets = [artnetPacket(universe, channels)
+                       for universe, channels in zip(self.universes,
+                                                     self.numchannels)]
+            self.syncPacket = bytearray(artnetSyncPacket()) if sync else None
+            self.sequenceOffset = ARTNET_SEQUENCE_OFFSET
+            self.dataOffset = ARTNET_DATA_OFFSET
+            self.addresses = [(host or "255.255.255.255", self.port)
+                              ] * numuniverses
+            self.syncAddress = self.addresses[0]
+
+        self.lengths = [len(packet) for packet in packets]
+        self.packets = numpy.zeros(
+            [numuniverses, max(self.lengths + [self.dataOffset +
+                                               3 * LEDS_PER_UNIVERSE])],
+            dtype=numpy.uint8)
+        for row, packet in zip(self.packets, packets):
+            row[:len(packet)] = numpy.frombuffer(packet, dtype=numpy.uint8)
+
+        # the data of every packet as one [universes, 510] view, and the
+        # colors padded out to fill it
+        self.data = self.packets[:, self.dataOffset:
+                                 self.dataOffset + 3 * LEDS_PER_UNIVERSE]
+        self.padded = numpy.zeros(numuniverses * 3 * LEDS_PER_UNIVERSE,
+                                  dtype=numpy.uint8)
+        self.sequence = 0
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        self.framesSent = 0
+        self.packetsSent = 0
+        self.bytesSent = 0
+
+    def __str__(self):
+        return "%s %s:%i universes %i - %i [ leds %i - %i ]" % (
+            self.protocol, self.host or "multicast", self.port,
+            self.universes[0], self.universes[-1], self.start,
+            self.start + self.numleds - 1)
+
+    def Segment(self, colorarray):
+        return colorarray[self.start:self.start + self.numleds]
+
+    def EncodeColors(self, colorarray):
+
+        # Copy the segment's color bytes into the packets and stamp them with
+        # the next sequence number.  Art-Net skips 0, which means unsequenced.
+        colorbytes = self.frameencoder.quantize(self.Segment(colorarray))
+        self.padded[:colorbytes.shape[0]] = colorbytes
+        self.data[...] = self.padded.reshape(self.data.shape)
+
+        self.sequence = (self.sequence + 1) % 256
+        if self.protocol == 'artnet' and self.sequence == 0:
+            self.sequence = 1
+        self.packets[:, self.sequenceOffset] = self.sequence
+
+        return self.packets
+
+    def SendPackets(self, packets):
+
+        numbytes = 0
+        for packet, length, address in zip(packets, self.lengths,
+                                           self.addresses):
+            numbytes += self.socket.sendto(packet[:length].data, address)
+
+        if self.syncPacket is not None:
+            if self.protocol == 'e131':
+                self.syncPacket[E131_SYNC_SEQUENCE_OFFSET] = self.sequence
+            numbytes += self.socket.sendto(self.syncPacket, self.syncAddress)
+
+        self.framesSent += 1
+        self.packetsSent += len(self.lengths) + (self.syncPacket is not None)
+        self.bytesSent += numbytes
+        return numbytes
+
+    def SendColors(self, colorarray):
+
+        if not self.metrics:
+            self.SendPackets(self.EncodeColors(colorarray))
+            return True
+
+        start = time.time()
+        packets = self.EncodeColors(colorarray)
+        encoded = time.time()
+        numbytes = self.SendPackets(packets)
+        end = time.time()
+
+        self.encodeTimes.observe(encoded - start)
+        self.sendTimes.observe(end - encoded)
+        self.bytesCounter.inc(numbytes)
+        self.packetsCounter.inc(len(self.lengths))
+        return True
+
+    def SetMetrics(self, metrics):
+
+        # The strip's metrics are labelled with its protocol and first
+        # universe
+        self.metrics = metrics
+        labels = {'protocol': self.protocol, 'universe': self.universe}
+
+        self.encodeTimes = metrics.histogram("stage_seconds", "Seconds each "
+            "stage of a frame takes", dict(labels, stage='encode'))
+        self.sendTimes = metrics.histogram("stage_seconds", "Seconds each "
+            "stage of a frame takes", dict(labels, stage='send'))
+        self.bytesCounter = metrics.counter("network_bytes_total", "Pixel "
+            "packet bytes sent", labels, rate=True)
+        self.packetsCounter = metrics.counter("network_packets_total",
+            "Pixel packets sent", labels)
+
+    def Start(self, asyncOutput=True):
+        # udp sends never wait on the link, so there is nothing to start
+        pass
+
+    def OutputPeriod(self):
+        return 0.
+
+    def Close(self):
+        self.socket.close()
+
+def parseSink(text, numleds):
+
+    # protocol[:host[:universe]], eg e131:10.0.0.50:1 or artnet
+    fields = text.split(":")
+    return UDPPixelStrip(numleds, fields[0],
+                         fields[1] if len(fields) > 1 and fields[1] else None,
+                         int(fields[2]) if len(fields) > 2 else None)
+
+# ------------------------------------------------------------------------
+# PIXEL RECEIVER
+
+# Receives the packets of a UDPPixelStrip and puts its frames back
+# together.  A frame is complete when every universe has arrived since the
+# last one.
+
+class PixelReceiver(threading.Thread):
+
+    def __init__(self, numleds, protocol='e131', universe=None,
+                 host="127.0.0.1", port=None):
+
+        threading.Thread.__init__(self, name="PixelReceiver")
+        self.daemon = True
+
+        if protocol not in PROTOCOLS:
+            raise Exception("Unknown pixel protocol [ %s ], use one of %s" %
+                            (protocol, PROTOCOLS))
+
+        self.protocol = protocol
+        self.numleds = numleds
+        self.universe = (FIRST_UNIVERSES[protocol] if universe is None
+                         else universe)
+        self.numuniverses = -(-numleds // LEDS_PER_UNIVERSE)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.socket.bind((host, port if port is not None
+                          else DEFAULT_PORTS[protocol]))
+        self.socket.settimeout(.1)
+        self.port = self.socket.getsockname()[1]
+
+        self.running = True
+        self.lock = threading.Lock()
+
+        self.universedata = numpy.zeros(
+            [self.numuniverses, 3 * LEDS_PER_UNIVERSE], dtype=numpy.uint8)
+        self.received = set()
+        self.colorbytes = numpy.zeros(3 * numleds, dtype=numpy.uint8)
+
+        self.packets = 0
+        self.syncs = 0
+        self.invalid = 0
+        self.frames = 0
+        self.firstFrameAt = None
+        self.lastFrameAt = None
+
+    def _parse(self, packet):
+
+        # Returns (universe, data), 'sync' or None for packets that are not
+        # ours
+        if self.protocol == 'e131':
+            if len(packet) >= E131_SYNC.size and packet[4:16] == ACN_IDENTIFIER:
+                vector = struct.unpack_from("!I", packet, 18)[0]
+                if vector == VECTOR_ROOT_E131_EXTENDED:
+                    return 'sync'
+                if (vector == VECTOR_ROOT_E131_DATA and
+                        len(packet) >= E131_DATA_OFFSET):
+                    universe = struct.unpack_from("!H", packet, 113)[0]
+                    return universe, packet[E131_DATA_OFFSET:]
+        else:
+            if len(packet) >= 10 and packet[:8] == ARTNET_ID:
+                opcode = struct.unpack_from("<H", packet, 8)[0]
+                if opcode == OP_SYNC:
+                    return 'sync'
+                if opcode == OP_DMX and len(packet) >= ARTNET_DATA_OFFSET:
+                    universe = struct.unpack_from("<H", packet, 14)[0]
+                    length = struct.unpack_from("!H", packet, 16)[0]
+                    return universe, packet[ARTNET_DATA_OFFSET:
+                                            ARTNET_DATA_OFFSET + length]
+        return None
+
+    def run(self):
+
+        while self.running:
+
+            try:
+                packet = self.socket.recv(2048)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+
+            parsed = self._parse(packet)
+            with self.lock:
+                self.packets += 1
+
+                if parsed is None:
+                    self.invalid += 1
+                    continue
+
+                if parsed == 'sync':
+                    self.syncs += 1
+                    continue
+
+                universe, data = parsed
+                idx = universe - self.universe
+                if not 0 <= idx < self.numuniverses:
+                    continue
+
+                numbytes = min(len(data), self.universedata.shape[1])
+                self.universedata[idx, :numbytes] = numpy.frombuffer(
+                    data[:numbytes], dtype=numpy.uint8)
+                self.received.add(idx)
+
+                if len(self.received) == self.numuniverses:
+                    self.colorbytes[...] = self.universedata.ravel()[
+                        :self.colorbytes.shape[0]]
+                    self.received.clear()
+                    self.frames += 1
+                    self.lastFrameAt = time.time()
+                    if self.firstFrameAt is None:
+                        self.firstFrameAt = self.lastFrameAt
+
+    def stats(self):
+
+        with self.lock:
+            seconds = (self.lastFrameAt or 0.) - (self.firstFrameAt or 0.)
+            return {
+                'packets': self.packets,
+                'syncs': self.syncs,
+                'invalid': self.invalid,
+                'frames': self.frames,
+                'fps': (self.frames - 1) / seconds if seconds > 0. else 0.,
+            }
+
+    def stop(self, timeout=1.):
+
+        self.running = False
+        if self.ident is not None:
+            self.join(timeout)
+        self.socket.close()
+
+if __name__ == "__main__":
+
+    # Receive a strip's frames until interrupted and print the counters
+    # every second
+    protocol = sys.argv[1] if len(sys.argv) > 1 else 'e131'
+    numleds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    receiver = PixelReceiver(numleds, protocol, host="0.0.0.0")
+    receiver.start()
+    print "Receiving %s on port [ %i ]" % (protocol, receiver.port)
+
+    try:
+        while True:
+            time.sleep(1.)
+            print receiver.stats()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.stop()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+import audiosource
+
+# ------------------------------------------------------------------------
+# SPECTRAL FLUX ONSETS
+
+# A beat engine that reacts to the attack of a sound instead of to its
+# energy.  The energy engine in SoundToColorProcessor._processBeat compares
+# every frame against the average energy of the last 40 frames, measured
+# over a long window, so a beat only shows once enough of it has been
+# averaged in.
+#
+# This detector cuts the new audio of every frame into short overlapping
+# windows (512 samples, 128 apart at 44.1 kHz: a new window every 3 ms) and
+# measures the energy of every band in each of them.  The spectral flux of a
+# window is how much the log energy of a band rose since the window before
+# it, summed over both channels.  All of the windows of a frame, for every
+# band and channel, go through one FFT and one matrix product.
+#
+# A band has an onset when its flux is rising and stands THRESHOLD_STDS
+# standard deviations above its average over the last HISTORY_SECONDS, and
+# it had no onset for REFRACTORY_SECONDS.  The strength of an onset is its
+# flux over that threshold, so like the energy engine a strength of 1 is a
+# beat that barely made it.
+#
+# The detector needs the raw samples, so it only works with audio sources
+# that have them (see AudioSource.newSamples).
+
+# Key functions:
+
+#   process(samples):
+#     Consume the [numchannels, numsamples] samples that arrived since the
+#     last call.  Returns the strength of the strongest onset of every band
+#     in them, 0 for bands without one.
+
+class SpectralFluxDetector(object):
+
+    WINDOW_SIZE = 512
+    HOP_SIZE = 128
+
+    HISTORY_SECONDS = 1.
+    THRESHOLD_STDS = 3.
+    REFRACTORY_SECONDS = .08
+
+    # flux a band needs no matter how quiet it has been, and how strongly
+    # band amplitudes are compressed before taking their log
+    FLUX_FLOOR = 1.
+    COMPRESSION = 1000.
+
+    def __init__(self, numbands=16, samplerate=44100):
+
+        self.numbands = numbands
+        self.analyzer = audiosource.BandEnergyAnalyzer(
+            samplerate, self.WINDOW_SIZE, numbands)
+
+        # the samples of the last frame that still belong to a window, and
+        # the log band energies and flux of the last window
+        self.tail = numpy.zeros([2, 0])
+        self.lastenergies = None
+        self.lastflux = numpy.zeros(numbands)
+
+        # circular history of the flux of every window, per band
+        historysize = int(self.HISTORY_SECONDS * samplerate / self.HOP_SIZE)
+        self.history = numpy.zeros([numbands, historysize])
+        self.historyhead = 0
+        self.historycount = 0
+
+        self.refractory = int(self.REFRACTORY_SECONDS * samplerate /
+                              self.HOP_SIZE)
+        self.windowsSeen = 0
+        self.lastonsets = numpy.zeros(numbands, dtype=int) - self.refractory
+
+        self.strengths = numpy.zeros(numbands)
+
+    def _windows(self, samples):
+
+        # Append the new samples to the tail of the last frame and view
+        # every complete window in them, without copying
+        if samples.shape[0] == 1:
+            samples = numpy.repeat(samples, 2, axis=0)
+
+        buffered = numpy.ascontiguousarray(
+            numpy.concatenate((self.tail, samples[:2]), axis=1))
+
+        numwindows = max(0, (buffered.shape[1] - self.WINDOW_SIZE) //
+                         self.HOP_SIZE + 1)
+        self.tail = buffered[:, numwindows * self.HOP_SIZE:].copy()
+
+        rowstride, samplestride = buffered.strides
+        return as_strided(buffered,
+                          shape=(2, numwindows, self.WINDOW_SIZE),
+                          strides=(rowstride, self.HOP_SIZE * samplestride,
+                                   samplestride))
+
+    def _pushHistory(self, flux):
+
+        size = self.history.shape[1]
+        numwindows = min(flux.shape[0], size)
+
+        columns = (self.historyhead + numpy.arange(numwindows)) % size
+        self.history[:, columns] = flux[-numwindows:].T
+
+        self.historyhead = (self.historyhead + numwindows) % size
+        self.historycount = min(self.historycount + numwindows, size)
+
+    def process(self, samples):
+
+        self.strengths[...] = 0.
+
+        windows = self._windows(samples)
+        numwindows = windows.shape[1]
+        if not numwindows:
+            return self.strengths
+
+        # [channels, windows, bands] log band energies of every window
+        energies = numpy.log1p(self.COMPRESSION *
+                               self.analyzer.analyze(windows))
+
+        if self.lastenergies is None:
+            self.lastenergies = energies[:, 0]
+
+        rises = numpy.diff(numpy.concatenate(
+            (self.lastenergies[:, numpy.newaxis], energies), axis=1), axis=1)
+        flux = numpy.sum(numpy.maximum(rises, 0.), axis=0)
+
+        # the threshold comes from the history before this frame, and the
+        # history has to cover a good part of HISTORY_SECONDS to be trusted
+        if self.historycount >= self.history.shape[1] // 4:
+
+            history = self.history[:, :self.historycount]
+            thresholds = (numpy.mean(history, axis=1) + self.FLUX_FLOOR +
+                          self.THRESHOLD_STDS * numpy.std(history, axis=1))
+
+            previous = numpy.concatenate((self.lastflux[numpy.newaxis],
+                                          flux[:-1]))
+            windowidx = self.windowsSeen + numpy.arange(numwindows)
+
+            onsets = ((flux > thresholds) & (flux >= previous) &
+                      (windowidx[:, numpy.newaxis] - self.lastonsets >=
+                       self.refractory))
+
+            hasonset = onsets.any(axis=0)
+            self.strengths[...] = numpy.max(
+                numpy.where(onsets, flux / thresholds, 0.), axis=0)
+            self.lastonsets[hasonset] = windowidx[
+                numpy.argmax(onsets, axis=0)[hasonset]]
+
+        self._pushHistory(flux)
+        self.lastenergies = energies[:, -1]
+        self.lastflux = flux[-1]
+        self.windowsSeen += numwindows
+
+        return self.strengths
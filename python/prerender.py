@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import signal
+import argparse
+import multiprocessing
+
+import audioblocks
+import audiosource
+import showfile
+import sound2color
+
+# ------------------------------------------------------------------------
+# PRE-RENDERING
+
+# When the playlist is known ahead of time, the shows can be rendered
+# before the event instead of live.  Every audio file of the list goes
+# through the same beat detection and rendering as the live audio, read
+# from disk as fast as the analysis goes, and its frames are recorded into
+# a show file (see showfile.py), which `./showfile.py play` then sends to
+# the lights with no analysis at all and exactly on time.
+#
+# The files are rendered on a pool of processes, one file per process at a
+# time and the longest files first, so a library renders about as many
+# times faster as there are cores on top of running faster than real time.
+# Every file gets a processor of its own and a clock that counts frames
+# rather than seconds, and the effect layers that draw at random (fire) are
+# seeded with the same seed for every show, so a show is the same however
+# fast it was rendered and whichever process rendered it.
+#
+# A show is written to a .partial file next to it and only renamed once
+# complete, so an interrupted batch leaves no show that looks finished.
+# Running the batch again skips the shows that are already there and
+# renders the rest from the start.
+#
+#   ./prerender.py --output shows/ playlist/*.wav
+#   ./prerender.py --output shows/ --jobs 4 --flux --effects fire,pulse:add \
+#       playlist/
+
+# Key functions:
+
+#   renderShow(wavepath, showpath, numleds, fps, beatengine, effectLayers,
+#              seed):
+#     Render one audio file into a show file, in the calling process.
+#     Returns the number of frames and the seconds of audio rendered.
+
+#   renderShows(jobs, numjobs, force):
+#     Render (wavepath, showpath) pairs on a pool of numjobs processes,
+#     printing the progress.  Returns the number of shows that failed.
+
+# the extension of the audio files found in directories, and of the shows
+AUDIO_EXTENSIONS = ['.wav']
+SHOW_EXTENSION = '.s2l'
+PARTIAL_EXTENSION = '.partial'
+
+# what the random effect layers are seeded with
+EFFECT_SEED = 0
+
+# Counts frames for the processor's color ramps, so they change with the
+# audio and not with how fast it renders
+
+class FrameClock(object):
+
+    def __init__(self, fps):
+
+        self.fps = fps
+        self.frames = 0
+
+    def tick(self):
+        self.frames += 1
+
+    def __call__(self):
+        return self.frames / self.fps
+
+def renderShow(wavepath, showpath, numleds=None, fps=30., beatengine=None,
+               effectLayers=None, seed=EFFECT_SEED, processorclass=None):
+
+    processorclass = processorclass or sound2color.SoundToColorProcessor
+
+    # One frame every hop of the audio.  The show keeps the exact frame
+    # rate the hop comes to at the file's sample rate.
+    source = audiosource.WaveFileAudioSource(wavepath,
+        numbands=processorclass.NUM_FREQUENCY_BANDS)
+    source.hopsize = int(round(source.samplerate / fps))
+    showfps = float(source.samplerate) / source.hopsize
+
+    processor = processorclass(source, headless=True, numleds=numleds,
+                               beatengine=beatengine)
+
+    # the energy beat engine's history was tuned at 30 fps, keep it as
+    # many seconds long
+    processor.NUM_AVERAGE_SAMPLES = max(1, int(round(
+        processor.NUM_AVERAGE_SAMPLES * showfps / audioblocks.TUNED_FPS)))
+
+    if effectLayers:
+        import effects
+        processor.effects = effects.parseEffects(effectLayers, seed)
+
+    clock = FrameClock(showfps)
+    processor.clock = clock
+    processor.starttime = 0.
+
+    partialpath = showpath + PARTIAL_EXTENSION
+    processor.recorder = showfile.ShowRecorder(partialpath,
+        processor.NUM_FREQUENCY_BANDS, processor.numleds, fps=showfps,
+        useClock=False)
+
+    processor.start()
+    try:
+        while not source.isFinished():
+            processor.update()
+            clock.tick()
+    finally:
+        processor.shutdown()
+        processor.recorder.close()
+
+    os.rename(partialpath, showpath)
+    return clock.frames, clock.frames / showfps
+
+def _renderJob(job):
+
+    # Runs in a pool process.  Errors come back as a message, so one bad
+    # file does not stop the batch.
+    wavepath, showpath, options = job
+
+    start = time.time()
+    try:
+        frames, seconds = renderShow(wavepath, showpath, **options)
+    except Exception, e:
+        return wavepath, showpath, None, "%s: %s" % (e.__class__.__name__,
+                                                    str(e))
+
+    return wavepath, showpath, (frames, seconds, time.time() - start), None
+
+def _ignoreInterrupt():
+
+    # Pool processes leave a KeyboardInterrupt to the parent, which
+    # terminates them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def findAudioFiles(paths):
+
+    # The audio files among paths, with the ones in directories found by
+    # extension
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            found.extend(os.path.join(dirpath, filename)
+                         for filename in sorted(filenames)
+                         if os.path.splitext(filename)[1].lower() in
+                         AUDIO_EXTENSIONS)
+
+    return found
+
+def showPaths(wavepaths, outputdir):
+
+    # Every audio file's show in outputdir, named after the audio file
+    jobs = []
+    seen = {}
+    for wavepath in wavepaths:
+
+        name = os.path.splitext(os.path.basename(wavepath))[0]
+        showpath = os.path.join(outputdir, name + SHOW_EXTENSION)
+        if showpath in seen:
+            raise Exception("[ %s ] and [ %s ] would both render to [ %s ]" %
+                            (seen[showpath], wavepath, showpath))
+
+        seen[showpath] = wavepath
+        jobs.append((wavepath, showpath))
+
+    return jobs
+
+def _formatSeconds(seconds):
+    return "%i:%02i" % divmod(int(round(seconds)), 60)
+
+def renderShows(jobs, numjobs=None, force=False, **options):
+
+    # Skip the shows that are already rendered, and start with the longest
+    # audio so no process is left with a long file at the end
+    todo = [(wavepath, showpath) for wavepath, showpath in jobs
+            if force or not os.path.exists(showpath)]
+    todo.sort(key=lambda job: -os.path.getsize(job[0]))
+
+    if len(todo) < len(jobs):
+        print "Skipping %i shows already rendered" % (len(jobs) - len(todo))
+    if not todo:
+        return 0
+
+    numjobs = min(numjobs or multiprocessing.cpu_count(), len(todo))
+    print "Rendering %i shows on %i processes" % (len(todo), numjobs)
+
+    work = [(wavepath, showpath, options) for wavepath, showpath in todo]
+    pool = None
+    if numjobs > 1:
+        pool = multiprocessing.Pool(numjobs, _ignoreInterrupt)
+        results = pool.imap_unordered(_renderJob, work)
+    else:
+        results = (_renderJob(job) for job in work)
+
+    start = time.time()
+    audioSeconds = 0.
+    failed = 0
+
+    try:
+        for done in range(1, len(work) + 1):
+
+            # Wait with a timeout so a KeyboardInterrupt still gets through
+            result = None
+            while result is None:
+                try:
+                    result = (results.next(.1) if pool else next(results))
+                except multiprocessing.TimeoutError:
+                    continue
+
+            wavepath, showpath, stats, error = result
+            if error:
+                failed += 1
+                print "[ %i/%i ] Failed [ %s ]: %s" % (done, len(work),
+                                                       wavepath, error)
+                continue
+
+            frames, seconds, renderSeconds = stats
+            audioSeconds += seconds
+            print ("[ %i/%i ] [ %s ] %s of audio, %i frames in %.1fs "
+                   "(%.0fx real time)" % (
+                       done, len(work), showpath, _formatSeconds(seconds),
+                       frames, renderSeconds,
+                       seconds / max(renderSeconds, 1e-6)))
+
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+            pool.join()
+        print "Interrupted, run again to render the rest"
+        raise
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print "Rendered %s of audio in %.1fs (%.0fx real time), %i failed" % (
+        _formatSeconds(audioSeconds), elapsed,
+        audioSeconds / max(elapsed, 1e-6), failed)
+
+    return failed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Render audio files into "
+                                     "show files ahead of time")
+    parser.add_argument("audio", nargs="+",
+                        help="wave files, or directories of them")
+    parser.add_argument("--output", "-o", default=".",
+                        help="directory the shows are written to")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="processes to render on (default: one per "
+                        "core)")
+    parser.add_argument("--force", action="store_true",
+                        help="render the shows that are already there again")
+    parser.add_argument("--leds", type=int,
+                        help="leds of the show (default %i)" %
+                        sound2color.SoundToColorProcessor.NUM_LEDS)
+    parser.add_argument("--fps", type=float, default=30.,
+                        help="frames per second of the show")
+    parser.add_argument("--flux", action="store_true",
+                        help="find beats by spectral flux onsets, see "
+                        "onsetdetection.py")
+    parser.add_argument("--effects", metavar="LAYERS",
+                        help="draw effect layers, eg "
+                        "fire,pulse:add,vu:screen:.5, see effects.py")
+    parser.add_argument("--seed", type=int, default=EFFECT_SEED,
+                        help="seed of the effect layers that draw at random "
+                        "(default %i)" % EFFECT_SEED)
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    jobs = showPaths(findAudioFiles(args.audio), args.output)
+
+    try:
+        failed = renderShows(jobs, args.jobs, args.force, numleds=args.leds,
+                             fps=args.fps,
+                             beatengine='flux' if args.flux else None,
+                             effectLayers=args.effects, seed=args.seed)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    sys.exit(1 if failed else 0)
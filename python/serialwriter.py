@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+import time
+import threading
+import numpy
+
+# ------------------------------------------------------------------------
+# SERIAL WRITER
+
+# Sends color frames to the arduino from its own thread so that a slow
+# serial link never holds up the audio analysis and rendering.
+#
+# The render loop calls publish() with its colorarray, which only copies
+# the colors into the front half of a double buffer.  The writer thread
+# swaps the halves, encodes the frame and sends it, then waits for the link
+# to drain before taking the next one.  If the render loop publishes again
+# before the writer got to a frame, the older frame is dropped: the newest
+# frame always wins.
+
+# Key functions:
+
+#   publish(colorarray):
+#     Hand the newest frame to the writer.  Never waits on the serial link.
+#     Returns False if the writer stopped because of a serial error.
+
+#   stats( ):
+#     Counters for published, written and dropped frames, the number of
+#     frames waiting (0 or 1), bytes written, the write latency (from
+#     publish until the frame has left the serial port) and the write time
+#     (a running average of how long encoding and sending one frame takes)
+#     in seconds.
+
+#   setMetrics(metrics, labels):
+#     Count the frames the writer drops in a metrics.Metrics.
+
+#   stop( ):
+#     Sends the last published frame and stops the thread.
+
+class SerialFrameWriter(threading.Thread):
+
+    def __init__(self, serialmgr, numleds):
+
+        threading.Thread.__init__(self, name="SerialFrameWriter")
+        self.daemon = True
+
+        self.serialmgr = serialmgr
+        self.condition = threading.Condition()
+
+        # publish() copies into the front buffer, the writer sends from the
+        # back buffer.  Single precision like the colorarray.
+        self.frontbuffer = numpy.zeros([numleds, 3], dtype=numpy.float32)
+        self.backbuffer = numpy.zeros([numleds, 3], dtype=numpy.float32)
+        self.pending = False
+        self.publishedAt = 0.
+        self.running = True
+        self.error = None
+
+        self.framesPublished = 0
+        self.framesWritten = 0
+        self.framesDropped = 0
+        self.bytesWritten = 0
+        self.lastWriteLatency = 0.
+        self.maxWriteLatency = 0.
+        self.totalWriteLatency = 0.
+        self.writeTime = 0.
+
+        self.metrics = None
+
+    def setMetrics(self, metrics, labels=None):
+
+        self.metrics = metrics
+        self.droppedCounter = metrics.counter("serial_frames_dropped_total",
+                                              "Frames replaced by a newer "
+                                              "one before they were sent",
+                                              labels)
+
+    def publish(self, colorarray):
+
+        with self.condition:
+
+            if self.error is not None:
+                return False
+
+            if self.pending:
+                self.framesDropped += 1
+                if self.metrics:
+                    self.droppedCounter.inc()
+
+            if self.frontbuffer.shape != colorarray.shape:
+                self.frontbuffer = numpy.zeros(colorarray.shape,
+                                               dtype=numpy.float32)
+
+            self.frontbuffer[...] = colorarray
+            self.pending = True
+            self.publishedAt = time.time()
+            self.framesPublished += 1
+
+            self.condition.notify()
+
+        return True
+
+    def queueDepth(self):
+        return 1 if self.pending else 0
+
+    def stats(self):
+
+        with self.condition:
+            return {
+                'published': self.framesPublished,
+                'written': self.framesWritten,
+                'dropped': self.framesDropped,
+                'queuedepth': self.queueDepth(),
+                'bytes': self.bytesWritten,
+                'lastlatency': self.lastWriteLatency,
+                'maxlatency': self.maxWriteLatency,
+                'avglatency': (self.totalWriteLatency /
+                               max(self.framesWritten, 1)),
+                'writetime': self.writeTime,
+            }
+
+    def run(self):
+
+        while True:
+
+            with self.condition:
+
+                while self.running and not self.pending:
+                    self.condition.wait()
+
+                if not self.pending:
+                    return
+
+                self.frontbuffer, self.backbuffer = (self.backbuffer,
+                                                     self.frontbuffer)
+                self.pending = False
+                publishedAt = self.publishedAt
+
+            writeStart = time.time()
+            try:
+                frameData = self.serialmgr.EncodeColors(self.backbuffer)
+                self.serialmgr.SendColorBytes(frameData)
+
+            except Exception, e:
+                print "Serial writer stopped: %s" % str(e)
+                with self.condition:
+                    self.error = e
+                return
+
+            writeEnd = time.time()
+            latency = writeEnd - publishedAt
+
+            with self.condition:
+                self.framesWritten += 1
+                self.bytesWritten += len(frameData)
+                self.lastWriteLatency = latency
+                self.maxWriteLatency = max(self.maxWriteLatency, latency)
+                self.totalWriteLatency += latency
+                self.writeTime += .1 * (writeEnd - writeStart - self.writeTime)
+
+    def stop(self, timeout=1.):
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.join(timeout)
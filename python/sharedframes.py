@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import multiprocessing
+import numpy
+
+# ------------------------------------------------------------------------
+# SHARED FRAME RING
+
+# A ring of frames in shared memory, written by one process and read by
+# others without pickling.  The memory is allocated before the processes
+# fork, so every process sees the same frames.
+#
+# A frame is a set of float arrays with fixed shapes (for example the color
+# array and the per pitch array).  Frames are numbered from 1 in the order
+# they are written and frame seq lives in slot (seq - 1) % numslots, so the
+# ring holds the last numslots frames.
+#
+# Every slot has a lock of its own, held by the writer while it fills the
+# slot and by a reader while it copies a frame out, so a reader never sees
+# half a frame.  Taking and releasing a lock are memory barriers, so this
+# holds on ARM as well, where the stores to shared memory can become
+# visible to the other processes out of order.  Frames are small and
+# copied in microseconds, so the writer and readers rarely wait on each
+# other, and never on more than one slot.
+
+# Key functions:
+
+#   write(*arrays):
+#     Write the next frame, returns its sequence number.
+
+#   readLatest(lastseq, *outs):
+#     Copy the newest frame into outs if it is newer than lastseq.  Returns
+#     its sequence number, or 0 when there is nothing newer.
+
+#   readNext(lastseq, *outs):
+#     Copy the oldest frame after lastseq that is still in the ring.  Frames
+#     that were already overwritten are skipped.  Returns its sequence
+#     number, or 0 when there is nothing newer.
+
+#   close( ) / isClosed( ):
+#     The writer closes the ring once it has written its last frame.
+
+# How long readers sleep between looking for a new frame
+POLL_SECONDS = .001
+
+# Layout of the control block
+_HEAD = 0
+_CLOSED = 1
+_SLOTS = 2
+
+class SharedFrameRing(object):
+
+    def __init__(self, shapes, numslots=8):
+
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.numslots = numslots
+
+        sizes = [int(numpy.prod(shape)) for shape in self.shapes]
+        framesize = sum(sizes)
+
+        self.data = multiprocessing.RawArray('d', numslots * framesize)
+        self.control = multiprocessing.RawArray('l', _SLOTS + numslots)
+
+        # numpy views of the shared memory, which stay valid in the forked
+        # processes
+        frames = numpy.frombuffer(self.data, dtype=float).reshape(
+            numslots, framesize)
+        offsets = numpy.cumsum([0] + sizes)
+
+        self.fields = [[frames[slot, offsets[i]:offsets[i + 1]].reshape(shape)
+                        for i, shape in enumerate(self.shapes)]
+                       for slot in range(numslots)]
+
+        control = numpy.frombuffer(self.control, dtype=numpy.dtype('l'))
+        self.header = control[:_SLOTS]
+        self.seqs = control[_SLOTS:_SLOTS + numslots]
+        self.locks = [multiprocessing.Lock() for slot in range(numslots)]
+
+    def head(self):
+        return int(self.header[_HEAD])
+
+    def close(self):
+        self.header[_CLOSED] = 1
+
+    def isClosed(self):
+        return bool(self.header[_CLOSED])
+
+    def write(self, *arrays):
+
+        seq = self.head() + 1
+        slot = (seq - 1) % self.numslots
+
+        with self.locks[slot]:
+            for field, array in zip(self.fields[slot], arrays):
+                field[...] = array
+            self.seqs[slot] = seq
+
+        self.header[_HEAD] = seq
+        return seq
+
+    def read(self, seq, *outs):
+
+        # Copy frame seq into outs, returns False when it is not in the ring
+        # (not written yet, or already overwritten)
+        slot = (seq - 1) % self.numslots
+
+        with self.locks[slot]:
+            if self.seqs[slot] != seq:
+                return False
+
+            for out, field in zip(outs, self.fields[slot]):
+                out[...] = field
+
+        return True
+
+    def readLatest(self, lastseq, *outs):
+
+        while True:
+            seq = self.head()
+            if seq <= lastseq:
+                return 0
+            if self.read(seq, *outs):
+                return seq
+
+    def readNext(self, lastseq, *outs):
+
+        while True:
+            head = self.head()
+
+            # the oldest slot is the next one to be overwritten, so leave it
+            seq = max(lastseq + 1, head - self.numslots + 2)
+            if seq > head:
+                return 0
+            if self.read(seq, *outs):
+                return seq
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+
+import os
+import time
+import mmap
+import struct
+import argparse
+import numpy
+
+import audiosource
+import sound2color
+
+# ------------------------------------------------------------------------
+# SHOW FILES
+
+# A show file is a recording of what a processor did every frame: the left
+# and right band amplitudes it read, the power of the beats it found in each
+# band (the beatstored values turned into beats that frame), the color ramp
+# and the colorarray quantized into bytes.  A show can be played back to the
+# lights without any audio, as fast as they take it, from any point in time,
+# or its band amplitudes can be fed back through the beat detection to
+# reproduce a run exactly.
+#
+# The file is a header followed by chunks of frames and an index of the
+# chunks.  Numbers are little endian.
+#
+#   header : 'S2LSHOW1' <version: 4 bytes> <number of bands: 4 bytes>
+#            <number of leds: 4 bytes> <frames per chunk: 4 bytes>
+#            <frames per second: float32>
+#   chunk  : 'CHNK' <number of frames: 4 bytes> and then the frames, each a
+#            fixed size record (see frameDtype):
+#              <seconds since the recording started: float64>
+#              <left and right band amplitudes: 2 * bands float32>
+#              <beat power per band: bands float32>
+#              <color ramp index: 1 byte>
+#              <color bytes: 3 * leds bytes>
+#   index  : for every chunk <file offset: 8 bytes> <first frame: 8 bytes>
+#            <number of frames: 4 bytes> <first and last seconds: 2 float64>
+#   trailer: <index offset: 8 bytes> <number of chunks: 4 bytes> 'S2LINDEX'
+#
+# The reader maps the file into memory and every chunk is a numpy view of
+# its records, so nothing is read or copied until a frame is used.  Seeking
+# is a binary search on the chunk times of the index and then on the frame
+# times of one chunk.  A recording that was cut short has no index, the
+# reader then finds the chunks by walking their headers and keeps every
+# complete frame.
+
+# Key functions:
+
+#   ShowRecorder.record(processor, timestamp):
+#     Append the frame the processor just rendered.  Set it as a processor's
+#     recorder and update() calls it every frame.
+
+#   ShowReader.frameAt(seconds) / frame(index):
+#     Find and read frames of a show.
+
+#   ShowPlayer.play(processor, ...) / seek(seconds):
+#     Stream the frames of a show to a processor's output(), at any speed.
+
+#   ShowAudioSource:
+#     An audio source that reads the band amplitudes of a show.
+
+SHOW_MAGIC = b"S2LSHOW1"
+CHUNK_MAGIC = b"CHNK"
+INDEX_MAGIC = b"S2LINDEX"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIIIf")
+CHUNK_HEADER = struct.Struct("<4sI")
+TRAILER = struct.Struct("<QI8s")
+
+INDEX_DTYPE = numpy.dtype([('offset', '<u8'), ('first', '<u8'),
+                           ('count', '<u4'), ('start', '<f8'),
+                           ('end', '<f8')])
+
+# 256 frames is a bit over 8 seconds at 30 fps
+FRAMES_PER_CHUNK = 256
+
+def frameDtype(numbands, numleds):
+    return numpy.dtype([('time', '<f8'),
+                        ('bands', '<f4', (2, numbands)),
+                        ('beats', '<f4', (numbands,)),
+                        ('ramp', 'u1'),
+                        ('colors', 'u1', (3 * numleds,))])
+
+# Writes a show file.  Frames are stamped with the clock, or with useClock
+# off, with their frame number at fps, for audio sources that run faster
+# than the clock such as audiosource.WaveFileAudioSource.
+
+class ShowRecorder(object):
+
+    def __init__(self, path, numbands, numleds, fps=30.,
+                 framesPerChunk=FRAMES_PER_CHUNK, useClock=True):
+
+        self.path = path
+        self.fps = fps
+        self.useClock = useClock
+        self.numbands = numbands
+        self.numleds = numleds
+        self.dtype = frameDtype(numbands, numleds)
+
+        # frames are gathered into a chunk that is written once it is full
+        self.chunk = numpy.zeros(framesPerChunk, dtype=self.dtype)
+        self.numchunkframes = 0
+        self.work = numpy.zeros(3 * numleds)
+
+        self.index = []
+        self.numframes = 0
+        self.starttime = None
+
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(SHOW_MAGIC, VERSION, numbands, numleds,
+                                    framesPerChunk, fps))
+
+    def record(self, processor, timestamp=None):
+
+        # timestamp is the seconds since the recording started, by default
+        # taken from the clock, or from the frame count at fps for sources
+        # that run faster than the clock
+        if timestamp is None and not self.useClock:
+            timestamp = (self.numframes + self.numchunkframes) / self.fps
+
+        elif timestamp is None:
+            now = time.time()
+            if self.starttime is None:
+                self.starttime = now
+            timestamp = now - self.starttime
+
+        frame = self.chunk[self.numchunkframes]
+        frame['time'] = timestamp
+        frame['bands'] = processor.bands
+        frame['beats'] = processor.beatamps
+        frame['ramp'] = processor.colorramps.index(processor.colorramp.name)
+
+        # quantized the same way as framecodec.ColorFrameEncoder does
+        numpy.floor(processor.colorarray.ravel(), out=self.work)
+        numpy.clip(self.work, 0, 255, out=self.work)
+        frame['colors'] = self.work
+
+        self.numchunkframes += 1
+        if self.numchunkframes == self.chunk.shape[0]:
+            self.flush()
+
+    def flush(self):
+
+        # Write the frames gathered so far as a chunk
+        if not self.numchunkframes:
+            return
+
+        frames = self.chunk[:self.numchunkframes]
+        self.index.append((self.file.tell(), self.numframes,
+                           self.numchunkframes, frames['time'][0],
+                           frames['time'][-1]))
+
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self.numchunkframes))
+        frames.tofile(self.file)
+        self.file.flush()
+
+        self.numframes += self.numchunkframes
+        self.numchunkframes = 0
+
+    def close(self):
+
+        if self.file.closed:
+            return
+
+        self.flush()
+
+        indexOffset = self.file.tell()
+        numpy.array(self.index, dtype=INDEX_DTYPE).tofile(self.file)
+        self.file.write(TRAILER.pack(indexOffset, len(self.index),
+                                     INDEX_MAGIC))
+        self.file.close()
+
+class ShowReader(object):
+
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, "rb")
+
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            raise Exception("[ %s ] is too short to be a show file" % path)
+
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.numbands, self.numleds, self.framesPerChunk,
+         self.fps) = HEADER.unpack_from(self.map, 0)
+
+        if magic != SHOW_MAGIC or version != VERSION:
+            raise Exception("[ %s ] is not a version %i show file" %
+                            (path, VERSION))
+
+        self.dtype = frameDtype(self.numbands, self.numleds)
+
+        self.index = self._readIndex(size)
+        if self.index is None:
+            self.index = self._scanChunks(size)
+
+        # a view of the records of every chunk, straight onto the map
+        self.chunks = [numpy.frombuffer(self.map, dtype=self.dtype,
+                                        count=int(entry['count']),
+                                        offset=int(entry['offset']) +
+                                        CHUNK_HEADER.size)
+                       for entry in self.index]
+
+        self.numframes = int(numpy.sum(self.index['count']))
+
+    def _readIndex(self, size):
+
+        # The index the recorder wrote at the end, or None when there is
+        # none
+        if size < HEADER.size + TRAILER.size:
+            return None
+
+        indexOffset, numchunks, magic = TRAILER.unpack_from(
+            self.map, size - TRAILER.size)
+        if (magic != INDEX_MAGIC or indexOffset + numchunks *
+                INDEX_DTYPE.itemsize + TRAILER.size != size):
+            return None
+
+        return numpy.frombuffer(self.map, dtype=INDEX_DTYPE, count=numchunks,
+                                offset=indexOffset).copy()
+
+    def _scanChunks(self, size):
+
+        # Rebuild the index of a recording that was cut short from the chunk
+        # headers, keeping the complete frames of a chunk cut in half
+        entries = []
+        offset = HEADER.size
+        first = 0
+
+        while offset + CHUNK_HEADER.size <= size:
+
+            magic, count = CHUNK_HEADER.unpack_from(self.map, offset)
+            if magic != CHUNK_MAGIC:
+                break
+
+            available = (size - offset - CHUNK_HEADER.size) // self.dtype.itemsize
+            count = min(count, available)
+            if not count:
+                break
+
+            times = numpy.frombuffer(self.map, dtype=self.dtype, count=count,
+                                     offset=offset + CHUNK_HEADER.size)['time']
+            entries.append((offset, first, count, times[0], times[-1]))
+
+            offset += CHUNK_HEADER.size + count * self.dtype.itemsize
+            first += count
+
+        return numpy.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return self.numframes
+
+    def duration(self):
+
+        if not self.numframes:
+            return 0.
+        return float(self.index['end'][-1] - self.index['start'][0])
+
+    def frame(self, index):
+
+        # The record of frame index, a view onto the map
+        chunk = numpy.searchsorted(self.index['first'], index,
+                                   side='right') - 1
+        return self.chunks[chunk][index - int(self.index['first'][chunk])]
+
+    def indexAt(self, seconds):
+
+        # The index of the first frame at or after seconds
+        chunk = numpy.searchsorted(self.index['end'], seconds)
+        if chunk >= len(self.chunks):
+            return self.numframes
+
+        within = numpy.searchsorted(self.chunks[chunk]['time'], seconds)
+        return int(self.index['first'][chunk]) + int(within)
+
+    def frameAt(self, seconds):
+        return self.frame(min(self.indexAt(seconds), self.numframes - 1))
+
+    def close(self):
+
+        # the views go first, they are not valid once the map is closed
+        self.chunks = []
+        self.map.close()
+        self.file.close()
+
+# Streams the frames of a show to a processor's output(), copying each
+# frame's colors into its colorarray and setting its color ramp.  With a
+# speed of 1 the frames go out at the times they were recorded at, 4 plays
+# them 4 times as fast and None as fast as output() takes them.  seek() can
+# be called from another thread while playing.  play() returns the number
+# of frames it played.
+#
+# Only the colors are recorded, so the terminal view of a processor the
+# show is played to stays blank.
+
+class ShowPlayer(object):
+
+    def __init__(self, reader):
+
+        self.reader = reader
+        self.position = 0
+        self.seekTo = None
+        self.framesPlayed = 0
+
+    def seek(self, seconds):
+        self.seekTo = seconds
+
+    def play(self, processor, start=0., end=None, speed=1.):
+
+        if processor.colorarray.shape[0] != self.reader.numleds:
+            raise Exception("The show has %i leds but the processor %i" %
+                            (self.reader.numleds, processor.colorarray.shape[0]))
+
+        colors = processor.colorarray.reshape(-1)
+        self.seek(start)
+        clockstart = showstart = None
+        played = 0
+
+        while True:
+
+            if self.seekTo is not None:
+                self.position = self.reader.indexAt(self.seekTo)
+                self.seekTo = None
+                clockstart = None
+
+            if self.position >= len(self.reader):
+                break
+
+            frame = self.reader.frame(self.position)
+            if end is not None and frame['time'] > end:
+                break
+
+            # wait until the frame is due
+            if speed:
+                if clockstart is None:
+                    clockstart, showstart = time.time(), frame['time']
+                wait = (clockstart + (frame['time'] - showstart) / speed -
+                        time.time())
+                if wait > 0.:
+                    time.sleep(wait)
+
+            colors[...] = frame['colors']
+            processor.colorramp = sound2color.colorramptable(
+                processor.colorramps[frame['ramp']])
+
+            processor.output()
+            self.position += 1
+            self.framesPlayed += 1
+            played += 1
+
+        return played
+
+# Reads the band amplitudes of a show, one frame per read, so a recording
+# can be run through the beat detection and rendering again.
+
+class ShowAudioSource(audiosource.AudioSource):
+
+    def __init__(self, reader, start=0.):
+
+        audiosource.AudioSource.__init__(self, reader.numbands)
+        self.reader = reader
+        self.position = reader.indexAt(start)
+        self.silence = numpy.zeros(reader.numbands)
+
+    def read(self):
+
+        if self.isFinished():
+            return self.silence, self.silence
+
+        bands = self.reader.frame(self.position)['bands']
+        self.position += 1
+        return bands[0].astype(float), bands[1].astype(float)
+
+    def isFinished(self):
+        return self.position >= len(self.reader)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Record a show from the "
+                                     "live audio or play one back")
+    subparsers = parser.add_subparsers(dest="command")
+
+    recordparser = subparsers.add_parser("record", help="record the live "
+                                         "audio until interrupted")
+    recordparser.add_argument("file")
+    recordparser.add_argument("--lights", action="store_true",
+                              help="send the colors to the lights as well")
+    recordparser.add_argument("--headless", action="store_true")
+
+    playparser = subparsers.add_parser("play", help="play a show to the "
+                                       "lights")
+    playparser.add_argument("file")
+    playparser.add_argument("--seek", type=float, default=0.,
+                            help="second of the show to start at")
+    playparser.add_argument("--end", type=float,
+                            help="second of the show to stop at")
+    playparser.add_argument("--speed", type=float, default=1.,
+                            help="how many times faster than recorded to "
+                            "play, 0 for as fast as the lights go")
+
+    infoparser = subparsers.add_parser("info", help="describe a show")
+    infoparser.add_argument("file")
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+
+        import framescheduler
+        import sound2light
+
+        if args.lights:
+            processor = sound2light.SoundToLightProcessor(
+                headless=args.headless)
+        else:
+            processor = sound2color.SoundToColorProcessor(
+                headless=args.headless)
+
+        # the lights only know how many leds they drive once connected
+        if args.lights:
+            processor.connect()
+
+        processor.recorder = ShowRecorder(args.file,
+                                          processor.NUM_FREQUENCY_BANDS,
+                                          processor.numleds)
+        processor.start(outputAudio=False)
+        scheduler = framescheduler.FrameScheduler(fps=30.)
+
+        try:
+            scheduler.run(processor)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            processor.shutdown()
+            processor.recorder.close()
+            print "Recorded %i frames to [ %s ]" % (
+                processor.recorder.numframes, args.file)
+
+    elif args.command == "play":
+
+        import sound2light
+
+        reader = ShowReader(args.file)
+        processor = sound2light.SoundToLightProcessor(
+            audiosource.AudioSource(reader.numbands), headless=True,
+            numleds=reader.numleds)
+        processor.start()
+
+        player = ShowPlayer(reader)
+        try:
+            player.play(processor, args.seek, args.end, args.speed or None)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            processor.shutdown()
+            reader.close()
+            print "Played %i frames" % player.framesPlayed
+
+    else:
+
+        reader = ShowReader(args.file)
+        print ("[ %s ] %i frames in %i chunks, %.1f seconds, %i bands, "
+               "%i leds, %i bytes per frame" % (
+                   args.file, len(reader), len(reader.chunks),
+                   reader.duration(), reader.numbands, reader.numleds,
+                   reader.dtype.itemsize))
+        reader.close()
@@ -5,10 +5,9 @@ import sys
 import numpy
 import time
 import math
-import curses
+import threading
 
-# requires pyo: https://code.google.com/p/pyo/
-from pyo import *
+import audiosource
 
 # ------------------------------------------------------------------------
 # SIGNAL UTILITIES
@@ -19,8 +18,9 @@ def clamp(val, bottom, top):
 def clampedmix(bottom, top, x):
     return clamp(bottom * (1. - x) + top * x, bottom, top)
 
+# Works on single values as well as whole numpy arrays of values
 def smoothstep(val, bottom, top):
-    t = (clamp(val, bottom, top) - bottom) / (top - bottom);
+    t = (numpy.clip(val, bottom, top) - bottom) / (top - bottom);
     return 3*t*t - 2*t*t*t;
 
 def smoothremap(val, bottom, top, targetbottom, targettop):
@@ -32,10 +32,11 @@ def smoothremap(val, bottom, top, targetbottom, targettop):
 
 # Have a smooth ramped color gradient that has 2 knots at the extremes 
 # (val=0 and val=1) and 2 floating knots that can be at any location
-# in between.
+# in between.  val can be a single value (returns one color) or an array
+# of values (returns one color per value).
 def colorgrad4(c1, c2, l1, c3, l2, c4, val):
 
-    result = numpy.array([0., 0., 0.])
+    val = numpy.asarray(val, dtype=float)[..., numpy.newaxis]
 
     v1 = smoothremap(val, 0., l1, 0., 1.)
     result = c1 * (1. - v1) + c2 * v1
@@ -45,43 +46,370 @@ def colorgrad4(c1, c2, l1, c3, l2, c4, val):
     result = result * (1. - v3) + c4 * v3
     return result
 
+# The knots of the ramps below, as the colorgrad4 arguments before val.
+# They are built once here rather than on every call.
+FIRE_RAMP_KNOTS = (numpy.array([255, 2, 49]),
+                   numpy.array([204, 82, 6]), .22,
+                   numpy.array([226, 159, 2]), .53,
+                   numpy.array([232, 249, 247]))
+
+RGB_RAMP_KNOTS = (numpy.array([255, 1, 1]),
+                  numpy.array([1, 255, 1]), .45,
+                  numpy.array([1, 255, 1]), .55,
+                  numpy.array([1, 1, 255]))
+
+RED_TO_BLUE_RAMP_KNOTS = (numpy.array([255, 1, 1]),
+                          numpy.array([128, 1, 129]), .3,
+                          numpy.array([20, 1, 250]), .55,
+                          numpy.array([1, 1, 255]))
+
+AQUA_BLUE_RAMP_KNOTS = (numpy.array([105, 177, 244]),
+                        numpy.array([12, 46, 242]), .25,
+                        numpy.array([98, 88, 239]), .71,
+                        numpy.array([138, 147, 247]))
+
 # Returns a firey color given a value betweeen 0 and 1
 def fireramp(val):
-    return colorgrad4(numpy.array([255, 2, 49]),
-                 numpy.array([204, 82, 6]), .22,
-                 numpy.array([226, 159, 2]), .53,
-                 numpy.array([232, 249, 247]),
-                 val)
+    return colorgrad4(*FIRE_RAMP_KNOTS, val=val)
 
 # Returns a classic red->green->blue color given a value betweeen 
 # 0 and 1
 def rgbramp(val):
-    return colorgrad4(numpy.array([255, 1, 1]),
-                 numpy.array([1, 255, 1]), .45,
-                 numpy.array([1, 255, 1]), .55,
-                 numpy.array([1, 1, 255]),
-                 val)
+    return colorgrad4(*RGB_RAMP_KNOTS, val=val)
 
 # Returns a red->purple->blue color given a value betweeen 0 and 1
 def redtoblueramp(val):
-    return colorgrad4(numpy.array([255, 1, 1]),
-                 numpy.array([128, 1, 129]), .3,
-                 numpy.array([20, 1, 250]), .55,
-                 numpy.array([1, 1, 255]),
-                 val)
+    return colorgrad4(*RED_TO_BLUE_RAMP_KNOTS, val=val)
 
 # Returns a subtle ramp through an aqua blue given a value betweeen 0 and 1
 def aquablueramp(val):
-    return colorgrad4(numpy.array([105, 177, 244]),
-                 numpy.array([12, 46, 242]), .25,
-                 numpy.array([98, 88, 239]), .71,
-                 numpy.array([138, 147, 247]),
-                 val)
+    return colorgrad4(*AQUA_BLUE_RAMP_KNOTS, val=val)
+
+# ------------------------------------------------------------------------
+# COLOR RAMP TABLES
+
+# Color ramps are baked into lookup tables once so that coloring beats in
+# the frame loop is a single array lookup no matter how expensive the ramp
+# function is.  Add your own ramps with registercolorramp().
+
+# The default number of entries in a baked table.  A multiple of 16 plus 1
+# puts every one of the 16 pitch bands exactly on a table entry.
+COLOR_RAMP_RESOLUTION = 257
+
+# Registered ramp functions by name, and the tables baked from them
+COLOR_RAMPS = {}
+_COLOR_RAMP_TABLES = {}
+
+class ColorRampTable(object):
+
+    def __init__(self, name, rampfunc, resolution=COLOR_RAMP_RESOLUTION):
+
+        self.name = name
+        self.resolution = resolution
+        self.table = rampfunc(numpy.linspace(0., 1., resolution))
+
+    def lookup(self, vals):
+
+        # Returns one color per value in vals (values between 0 and 1),
+        # linearly interpolating between the baked entries.
+        pos = numpy.clip(numpy.asarray(vals, dtype=float), 0., 1.)
+        pos *= self.resolution - 1
+
+        lo = numpy.minimum(pos.astype(int), self.resolution - 2)
+        frac = (pos - lo)[..., numpy.newaxis]
+        return self.table[lo] * (1. - frac) + self.table[lo + 1] * frac
+
+def registercolorramp(name, rampfunc):
+
+    COLOR_RAMPS[name] = rampfunc
+
+    # drop any tables baked from a ramp that used to have this name
+    for key in _COLOR_RAMP_TABLES.keys():
+        if key[0] == name:
+            del _COLOR_RAMP_TABLES[key]
+
+def colorramptable(name, resolution=COLOR_RAMP_RESOLUTION):
+
+    key = (name, resolution)
+    if key not in _COLOR_RAMP_TABLES:
+        _COLOR_RAMP_TABLES[key] = ColorRampTable(name, COLOR_RAMPS[name], 
+                                                 resolution)
+
+    return _COLOR_RAMP_TABLES[key]
+
+for rampfunc in (fireramp, rgbramp, redtoblueramp, aquablueramp):
+    registercolorramp(rampfunc.func_name, rampfunc)
+
+# ------------------------------------------------------------------------
+# FRAME BUFFERS
+
+# The colorarray, the perpitcharray, the beats and the other buffers of a
+# frame hold single precision floats, which is plenty for colors between 0
+# and 255 and halves the memory the frame loop goes through.  They are all
+# allocated up front and every frame works into them in place.
+FRAME_DTYPE = numpy.float32
+
+# ------------------------------------------------------------------------
+# HISTORY UTILITIES
+
+# Circular history of the last numsamples values of every band.  A running
+# sum and sum of squares are kept per band so that pushing a sample and
+# reading the mean and variance cost the same no matter how long the 
+# history is.  mean() and variance() work into out when it is given, so
+# the frame loop can reuse its buffers.
+#
+# Unlike the frame buffers the history stays in double precision: the
+# variance is the difference of two close sums of squares, which single
+# precision would mostly cancel away.
+class EnergyHistory(object):
+
+    def __init__(self, numbands, numsamples):
+
+        self.samples = numpy.zeros([numbands, numsamples])
+        self.head = 0
+        self.count = 0
+
+        self.sums = numpy.zeros(numbands)
+        self.sumsquares = numpy.zeros(numbands)
+
+        # work buffers for push() and variance()
+        self.work = numpy.zeros([2, numbands])
+        self.meanwork = numpy.zeros(numbands)
+
+    def isFull(self):
+        return self.count == self.samples.shape[1]
+
+    def push(self, values):
+
+        oldest = self.samples[:, self.head]
+        newwork, oldwork = self.work
+
+        numpy.subtract(values, oldest, out=newwork)
+        self.sums += newwork
+
+        numpy.multiply(values, values, out=newwork)
+        numpy.multiply(oldest, oldest, out=oldwork)
+        newwork -= oldwork
+        self.sumsquares += newwork
+
+        oldest[...] = values
+
+        self.head = (self.head + 1) % self.samples.shape[1]
+        self.count = min(self.count + 1, self.samples.shape[1])
+
+        # The running sums slowly pick up floating point error, so re-sum
+        # them every time we wrap around the history.
+        if self.head == 0:
+            numpy.sum(self.samples, axis=1, out=self.sums)
+            numpy.einsum('ij,ij->i', self.samples, self.samples,
+                         out=self.sumsquares)
+
+    def mean(self, out=None):
+        return numpy.divide(self.sums, max(self.count, 1), out=out)
+
+    def variance(self, out=None):
+        mean = self.mean(self.meanwork)
+        mean *= mean
+        out = numpy.divide(self.sumsquares, max(self.count, 1), out=out)
+        out -= mean
+        return numpy.maximum(out, 0., out=out)
+
+# Fixed capacity pool of beats.  The newest beat sits at head and the 
+# following slots (wrapping around) hold older and older beats, so adding
+# a beat just moves head back one slot and overwrites the oldest beat.
+class BeatPool(object):
+
+    def __init__(self, capacity, dtype=FRAME_DTYPE):
+
+        # each beat captures        
+        # 0 index := position on the slider of the current beat
+        # 1 index := power/velocity of the current beat
+        # 2 index := [0,NUM_FREQUENCY_BANDS] value that captures the pitch of 
+        #     the beat (lower value means more of a bass)
+        self.beats = numpy.zeros([capacity, 3], dtype=dtype)
+        self.head = 0
+
+        # slot offsets from head, and the slots addMany() writes and order()
+        # returns
+        self.offsets = numpy.arange(capacity)
+        self.addslots = numpy.zeros(capacity, dtype=numpy.intp)
+        self.orderslots = numpy.zeros(capacity, dtype=numpy.intp)
+
+    def add(self, power, pitch):
+
+        self.head = (self.head - 1) % self.beats.shape[0]
+        self.beats[self.head] = (0., power, pitch)
+
+    def addMany(self, powers, pitches):
+
+        # Same as calling add() for every power and pitch in order
+        capacity = self.beats.shape[0]
+
+        # only the newest capacity beats would survive
+        skip = len(powers) - capacity
+        if skip > 0:
+            self.head = (self.head - skip) % capacity
+            powers, pitches = powers[skip:], pitches[skip:]
+
+        slots = self.addslots[:len(powers)]
+        numpy.subtract(self.head - 1, self.offsets[:len(powers)], out=slots)
+        numpy.remainder(slots, capacity, out=slots)
+
+        self.beats[slots, 0] = 0.
+        self.beats[slots, 1] = powers
+        self.beats[slots, 2] = pitches
+
+        self.head = (self.head - len(powers)) % capacity
+
+    def order(self):
+
+        # Indices of the beats from newest to oldest.  The array is reused
+        # by the next call.
+        numpy.add(self.offsets, self.head, out=self.orderslots)
+        return numpy.remainder(self.orderslots, self.beats.shape[0],
+                               out=self.orderslots)
+
+# ------------------------------------------------------------------------
+# BEAT WAVE UTILITIES
+
+# Work buffers of renderbeatwave for a beat capacity, strip length and
+# number of pitch bands, so that rendering a frame works in place.  Every
+# beat of the pool is worked on, the beats that are not live are drawn to
+# a spare led past the end of the strip and a spare perpitcharray cell.
+class BeatWaveBuffers(object):
+
+    def __init__(self, capacity, numleds, numbands):
+
+        self.capacity = capacity
+        self.numleds = numleds
+        self.numbands = numbands
+
+        self.live = numpy.zeros(capacity, dtype=bool)
+        self.dead = numpy.zeros([capacity, 1], dtype=bool)
+        self.positions = numpy.zeros(capacity, dtype=numpy.intp)
+        self.pitches = numpy.zeros([capacity, 1], dtype=numpy.intp)
+        self.steps = numpy.zeros(capacity, dtype=FRAME_DTYPE)
+
+        # the right and left led of every beat and its perpitcharray cells,
+        # as stored and in the order drawn, and the powers drawn in them
+        self.leds = numpy.zeros([capacity, 2], dtype=numpy.intp)
+        self.cells = numpy.zeros([capacity, 2], dtype=numpy.intp)
+        self.drawncells = numpy.zeros([capacity, 2], dtype=numpy.intp)
+        self.powers = numpy.zeros([capacity, 2], dtype=FRAME_DTYPE)
+        self.drawnpowers = numpy.zeros([capacity, 2], dtype=FRAME_DTYPE)
+        self.perpitch = numpy.zeros(numbands * numleds + 1, dtype=FRAME_DTYPE)
+
+        # how many beats sit on every led with every pitch, and the sum of
+        # their colors per led
+        self.hits = numpy.zeros([numleds + 1, numbands], dtype=FRAME_DTYPE)
+        self.beatcolors = numpy.zeros([numbands, 3], dtype=FRAME_DTYPE)
+        self.centercolors = numpy.zeros([numleds + 1, 3], dtype=FRAME_DTYPE)
+
+    def fits(self, beatwave, perpitcharray):
+        return (self.capacity == beatwave.shape[0] and
+                (self.numbands, self.numleds) == perpitcharray.shape)
+
+# Render every live beat in the beatwave onto the colorarray and the
+# perpitcharray in one batch of array operations, then move each live beat
+# along the strip and slow it down.  beatcolors holds one color per pitch
+# band and kernelweight is the weight of each of the 3 spread leds.  order
+# gives the order the beats are drawn in (see BeatPool.order) and defaults
+# to the order of the rows in the beatwave.  buffers are the
+# BeatWaveBuffers to work in, made up for the call when not given.
+#
+# The strip geometry comes from the shape of the colorarray, so this works
+# for any number of leds: beats start at the 2 center leds and travel out
+# to both ends in a mirrored way.
+def renderbeatwave(beatwave, beatcolors, colorarray, perpitcharray,
+                   kernelweight, order=None, buffers=None):
+
+    numleds = colorarray.shape[0]
+    numbands = perpitcharray.shape[0]
+    center = numleds // 2
+    maxpos = center - 1
+
+    if buffers is None or not buffers.fits(beatwave, perpitcharray):
+        buffers = BeatWaveBuffers(beatwave.shape[0], numleds, numbands)
+
+    positions = beatwave[:, 0]
+    powers = beatwave[:, 1]
+
+    numpy.greater(powers, 0., out=buffers.live)
+    numpy.logical_not(buffers.live[:, numpy.newaxis], out=buffers.dead)
+
+    # The right and left led for each beat
+    numpy.copyto(buffers.positions, positions, casting='unsafe')
+    numpy.clip(buffers.positions, 0, maxpos, out=buffers.positions)
+    numpy.copyto(buffers.pitches[:, 0], beatwave[:, 2], casting='unsafe')
+
+    leds = buffers.leds
+    numpy.add(buffers.positions, center, out=leds[:, 0])
+    numpy.subtract(maxpos, buffers.positions, out=leds[:, 1])
+
+    cells = buffers.cells
+    numpy.multiply(buffers.pitches, numleds, out=cells)
+    cells += leds
+    numpy.copyto(cells, numbands * numleds, where=buffers.dead)
+    numpy.copyto(leds, numleds, where=buffers.dead)
+
+    # When several beats land on the same pitch and led, the last beat drawn
+    # wins: put() writes the cells one after the other.  (take() only works
+    # straight into out with a mode other than 'raise'.)
+    buffers.powers[...] = powers[:, numpy.newaxis]
+    if order is None:
+        buffers.drawncells[...] = cells
+        buffers.drawnpowers[...] = buffers.powers
+    else:
+        numpy.take(cells, order, axis=0, out=buffers.drawncells,
+                   mode='clip')
+        numpy.take(buffers.powers, order, axis=0,
+                   out=buffers.drawnpowers, mode='clip')
+
+    buffers.perpitch.fill(0)
+    numpy.put(buffers.perpitch, buffers.drawncells, buffers.drawnpowers)
+    perpitcharray[...] = buffers.perpitch[:-1].reshape(perpitcharray.shape)
+
+    # Count the beats of every pitch on every led, which colors each led
+    # with one matrix product.  The count is the one temporary of a frame:
+    # the only scatter add numpy has that works in place (ufunc.at) is many
+    # times slower.
+    leds *= numbands
+    leds += buffers.pitches
+    numpy.copyto(buffers.hits.reshape(-1), numpy.bincount(
+        leds.reshape(-1), minlength=buffers.hits.size))
+
+    buffers.beatcolors[...] = beatcolors
+    numpy.dot(buffers.hits, buffers.beatcolors, out=buffers.centercolors)
+
+    # Spread each beat across its led and the 2 next to it
+    centercolors = buffers.centercolors[:numleds]
+    colorarray[...] = centercolors
+    colorarray[1:] += centercolors[:-1]
+    colorarray[:-1] += centercolors[1:]
+    colorarray *= kernelweight
+
+    # update the beatwave position with the velocity/power of the beat
+    # slow down the power of the beat at every update using a "drag" plus
+    # plus a small constant.  Beats that are not live keep a power of 0.
+    numpy.multiply(powers, 3., out=buffers.steps)
+    positions += buffers.steps
+    numpy.clip(positions, 0, maxpos, out=positions)
+
+    powers *= .92
+    powers -= .01
+    numpy.maximum(powers, 0., out=powers)
 
 # ------------------------------------------------------------------------
 # Base class used for processing sound coming through soundflower and turning
-# into a 50 color array.  This 50 color array is abstract in this class but
-# can be pushed out to a light display by implementing output().
+# into an array of numleds colors (50 by default).  This color array is
+# abstract in this class but can be pushed out to a light display by
+# implementing output().  The sound comes from an audiosource.AudioSource,
+# by default the live pyo input, but a file or numpy array can be analyzed
+# instead (see audiosource.py).
+#
+# Building a processor only allocates its buffers.  The audio server and
+# the curses terminal view come up in start(), so processors can be built
+# cheaply (and handed to other processes) without touching the hardware.
 
 # Key functions:
 
@@ -101,291 +429,399 @@ def aquablueramp(val):
 #   update( ): <-- can override to change how audio is processed
 #     Called at each time step to update the internal color array state based on
 #     the state of the audio server.  update is where the beat detection happen.
+#     It is analyze( ) followed by render( ): analyze reads the audio source
+#     and finds the beats, render turns the beats found since the last render
+#     into colors.  They can run on different threads, see audioblocks.py.
 #
 
 #   output( ): <-- can override to output to more than just text to the terminal
 #      Called at each time step to push the colorarray data to a meaningful output
-#      The default implementation prints to the terminal.  You can see that in
+#      The default implementation hands it to the terminal view, or does nothing
+#      when headless.  You can see that in
 #      sound2light, there is an output function in the subclass
 #      SoundToLightProcessor that extends output() to send serial messages to the
 #      arduino
 
-class SoundToColorProcessor(object):
-
-    NUM_FREQUENCY_BANDS = 16
-    NUM_AVERAGE_SAMPLES = 40
-
-    def __init__(self):
+#   recorder:
+#      Set it to a showfile.ShowRecorder to record every frame update()
+#      renders, see showfile.py.
 
-        self.beatstored = numpy.ndarray(SoundToColorProcessor.NUM_FREQUENCY_BANDS) 
-        self.colorarray = numpy.zeros([50,3])
-        self.perpitcharray = numpy.zeros([SoundToColorProcessor.NUM_FREQUENCY_BANDS,50])
+#   effects:
+#      Set it to an effects.EffectStack to draw its layers (fire, rainbow, vu
+#      meters, ...) blended with the beat pulse, see effects.py.  Without it
+#      update() draws the beat pulse alone.
 
-        # allow up to 300 beats, each beat captures        
-        # 0 index := position on the slider of the current beat
-        # 1 index := power/velocity of the current beat
-        # 2 index := [0,NUM_FREQUENCY_BANDS] value that captures the pitch of 
-        #     the beat (lower value means more of a bass)
-
-        self.beatwave = numpy.zeros([300,3])
-
-        self.stdscr = curses.initscr()
-        curses.start_color()
-        curses.noecho()
-        curses.cbreak()
-
-        # This is the pyo sound server that will be grabbing color from the 
-        # soundflower input.
-        self.server = Server(sr=44100, nchnls=2, buffersize=1024)
+#   setMetrics(metrics):
+#      Time the stages of every frame into a metrics.Metrics, see metrics.py.
+#      Without it nothing is timed.
 
-        self.inputDeviceIdx = -1;
-        self.outputDeviceIdx = -1;
-
-        inputs, outputs = pa_get_devices_infos()
-        for idx,info in inputs.iteritems():
-            sound2color2ch = 'Soundflower (2ch)'
-            if sound2color2ch == info.get('name', None):
-                print "Found input device ( %(sound2color2ch)s ]: %(idx)i " % locals()
-                self.inputDeviceIdx = idx
-
-        for idx,info in outputs.iteritems():      
-            builtinOutput = 'Built-in Output'      
-            if 'Built-in Output' == info.get('name', None):
-                print "Found input device [ %(builtinOutput)s ]: %(idx)i " % locals()
-                self.outputDeviceIdx = idx
+#   outputPeriod( ):
+#      How many seconds the output link needs per frame, which caps the frame
+#      rate the framescheduler.FrameScheduler aims for.  0 when output() is
+#      not held up by anything but its own work.
 
+class SoundToColorProcessor(object):
 
-        self.server.setInputDevice(self.inputDeviceIdx)
-        self.server.setOutputDevice(self.outputDeviceIdx)
+    NUM_FREQUENCY_BANDS = 16
+    NUM_AVERAGE_SAMPLES = 40
+    BEAT_CAPACITY = 300
+    NUM_LEDS = 50
+
+    COLOR_RAMP_SECONDS = 30.
+    COLOR_RAMP_CROSSFADE_SECONDS = 5.
+
+    # how often the terminal view redraws
+    TERMINAL_VIEW_FPS = 10.
+
+    # how beats are found: 'energy' compares the energy of every band with
+    # its recent average, 'flux' finds the onsets in the raw samples (see
+    # onsetdetection.py), which reacts faster but needs an audio source
+    # that has the samples
+    BEAT_ENGINES = ['energy', 'flux']
+    BEAT_ENGINE = 'energy'
+
+    def __init__(self, source=None, headless=False, numleds=None,
+                 beatengine=None):
+
+        self.numleds = numleds or self.NUM_LEDS
+
+        self.beatengine = beatengine or self.BEAT_ENGINE
+        if self.beatengine not in self.BEAT_ENGINES:
+            raise Exception("Unknown beat engine [ %s ], use one of %s" %
+                            (self.beatengine, self.BEAT_ENGINES))
+        self.onsetdetector = None
+
+        self.beatstored = numpy.zeros(self.NUM_FREQUENCY_BANDS) 
+
+        # work buffers of the energy beat engine
+        self.energyinsts = numpy.zeros(self.NUM_FREQUENCY_BANDS)
+        self.energyavgs = numpy.zeros(self.NUM_FREQUENCY_BANDS)
+        self.thresholds = numpy.zeros(self.NUM_FREQUENCY_BANDS)
+        self.beatratios = numpy.zeros(self.NUM_FREQUENCY_BANDS)
+        self.beatsfound = numpy.zeros(self.NUM_FREQUENCY_BANDS, dtype=bool)
+
+        # guards beatstored, which analyze() adds the beats it finds to and
+        # render() takes them from
+        self.beatlock = threading.Lock()
+
+        # the band amplitudes read and the beat powers found in the last
+        # update, and the showfile.ShowRecorder that records every frame
+        self.bands = numpy.zeros([2, self.NUM_FREQUENCY_BANDS],
+                                 dtype=FRAME_DTYPE)
+        self.beatamps = numpy.zeros(self.NUM_FREQUENCY_BANDS,
+                                    dtype=FRAME_DTYPE)
+
+        # the powers of the new beats of a frame, worked out in place, and
+        # the pitch of each
+        self.beatpowers = numpy.zeros([2, self.NUM_FREQUENCY_BANDS],
+                                      dtype=FRAME_DTYPE)
+        self.pitchbands = numpy.arange(self.NUM_FREQUENCY_BANDS)
+        self.recorder = None
+
+        # the effects.EffectStack drawn instead of the beat pulse alone
+        self.effects = None
+
+        # the metrics.Metrics the stages are timed into, see setMetrics
+        self.metrics = None
+
+        # allow up to BEAT_CAPACITY beats, see BeatPool for what each beat
+        # captures.  self.beatwave is the pool's array of beats.
+        self.beatpool = BeatPool(self.BEAT_CAPACITY)
+        self.beatwave = self.beatpool.beats
+        self._allocateLeds(self.numleds)
+
+        # Unless headless, a terminalview.TerminalView thread draws the
+        # ascii display of what output() hands it, from start() on.
+        # Headless never touches curses at all.
+        self.headless = headless
+        self.view = None
+
+        # This is the audio source that we will be grabbing color from, by
+        # default a pyo server listening to the soundflower input, which is
+        # only brought up by start().
+        if source is None:
+            source = audiosource.PyoAudioSource(
+                numbands=self.NUM_FREQUENCY_BANDS)
+
+        self.audiosource = source
+
+        # the clock the color ramps change by, the frame count instead of
+        # time.time when rendering faster than real time (see prerender.py)
+        self.clock = time.time
+        self.starttime = self.clock()
+
+        # These are the color ramps that we will cycle through to process the
+        # sound beats into color based on pitch.  self.colorramp is the table
+        # currently showing and self.beatcolors holds its color for each pitch.
+        # The colors of every pitch are looked up once per ramp table.
+        self.colorramps = ['fireramp', 'aquablueramp', 'redtoblueramp', 
+                           'rgbramp']
+        self.colorramp = colorramptable(self.colorramps[0])
+
+        self.pitchvalues = (numpy.arange(self.NUM_FREQUENCY_BANDS) /
+                            float(self.NUM_FREQUENCY_BANDS))
+        self.rampcolors = {}
+        self.beatcolors = numpy.array(self._rampColors(self.colorramp))
+        self.fadecolors = numpy.zeros_like(self.beatcolors)
+
+    def _allocateLeds(self, numleds):
+
+        # The buffers of a frame that have a color or cell for every led
+        self.numleds = numleds
+        self.colorarray = numpy.zeros([numleds, 3], dtype=FRAME_DTYPE)
+        self.perpitcharray = numpy.zeros([self.NUM_FREQUENCY_BANDS, numleds],
+                                         dtype=FRAME_DTYPE)
+        self.beatwavebuffers = BeatWaveBuffers(self.BEAT_CAPACITY, numleds,
+                                               self.NUM_FREQUENCY_BANDS)
+
+    def _initScreen(self):
+
+        if self.headless or self.view:
+            return
 
-        self.server.boot()
-        self.starttime = time.time()
+        # requires curses, which is only imported when there is a terminal
+        # view to draw
+        import terminalview
 
-        # This is the color ramp function that we will use to process the sound
-        # beats into color based on pitch.
-        self.colorramp = fireramp
+        self.view = terminalview.TerminalView(self.NUM_FREQUENCY_BANDS,
+            self.perpitcharray.shape[1], self.TERMINAL_VIEW_FPS)
 
     def start(self, outputAudio=False):
-        # Fire up the pyo sound server and prepare the audio inputs so that 
-        # it is split up into frequency bands.  Also create simple sound 
-        # analysis objects that we will use for beat detection.
+        # Fire up the audio source so that it is split up into frequency 
+        # bands.  Also create the energy history that we will use for beat
+        # detection.
 
         # beat detection algorithm inspired by:
         # http://archive.gamedev.net/archive/reference/programming/features/beatdetection/index.html
 
-        self.server.start()
+        self.audiosource.start(outputAudio)
+
+        # The view only takes over the terminal once we start, so a
+        # processor can be built in one process and started in another
+        self._initScreen()
+        if self.view:
+            self.view.start()
 
-        self.leftinput = Input(chnl=1)
-        self.rightinput = Input(chnl=0)
+        self.energyhistory = EnergyHistory(self.NUM_FREQUENCY_BANDS,
+            self.NUM_AVERAGE_SAMPLES)
 
-        self.leftbands = BandSplit(self.leftinput, 
-            num=SoundToColorProcessor.NUM_FREQUENCY_BANDS, min=20, max=18000)
-        self.rightbands = BandSplit(self.rightinput, 
-            num=SoundToColorProcessor.NUM_FREQUENCY_BANDS, min=20, max=18000)
+        if self.beatengine == 'flux':
+            self._startOnsetDetector()
 
-        self.leftinstamp = Average( Follower( self.leftbands ), size=1024 )
-        self.rightinstamp = Average( Follower( self.rightbands ), size=1024 )
+    def _startOnsetDetector(self):
 
-        self.energysamples = numpy.ndarray([SoundToColorProcessor.NUM_FREQUENCY_BANDS,
-            SoundToColorProcessor.NUM_AVERAGE_SAMPLES])
+        import onsetdetection
 
-        self.energysamples.fill(-1.)
+        if self.audiosource.newSamples() is None:
+            raise Exception("The flux beat engine needs the samples of the "
+                            "audio, which [ %s ] does not have" %
+                            self.audiosource.__class__.__name__)
 
-        if outputAudio:
-            self.leftinput.out(chnl=1)
-            self.rightinput.out(chnl=0)
+        self.onsetdetector = onsetdetection.SpectralFluxDetector(
+            self.NUM_FREQUENCY_BANDS,
+            getattr(self.audiosource, 'samplerate', 44100))
+
+    def _closeScreen(self):
+
+        # Stop the view, which hands the terminal back
+        if self.view:
+            self.view.stop()
 
     def shutdown(self):
         # Called when closing the app
-        curses.echo()
-        curses.nocbreak()
-        curses.endwin()      
+        self._closeScreen()
+        self.audiosource.shutdown()
 
     def _processBeat(self):
 
-        leftsamps = numpy.array(self.leftinstamp.get(all=True))
-        rightsamps = numpy.array(self.rightinstamp.get(all=True))
+        leftsamps, rightsamps = self.audiosource.read()
+        self.bands[0] = leftsamps
+        self.bands[1] = rightsamps
+
+        # keep the strongest onset seen in each band since the last update
+        if self.onsetdetector:
+            onsets = self.onsetdetector.process(self.audiosource.newSamples())
+            self._storeBeats(onsets)
+            return
 
-        energyinsts = leftsamps*leftsamps + rightsamps*rightsamps;
+        energyinsts = self.energyinsts
+        numpy.multiply(leftsamps, leftsamps, out=energyinsts)
+        numpy.multiply(rightsamps, rightsamps, out=self.beatratios)
+        energyinsts += self.beatratios
 
-        # right shift by 1 along the axis for number of samples, 
-        # there is a set of samples per band.
-        self.energysamples = numpy.roll(self.energysamples, 1, axis=1)
-        self.energysamples.transpose()[0] = energyinsts
+        # push the newest sample into the history kept for each band
+        self.energyhistory.push(energyinsts)
 
         # if we haven't buffered up NUM_AVERAGE_SAMPLES samples, then
         # we don't have enough data yet
-        if self.energysamples[0][-1] < 0.:
+        if not self.energyhistory.isFull():
             return
 
-        energyavgs = numpy.average(self.energysamples, axis=1)        
+        energyavgs = self.energyhistory.mean(self.energyavgs)
 
         # if the sound is so soft, then don't consider it worth
         # processing.
-        if numpy.max(energyavgs) < .00001:
+        if energyavgs.max() < .00001:
             return
 
-        variances = self.energysamples - energyavgs.reshape((energyavgs.shape[0],1))
-        variances *= variances;
+        # the thresholds are energyavgs * Cs, with Cs = -1000000 * Vs + 1.5
+        thresholds = self.energyhistory.variance(self.thresholds)
+        thresholds *= -1000000.
+        thresholds += 1.5
+        thresholds *= energyavgs
 
-        Vs = numpy.average(variances, axis=1)        
-        Cs = -1000000. * Vs + 1.5
+        # keep the strongest beat seen in each band since the last update
+        beats = numpy.greater(energyinsts, thresholds, out=self.beatsfound)
+        self.beatratios.fill(0.)
+        numpy.divide(energyinsts, thresholds, out=self.beatratios,
+                     where=beats)
+        self._storeBeats(self.beatratios)
 
-        currtime = time.time()
-        for i in range(energyinsts.shape[0]):
-            energyinst = energyinsts[i]
-            energyavg = energyavgs[i]
-            if ( energyinst > energyavg * Cs[i]):
-                energyratio = energyinst / (energyavg * Cs[i])
-                if (self.beatstored[i] < energyratio):
-                    self.beatstored[i] = energyratio
+    def _storeBeats(self, strengths):
+
+        # The beat lock is only held to merge the beats into beatstored, so
+        # render() never waits on the audio source or the detection
+        with self.beatlock:
+            numpy.maximum(self.beatstored, strengths, out=self.beatstored)
 
     def _addBeat(self, power, pitch):
 
         # shift another beat onto the queue
-        self.beatwave = numpy.roll(self.beatwave, 1, axis=0)
-
-        self.beatwave[0][0] = 0.;
-        self.beatwave[0][1] = power/100.;
-        self.beatwave[0][2] = pitch
+        self.beatpool.add(power/100., pitch)
 
     def _updateColorRamp(self):
-        elapsed = time.time() - self.starttime;
-
-        reltime = elapsed%120
-        if reltime <= 30:
-            self.colorramp = fireramp
-        elif reltime > 30 and reltime <= 60:
-            self.colorramp = aquablueramp
-        elif reltime > 60 and reltime <= 90:
-            self.colorramp = redtoblueramp
-        elif reltime > 90 and reltime <= 120:
-            self.colorramp = rgbramp
-
-    def update(self):
 
-        # Called during every frame color update to find beats across all 
-        # frequencies.  This will update the self.colorarray internal member
-        # data which stores the values of the 50 colors we play to push out 
-        # to the TLC controller
-
-        self._updateColorRamp()
-        self._processBeat()
+        # Show each color ramp for COLOR_RAMP_SECONDS and crossfade into the
+        # next one over the last COLOR_RAMP_CROSSFADE_SECONDS.
+        elapsed = self.clock() - self.starttime;
 
-        maxbeatpower = 0.;
-        maxbeatpitch = 0.;
-        for i in range(self.beatstored.shape[0]):        
-            amp = 0.
-            if self.beatstored[i] > 0.:
-                amp = self.beatstored[i]
-                self.beatstored[i] = 0.
+        rampidx = int(elapsed // self.COLOR_RAMP_SECONDS)
+        reltime = elapsed - rampidx * self.COLOR_RAMP_SECONDS
 
-            beatpower = smoothremap(amp, 1., 1.5, 0., 100.)
- 
-            self._addBeat(beatpower, i)
+        numramps = len(self.colorramps)
+        self.colorramp = colorramptable(self.colorramps[rampidx % numramps])
+        self.beatcolors[...] = self._rampColors(self.colorramp)
 
-        self.colorarray.fill(0)  
-        self.perpitcharray.fill(0)  
+        fadestart = (self.COLOR_RAMP_SECONDS - 
+                     self.COLOR_RAMP_CROSSFADE_SECONDS)
+        if reltime > fadestart:
+            nextramp = colorramptable(self.colorramps[(rampidx + 1) % numramps])
+            fade = smoothstep(reltime, fadestart, 
+                              self.COLOR_RAMP_SECONDS)
+            self.beatcolors *= 1. - fade
+            numpy.multiply(self._rampColors(nextramp), fade,
+                           out=self.fadecolors)
+            self.beatcolors += self.fadecolors
 
-        for i in range(self.beatwave.shape[0]):
+    def _rampColors(self, table):
 
-            beatpower = self.beatwave[i][1]
-            beatpitch = int(self.beatwave[i][2])
-            beatcolor = self.colorramp(float(beatpitch)/SoundToColorProcessor.NUM_FREQUENCY_BANDS)
+        # The color of every pitch band in a ramp table
+        if table not in self.rampcolors:
+            self.rampcolors[table] = table.lookup(
+                self.pitchvalues).astype(FRAME_DTYPE)
 
-            if beatpower > 0.:
-                beatpos = clamp(int(self.beatwave[i][0]), 0, 24)
+        return self.rampcolors[table]
 
-                self.perpitcharray[beatpitch][25 + beatpos] = beatpower;
-                self.perpitcharray[beatpitch][24 - beatpos] = beatpower;
+    def setMetrics(self, metrics):
 
-                redcolors = numpy.zeros(50)
-                greencolors = numpy.zeros(50)
-                bluecolors = numpy.zeros(50)
+        self.metrics = metrics
+        self.stageTimes = dict(
+            (stage, metrics.histogram("stage_seconds", "Seconds each stage "
+                                      "of a frame takes", {'stage': stage}))
+            for stage in ['beat', 'render', 'update'])
+        self.framesCounter = metrics.counter("frames_total", "Frames "
+                                             "rendered", rate=True)
 
-                # Have the beats travel from the center out to the left and right
-                # in a mirrored way
-                redcolors[25 + beatpos] = beatcolor[0]
-                redcolors[24 - beatpos] = beatcolor[0]
-
-                greencolors[25 + beatpos] = beatcolor[1]
-                greencolors[24 - beatpos] = beatcolor[1]
-                
-                bluecolors[25 + beatpos] = beatcolor[2]
-                bluecolors[24 - beatpos] = beatcolor[2]
-
-                # Spread the travelling beat across 3 color leds using a convolve
-                ckernel = 3. * (1./float(SoundToColorProcessor.NUM_FREQUENCY_BANDS)) * numpy.array([1., 1., 1.])
-
-                self.colorarray.transpose()[0] += numpy.convolve(redcolors, ckernel, mode="same")
-                self.colorarray.transpose()[1] += numpy.convolve(greencolors, ckernel, mode="same")
-                self.colorarray.transpose()[2] += numpy.convolve(bluecolors, ckernel, mode="same")              
-
-                # update the beatwave position with the velocity/power of the beat
-                # slow down the power of the beat at every update using a "drag" plus
-                # plus a small constant
-                self.beatwave[i][0] = clamp(self.beatwave[i][0] + 3. * self.beatwave[i][1], 0, 24)
-                self.beatwave[i][1] = max(0., self.beatwave[i][1] - .08 * self.beatwave[i][1] - .01);
+    def update(self):
 
-    def _getColorPair(self, idx):
+        # Called during every frame color update to find beats across all 
+        # frequencies.  This will update the self.colorarray internal member
+        # data which stores the values of the numleds colors we play to push out 
+        # to the TLC controller
 
-        coloridx = idx+1
-        fg, bg = curses.pair_content(coloridx)
-        if (fg + bg) == 0:
+        if self.metrics:
+            start = time.time()
 
-            nidx = float(idx)/SoundToColorProcessor.NUM_FREQUENCY_BANDS
-            fg = int(7 * nidx + 1)
-            bg = curses.COLOR_BLACK
+        self.analyze()
+        self.render()
 
-            curses.init_pair(coloridx, fg, bg)
+        if self.metrics:
+            self.stageTimes['update'].observe(time.time() - start)
 
-        return coloridx
+    def analyze(self):
 
-    def output(self):       
+        # Read the next band amplitudes from the audio source and keep the
+        # beats found in them until the next render().  Only the merge into
+        # the stored beats holds the beat lock, so it can run on its own
+        # thread (see audioblocks.py) without holding up render().
+        if self.metrics:
+            start = time.time()
 
-        ramptxt = "Color Ramp Name: %s" % self.colorramp.func_name
-        self.stdscr.addstr(0, 0, ramptxt) 
+        self._processBeat()
 
-        for pitchIdx in range(self.perpitcharray.shape[0]):
-            coloridx = self._getColorPair(pitchIdx)
-            ascii = "%(pitchIdx)i\t| " % locals()
+        if self.metrics:
+            self.stageTimes['beat'].observe(time.time() - start)
 
-            for ledIdx in range(self.perpitcharray.shape[1]-1,0,-1):
-                power = self.perpitcharray[pitchIdx][ledIdx]
+    def render(self):
 
-                if power < 0.1:
-                    ascii += "-"
-                elif power < 0.2:
-                    ascii += "*"
-                elif power < 0.3:
-                    ascii += "O"
-                elif power < 0.4:
-                    ascii += "0"
-                else:
-                    ascii += "@"
+        # Turn the beats found since the last render() into beat waves and
+        # render the colorarray
+        if self.metrics:
+            start = time.time()
 
-            ascii += " |\n"
-            self.stdscr.addstr(pitchIdx+1,0,ascii, curses.color_pair(coloridx))
+        self._updateColorRamp()
 
-        self.stdscr.refresh()
+        # turn the beats stored for every band into new beats on the queue
+        with self.beatlock:
+            self.beatamps[...] = self.beatstored
+            self.beatstored.fill(0.)
+
+        # the powers are smoothstep(amps, 1., 1.5), worked out in place
+        beatpowers, squares = self.beatpowers
+        numpy.clip(self.beatamps, 1., 1.5, out=beatpowers)
+        beatpowers -= 1.
+        beatpowers /= .5
+        numpy.multiply(beatpowers, beatpowers, out=squares)
+        beatpowers *= -2.
+        beatpowers += 3.
+        beatpowers *= squares
+        self.beatpool.addMany(beatpowers, self.pitchbands)
+
+        # Render all of the beats in the beatwave in a single batch, colored
+        # by the current color ramp.  Spread the travelling beat across 3 
+        # color leds.  With effects, the beats are one of its layers.
+        if self.effects:
+            self.effects.render(self, self.colorarray)
+        else:
+            kernelweight = 3. * (1./float(self.NUM_FREQUENCY_BANDS))
+            renderbeatwave(self.beatwave, self.beatcolors, self.colorarray,
+                           self.perpitcharray, kernelweight,
+                           self.beatpool.order(), self.beatwavebuffers)
+
+        if self.metrics:
+            self.stageTimes['render'].observe(time.time() - start)
+            self.framesCounter.inc()
+
+        if self.recorder:
+            self.recorder.record(self)
+
+    def output(self):
+
+        # Hand the frame to the terminal view, which draws it on its own
+        # thread
+        if self.view:
+            self.view.publish(self.perpitcharray, self.colorramp.name)
 
         return True
 
+    def outputPeriod(self):
+        return 0.
 
     def gui(self):
-        self.server.gui(self.__dict__)
+        self.audiosource.gui(self.__dict__)
 
 if __name__ == "__main__":
-    s2cprocessor = SoundToColorProcessor()
-    s2cprocessor.start(outputAudio=False)
-
-    try:
-        while True:
-
-            s2cprocessor.update()
-            s2cprocessor.output()
-            time.sleep(1./30.)
-
-    finally:
-        s2cprocessor.shutdown()
 
+    # see commandline.py for the flags
+    import commandline
+    commandline.main(SoundToColorProcessor)
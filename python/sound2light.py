@@ -1,29 +1,20 @@
 #!/usr/bin/python
 
 import sound2color
+import calibration
+import framecodec
+import tclprotocol
+import serialwriter
 
+import os
 import time
 import sys
-import numpy
-import math
-
-# requires pyserial: http://pyserial.sourceforge.net/
-import serial
+import json
+import threading
 
 # ------------------------------------------------------------------------
 # TCLSerial CLASSES
 
-# "Struct" class used to pass around serial state
-class TCLSerialOutput(object):
-    
-    def __init__(self):
-
-        self.handshakeConfirmed = False
-        self.handshakeProgram   = "Unknown"
-        self.serialHadOutput    = False
-        self.serialMessage      = ""
-        self.beginColor         = False
-
 # Class used to manage the serial connection.  Used for sending and 
 # receiving messages.
 
@@ -40,10 +31,86 @@ class TCLSerialOutput(object):
 #    - tcl:colorbegin!
 #    -- response: tcl:colorbeginreceived:<program name>\n
 
+#    - tcl:colorraw!
+#    -- response: tcl:colorrawreceived:<program name>\n
+#    The same as colorbegin, but the arduino sends the color bytes straight
+#    to the leds instead of color correcting them, so they have to be
+#    calibrated here (see SetCalibration and calibration.py).
+
+#   After colorbegin, color frames are sent with SendColors (or EncodeColors
+#   and SendColorBytes), see framecodec.py for the frame format.  The
+#   compression mode picks between full, delta and run length frames, see
+#   framecodec.COMPRESSION_MODES.
+
+#   Replies are parsed as the bytes arrive by a tclprotocol.TCLReplyParser.
+#   SendMessageAsync returns a tclprotocol.ReplyFuture for the reply right
+#   away, SendMessageAndListen waits for it.  Until StartReader is called,
+#   the waiting reads the serial port itself; after that a reader thread
+#   does, so nothing else ever waits on reading the port.
+
+# How long to wait for a reply, in seconds
+REPLY_TIMEOUT = 1.
+
+# Read timeout given to connections that have none, so reads never hang
+READ_TIMEOUT = .05
+
 class TCLSerialManager(object):
     
-    def __init__(self, serialConnection):
+    def __init__(self, serialConnection, compression='auto'):
         self.sconnect    = serialConnection
+        self.frameencoder = None
+        self.calibration = None
+        self.SetCompression(compression)
+
+        self.parser = tclprotocol.TCLReplyParser()
+        self.reader = None
+        self.reading = False
+        self.metrics = None
+
+        if getattr(self.sconnect, 'timeout', None) is None:
+            self.sconnect.timeout = READ_TIMEOUT
+
+
+
+    def SetCompression(self, compression, 
+                       keyframeInterval=framecodec.KEYFRAME_INTERVAL):
+
+        if compression not in framecodec.COMPRESSION_MODES:
+            raise Exception("Unknown compression [ %s ], use one of %s" %
+                            (compression, framecodec.COMPRESSION_MODES))
+
+        self.compression = compression
+        self.keyframeInterval = keyframeInterval
+
+        # the encoder is rebuilt on the next frame, which starts with a full
+        # frame so the arduino is in sync with the new encoder
+        self.frameencoder = None
+
+
+
+    def SetCalibration(self, profile):
+
+        # Calibrate the colors with a calibration.CalibrationProfile before
+        # encoding them, or not at all with None.  Only use it after
+        # colorraw, otherwise the arduino color corrects them a second time.
+        self.calibration = profile
+        self.frameencoder = None
+
+
+
+    def SetMetrics(self, metrics, labels=None):
+
+        # Time encoding and sending and count the bytes sent into a
+        # metrics.Metrics, labelled with labels
+        self.metrics = metrics
+        self.encodeTimes = metrics.histogram("stage_seconds", "Seconds each "
+            "stage of a frame takes", dict(labels or {}, stage='encode'))
+        self.sendTimes = metrics.histogram("stage_seconds", "Seconds each "
+            "stage of a frame takes", dict(labels or {}, stage='send'))
+        self.bytesCounter = metrics.counter("serial_bytes_total", "Color "
+            "frame bytes sent", labels, rate=True)
+        self.framesCounter = metrics.counter("serial_frames_total", "Color "
+            "frames sent", labels)
 
 
 
@@ -64,12 +131,6 @@ class TCLSerialManager(object):
         if not self.sconnect.writable():
             raise Exception("Unable to write to [ %s ]" % str(self.sconnect))
 
-        while(self.sconnect.outWaiting()):
-            print "Waiting for %s to write" % str(self.sconnect)
-            time.sleep(.1)
-
-        self.sconnect.flushInput()
-
         if self.sconnect.isOpen():        
             self.sconnect.write(self._FormatMessage(instruction, args))
 
@@ -77,200 +138,536 @@ class TCLSerialManager(object):
         return True
 
 
-    def SendColorBytes(self, bytesData):
+    def SendColorBytes(self, frameData):
 
+        # frameData is an encoded color frame from framecodec, starting with
+        # the '*' char the arduino firmware uses to know that this is a pack
+        # of color data
         if not self.sconnect.writable():
             raise Exception("Unable to write to [ %s ]" % str(self.sconnect))
 
-        while(self.sconnect.outWaiting()):
-            print "Waiting for %s to write" % str(self.sconnect)
-            time.sleep(.1)
+        if self.metrics:
+            start = time.time()
+
+        # Wait until the frame has drained out of the serial port, so the
+        # next frame sent is as fresh as possible instead of queueing up
+        # behind this one.
+        self.sconnect.write(frameData)   
+        self.sconnect.flush()
 
-        # The leading '*' char is a special character used by the arduino
-        # firmware to know that this is a pack of color data
-        rawBytes = '*' + reduce(lambda x,y:x+y, map(chr, bytesData))    
-        self.sconnect.write(rawBytes)   
+        if self.metrics:
+            self.sendTimes.observe(time.time() - start)
+            self.bytesCounter.inc(len(frameData))
+            self.framesCounter.inc()
 
         return True
 
 
 
-    def ReceiveMessage(self):
+    def EncodeColors(self, colorarray):
 
-        maxNumAttempts = 5
-        numAttempts = 0
+        # Encode a float colorarray into the next color frame to send
+        if (self.frameencoder is None or 
+                self.frameencoder.numleds != colorarray.shape[0]):
+            self.frameencoder = framecodec.ColorFrameEncoder(
+                colorarray.shape[0], self.compression, self.keyframeInterval,
+                self.calibration)
 
-        output = TCLSerialOutput()
-        result = []
+        if not self.metrics:
+            return self.frameencoder.encode(colorarray)
 
-        while numAttempts < maxNumAttempts:
+        start = time.time()
+        frameData = self.frameencoder.encode(colorarray)
+        self.encodeTimes.observe(time.time() - start)
+        return frameData
 
-            try:
-                result.extend(self.sconnect.readlines())
 
-            except serial.SerialTimeoutException:
-                print("Unable to read data from [ %s ] " % str(self.sconnect))
-                return output
 
-            validLines = []
-            for line in result:
+    def SendColors(self, colorarray):
+        return self.SendColorBytes(self.EncodeColors(colorarray))
 
-                strippedline = line.strip("\r\n")
-                if strippedline:
-                    validLines.append(strippedline)
 
-            for line in validLines:
 
-                tokens = line.split(":")
+    def ReadAvailable(self):
 
-                if (len(tokens) > 2):
-                    serialHeader, serialInstruction = tokens[:2]
+        # Feed whatever the arduino sent to the parser.  Waits at most the
+        # read timeout for the first byte.
+        data = self.sconnect.read(self.sconnect.inWaiting() or 1)
+        if data:
+            self.parser.feed(data)
 
-                    if serialHeader != "tcl":
-                        output.serialMessage += line + "\n"
 
-                    if serialInstruction == "handreceived":
-                        print "Success! -> " + tokens[2]
-                        output.handshakeConfirmed = True
-                        output.handshakeProgram = tokens[2]
-                        output.serialHadOutput = True
 
-                    if serialInstruction == "handshakeconfirmed":
-                        handshake = int(tokens[2])
-                        if handshake:
-                            print "Handshake Confirmed!"
-                        else:
-                            print "Handshake Not Made!"
+    def StartReader(self):
 
-                        output.handshakeConfirmed = handshake
-                        output.serialHadOutput = True
+        def read():
+            while self.reading:
+                self.ReadAvailable()
 
-                    if serialInstruction == "colorbeginreceived":
-                        output.handshakeProgram = tokens[2]
-                        output.serialHadOutput = True
-                        output.beginColor = True
+        self.reading = True
+        self.reader = threading.Thread(target=read, name="TCLSerialReader")
+        self.reader.daemon = True
+        self.reader.start()
 
 
-                    if serialInstruction == "handshakeprogram":
-                        output.handshakeProgram = tokens[2]
-                        print "Handshake Made With: " + output.handshakeProgram
-                        output.serialHadOutput = True
 
-                else:
-                    output.serialMessage += line + "\n"
+    def StopReader(self):
 
-            if output.serialHadOutput:
-                break
+        if self.reader:
+            self.reading = False
+            self.reader.join()
+            self.reader = None
 
-            numAttempts += 1
-        
-        self.sconnect.flushInput()
-        return output
 
 
+    def SendMessageAsync(self, instruction, args="", callback=None):
 
-    def SendMessageAndListen(self, instruction, args=""):
+        # Send the message and return a ReplyFuture for the reply it
+        # expects, see tclprotocol.EXPECTED_REPLIES
+        future = self.parser.expect(
+            tclprotocol.EXPECTED_REPLIES.get(instruction))
+        if callback:
+            future.addCallback(callback)
 
-        output = TCLSerialOutput()
-        if self.SendMessage(instruction, args):
-            time.sleep(.1)
-            output = self.ReceiveMessage()
-            if output.serialMessage:
-                print output.serialMessage
+        self.SendMessage(instruction, args)
+        return future
+
+
+
+    def SendMessageAndListen(self, instruction, args="",
+                             timeout=REPLY_TIMEOUT):
+
+        future = self.SendMessageAsync(instruction, args)
+        deadline = time.time() + timeout
+
+        while not future.done() and time.time() < deadline:
+            if self.reader:
+                future.wait(deadline - time.time())
+            else:
+                self.ReadAvailable()
+
+        self.parser.cancel(future)
+
+        output = future.output
+        if output.serialMessage:
+            print output.serialMessage
 
         return output
 
+# ------------------------------------------------------------------------
+# TCL STRIPS
+
+# One strip of lights behind its own serial connection and arduino.  The
+# strip shows numleds leds of the processor's colorarray, starting at led
+# start, and has its own TCLSerialManager (so its own frame encoder) and,
+# when started with a writer, its own serialwriter.SerialFrameWriter
+# thread, so strips never wait on each other's serial links.
+#
+# With a calibration profile the strip asks the arduino for raw color mode
+# and calibrates the colors itself.  Firmware that does not know colorraw
+# never answers it, and the strip falls back to colorbegin and lets the
+# firmware do the color correction.
+
+class TCLStrip(object):
+
+    def __init__(self, sconnect, start, numleds, compression='auto',
+                 calibration=None):
+
+        self.sconnect = sconnect
+        self.start = start
+        self.numleds = numleds
+        self.calibration = calibration
+        self.serialmgr = TCLSerialManager(sconnect, compression)
+        self.serialwriter = None
+        self.handshakeSeconds = 0.
+        self.metrics = None
+
+        # the program the arduino said it runs, once shaken hands with
+        self.program = None
+
+    def __str__(self):
+        return "%s [ leds %i - %i ]" % (self.sconnect, self.start,
+                                       self.start + self.numleds - 1)
+
+    def Handshake(self, program="sound2light"):
+
+        start = time.time()
+        try:
+            output = self._Handshake(program)
+            self.program = output.handshakeProgram
+            return output
+        finally:
+            self.handshakeSeconds = time.time() - start
+
+    def _Handshake(self, program):
+
+        output = self.serialmgr.SendMessageAndListen("handextended", program)
+        if output.handshakeConfirmed:
+            self.serialmgr.SendMessageAndListen("status")
+
+        if self.calibration is not None:
+            output = self.serialmgr.SendMessageAndListen("colorraw")
+            if output.rawColor:
+                self.serialmgr.SetCalibration(self.calibration)
+                return output
+
+            print("No raw color mode on [ %s ], the firmware color corrects "
+                  "instead" % str(self.sconnect))
+
+        return self.serialmgr.SendMessageAndListen("colorbegin")
+
+    def SetMetrics(self, metrics):
+
+        # The strip's metrics are labelled with its port and first led
+        self.metrics = metrics
+        self.labels = {'port': getattr(self.sconnect, 'port', None) or
+                               str(self.sconnect),
+                       'first_led': self.start}
+
+        self.serialmgr.SetMetrics(metrics, self.labels)
+        if self.serialwriter:
+            self.serialwriter.setMetrics(metrics, self.labels)
+
+        metrics.gauge("handshake_seconds", "Seconds the handshake with the "
+                      "arduino took", self.labels).set(self.handshakeSeconds)
+
+    def Start(self, asyncOutput=True):
+
+        self.serialmgr.StartReader()
+        if asyncOutput:
+            self.StartWriter()
+
+    def StartWriter(self):
+
+        self.serialwriter = serialwriter.SerialFrameWriter(self.serialmgr,
+                                                           self.numleds)
+        if self.metrics:
+            self.serialwriter.setMetrics(self.metrics, self.labels)
+        self.serialwriter.start()
+
+    def Segment(self, colorarray):
+        return colorarray[self.start:self.start + self.numleds]
+
+    def EncodeColors(self, colorarray):
+        return self.serialmgr.EncodeColors(self.Segment(colorarray))
+
+    def SendColors(self, colorarray):
+
+        # Hand the strip's segment to its writer thread, or send it right
+        # away when there is no writer
+        if self.serialwriter:
+            return self.serialwriter.publish(self.Segment(colorarray))
+
+        return self.serialmgr.SendColorBytes(self.EncodeColors(colorarray))
+
+    def OutputPeriod(self):
+
+        if self.serialwriter:
+            return self.serialwriter.stats()['writetime']
+
+        return 0.
+
+    def Close(self):
+
+        if self.serialwriter:
+            self.serialwriter.stop()
+
+        self.serialmgr.StopReader()
+
+        self.sconnect.flush()
+        self.sconnect.close()
+
 # ------------------------------------------------------------------------
 # TCLSerial CLASS
 
-# This processor finds the serial connection to a connected arduino device
-# and then overrides it's parent's output method to turn the color array
-# data into serial messages to the TCL device.
+# This processor finds the serial connections to the connected arduino
+# devices and then overrides it's parent's output method to turn the color
+# array data into serial messages to the TCL devices.  Serial connections
+# or the names of serial ports can be handed in as sconnect (one or a list
+# of them) to skip searching the usbserial ports.
+#
+# Nothing is opened when the processor is built.  connect() opens the ports
+# and shakes hands with the arduinos, and start() calls it when it was not
+# called before.  Until then the processor has the leds of one strip per
+# connection handed in (one strip when searching), and connecting to more
+# strips than that grows the colorarray.  pyserial is only imported by
+# connect().
+#
+# All of the usbserial ports are searched at the same time, and the ports
+# that worked are saved in PORT_CACHE_FILE so the next start tries them
+# first.
+#
+# Every connection drives one TCLStrip.  numleds is the led count of each
+# strip, either one count for all of them or a list with a count per strip.
+# The strips are laid end to end: the colorarray covers all of their leds
+# and every strip shows its own segment of it.
+#
+# With asyncOutput (the default) every strip's frames are sent by its own
+# serialwriter.SerialFrameWriter thread, so output() never waits on a
+# serial link.  strip.serialwriter.stats() has a writer's counters.
+#
+# Strips that are not behind a serial port, like the udp pixel controllers
+# of netoutput.UDPPixelStrip, can be handed in as sinks.  They are laid out
+# after the serial strips, and without sconnect no serial port is searched
+# for.
+#
+# calibrationProfile is the calibration.CalibrationProfile (or the json file
+# of one, eg calibration.PROFILE_FILE) the colors are corrected with before
+# they are sent, so the arduinos only pass the bytes on to the leds.  It
+# takes firmware that knows colorraw.  By default (None) the color
+# correction is left to the firmware.
 
 class SoundToLightProcessor(sound2color.SoundToColorProcessor):
 
-    def __init__(self):
+    # where the serial ports that worked are remembered between runs
+    PORT_CACHE_FILE = os.path.expanduser("~/.sound2light.json")
+
+    # how long to wait for the arduinos to say tcl:ready.  Opening the port
+    # resets an arduino, which then takes a second or two to boot.
+    PROBE_SECONDS = 3.
+
+    def __init__(self, source=None, sconnect=None, compression='auto',
+                 asyncOutput=True, headless=False, numleds=None,
+                 calibrationProfile=None,
+                 beatengine=None, sinks=None):
+
+        self.asyncOutput = asyncOutput
+        self.compression = compression
+        self.discoveredPorts = False
+
+        if sconnect is None and sinks:
+            self.sconnects = []
+        elif sconnect is None:
+            self.sconnects = None
+        elif isinstance(sconnect, (list, tuple)):
+            self.sconnects = list(sconnect)
+        else:
+            self.sconnects = [sconnect]
+
+        self.sinks = list(sinks or [])
+        self.stripleds = numleds if numleds is not None else self.NUM_LEDS
+
+        if isinstance(calibrationProfile, basestring):
+            calibrationProfile = calibration.loadProfile(calibrationProfile)
+        self.calibrationProfile = calibrationProfile
+
+        self.strips = []
+        self.connected = False
+
+        numstrips = (len(self.sconnects) if self.sconnects is not None
+                     else 1)
+        sound2color.SoundToColorProcessor.__init__(self, source, headless,
+            self._totalLeds(numstrips), beatengine)
+
+    def _stripLeds(self, numstrips):
+
+        # The led count of each of numstrips serial strips
+        numleds = self.stripleds
+        if not isinstance(numleds, (list, tuple)):
+            numleds = [numleds] * numstrips
+
+        if len(numleds) != numstrips:
+            raise Exception("Got led counts for %i strips but %i serial "
+                            "connections" % (len(numleds), numstrips))
+
+        return list(numleds)
+
+    def _totalLeds(self, numstrips):
+        return (sum(self._stripLeds(numstrips)) +
+                sum(sink.numleds for sink in self.sinks))
+
+    def connect(self):
+
+        # Open the serial ports, searching the usbserial ports unless they
+        # were handed in, shake hands with the arduinos and lay out the
+        # strips.  Does nothing once connected.
+        if self.connected:
+            return
+
+        sconnects = self.sconnects
+        if sconnects is None:
+            sconnects = self._findSerialPorts()
+
+        sconnects = [self._openSerialPort(connection)
+                     if isinstance(connection, basestring) else connection
+                     for connection in sconnects]
+
+        start = 0
+        for connection, stripleds in zip(sconnects,
+                                         self._stripLeds(len(sconnects))):
+            strip = TCLStrip(connection, start, stripleds, self.compression,
+                             self.calibrationProfile)
+            strip.Handshake("sound2light")
+            self.strips.append(strip)
+            start += stripleds
+
+        for sink in self.sinks:
+            sink.start = start
+            self.strips.append(sink)
+            start += sink.numleds
+
+        # remember the ports we found for the next start
+        if self.discoveredPorts:
+            self._savePortCache()
+
+        if self.metrics:
+            for strip in self.strips:
+                strip.SetMetrics(self.metrics)
+
+        if start != self.numleds:
+            self._allocateLeds(start)
+
+        self.connected = True
+
+    def _openSerialPort(self, portName):
+
+        # requires pyserial: http://pyserial.sourceforge.net/
+        import serial
+
+        # the arduino resets when the port opens, wait until it is ready
+        sconnect = serial.Serial(portName, 115200, bytesize=serial.EIGHTBITS,
+                                 timeout=READ_TIMEOUT)
+        if not self._checkTCLReady(sconnect,
+                                   time.time() + self.PROBE_SECONDS):
+            sconnect.close()
+            raise Exception("No tcl:ready message from serial port [ %s ]" %
+                            portName)
+
+        return sconnect
 
+    def _findSerialPorts(self):
+
+        # Open every usbserial port that has an arduino saying tcl:ready.
+        # The ports that worked last time are tried first, and when any of
+        # them answers the other ports are left alone.  Delete
+        # PORT_CACHE_FILE to search all of the ports again.
         import serial.tools.list_ports
-        self.serialPort = None
 
-        ttys = serial.tools.list_ports.comports()
+        portNames = [tty[0] for tty in serial.tools.list_ports.comports()
+                     if "usbserial" in tty[0]]
+
+        cache = self._loadPortCache()
+        cachedNames = [portName for portName in cache.get('ports', [])
+                       if portName in portNames]
+
+        sconnects = []
+        if cachedNames:
+            programs = cache.get('programs') or [cache.get('program',
+                                                           "Unknown")]
+            print("Trying the serial ports that worked last time with [ %s ]" %
+                  ", ".join(programs))
+            sconnects = self._probeSerialPorts(cachedNames)
+
+        if not sconnects:
+            sconnects = self._probeSerialPorts(portNames)
+
+        if not sconnects:
+            print "Unable to find a usb serial port that could be serving display"
+            sys.exit(1)
+
+        self.discoveredPorts = True
+        return sconnects
 
-        for tty in ttys:
-            portName = tty[0] 
-            if "usbserial" not in portName:
-                continue
+    def _probeSerialPorts(self, portNames):
+
+        # Probe all of the ports at once, each in its own thread, and give
+        # up on the ones that did not say tcl:ready within PROBE_SECONDS.
+        # Returns the open connections in the order of portNames.
+        import serial
+
+        deadline = time.time() + self.PROBE_SECONDS
+        sconnects = [None] * len(portNames)
+
+        def probe(idx, portName):
 
             print "Testing usbserial port [ %s ]" % portName
 
             try:
-                self.sconnect = serial.Serial(portName, 115200, 
-                                                bytesize=serial.EIGHTBITS)
+                sconnect = serial.Serial(portName, 115200, 
+                                         bytesize=serial.EIGHTBITS,
+                                         timeout=READ_TIMEOUT)
 
-                if not self.sconnect.isOpen():
+                if not sconnect.isOpen():
                     print "Could not open port"
 
-                self.sconnect.setTimeout(.1)
-
-                if not self._checkTCLReady():
+                if not self._checkTCLReady(sconnect, deadline):
                     print("Unable to connect [ %s ] could not get a tcl:ready "
-                        "message " % str(self.sconnect))
+                        "message " % str(sconnect))
+                    sconnect.close()
                 else:
-                    self.serialPort = portName 
-                    break
+                    print "Using serial port [ %s ]" % portName
+                    sconnects[idx] = sconnect
 
             except Exception, e:
-                print("Could not connect to light display using port [ %s ]" % 
-                    portName)
+                print("Could not connect to light display using port [ %s ]: "
+                      "%s" % (portName, str(e)))
 
-        if self.serialPort:
-            print "Using serial port [ %s ]" % self.serialPort
-        else:
-            print "Unable to find a usb serial port that could be serving display"
-            sys.exit(1)
+        threads = [threading.Thread(target=probe, args=(idx, portName))
+                   for idx, portName in enumerate(portNames)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        self.serialmgr = TCLSerialManager(self.sconnect)
+        return [sconnect for sconnect in sconnects if sconnect is not None]
 
-        output = self.serialmgr.SendMessageAndListen("handextended", "sound2light")
-        if output.handshakeConfirmed:
-            self.serialmgr.SendMessageAndListen("status")
+    def _checkTCLReady(self, sconnect, deadline):
 
-        output = self.serialmgr.SendMessageAndListen("colorbegin")
+        # The arduino says tcl:ready every second until a program shakes
+        # hands with it
+        parser = tclprotocol.TCLReplyParser()
+        ready = parser.expect("ready")
 
-        sound2color.SoundToColorProcessor.__init__(self)
+        while not ready.done() and time.time() < deadline:
+            data = sconnect.read(sconnect.inWaiting() or 1)
+            if data:
+                parser.feed(data)
 
-    def _checkTCLReady(self):
-        
-        maxNumAttempts = 10
-        attempts = 0
-        while (attempts < maxNumAttempts):
-            line = self.sconnect.readline()
-            strippedline = line.strip()
-            print strippedline
-            if strippedline == "tcl:ready":
-                time.sleep(.5)
-                return True
+        return ready.done()
 
-            time.sleep(.1)
-            attempts += 1
+    def _loadPortCache(self):
 
-        return False
+        try:
+            with open(self.PORT_CACHE_FILE) as cachefile:
+                return json.load(cachefile)
+        except (IOError, ValueError):
+            return {}
 
-    @staticmethod
-    def convertToByte(x):
-        byte = int(sound2color.clamp(math.floor(x), 0, 255))
+    def _savePortCache(self):
 
-        # 42 is a special byte that declares the head of a frame
-        # of lights, so we avoid outputting that byte as a color
-        if byte == 42:
-            return 43
-        else:
-            return byte
+        # the port of every serial strip and the program its arduino runs
+        strips = [strip for strip in self.strips
+                  if isinstance(strip, TCLStrip)]
+        cache = {
+            'ports': [strip.sconnect.port for strip in strips],
+            'programs': [strip.program for strip in strips],
+        }
+
+        try:
+            with open(self.PORT_CACHE_FILE, "w") as cachefile:
+                json.dump(cache, cachefile, indent=2)
+        except IOError, e:
+            print "Unable to save [ %s ]: %s" % (self.PORT_CACHE_FILE, str(e))
+
+    def start(self, outputAudio=False):
+
+        self.connect()
+        sound2color.SoundToColorProcessor.start(self, outputAudio)
+
+        for strip in self.strips:
+            strip.Start(self.asyncOutput)
+
+    def setMetrics(self, metrics):
+
+        sound2color.SoundToColorProcessor.setMetrics(self, metrics)
+        for strip in self.strips:
+            strip.SetMetrics(metrics)
 
     def shutdown(self):
         sound2color.SoundToColorProcessor.shutdown(self)
-        self.sconnect.flush()
-        self.sconnect.close()
+
+        for strip in self.strips:
+            strip.Close()
 
     def output(self):
 
@@ -278,28 +675,28 @@ class SoundToLightProcessor(sound2color.SoundToColorProcessor):
         # update and turn output it via 
         superResult = sound2color.SoundToColorProcessor.output(self)
 
-        colorData = list(numpy.ravel(map(SoundToLightProcessor.convertToByte, 
-                                         self.colorarray.ravel())))
-
-        if not self.serialmgr.SendColorBytes(colorData):
+        if not self._sendColors():
             return False
         else:
             return superResult
 
+    def _sendColors(self):
 
-if __name__ == "__main__":
-    s2lprocessor = SoundToLightProcessor()
-    s2lprocessor.start(outputAudio=False)
+        # Every strip gets its segment of the colorarray, even when sending
+        # to another one failed
+        results = [strip.SendColors(self.colorarray) for strip in self.strips]
+        return all(results)
+
+    def outputPeriod(self):
 
-    try:
-        while True:
+        # The serial links are the bottleneck, so pace frames by the slowest
+        # strip's writer
+        return max([strip.OutputPeriod() for strip in self.strips] or [0.])
 
-            s2lprocessor.update()
-            s2lprocessor.output()
-            # Since we are bound by the baudrate of serial, we can at best
-            # get 30 fps when sending 3 bytes * 50 LED colors per frame of 
-            # color set.
-            time.sleep(1./30.)
 
-    finally:
-        s2lprocessor.shutdown()
+if __name__ == "__main__":
+
+    # see commandline.py for the flags, eg --sink e131:10.0.0.50 to send to
+    # a networked pixel controller instead of arduinos
+    import commandline
+    commandline.main(SoundToLightProcessor, lights=True)
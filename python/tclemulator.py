@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+import os
+import pty
+import tty
+import time
+import select
+import threading
+import collections
+
+import framecodec
+
+# requires pyserial: http://pyserial.sourceforge.net/
+import serial
+
+# ------------------------------------------------------------------------
+# FIRMWARE EMULATOR
+
+# Plays the part of an arduino running PySerialTCLConnect.ino on the other
+# end of a pseudo terminal, so the serial path can be measured without any
+# hardware.  Like the firmware it:
+#
+#   - says tcl:ready every second until a program shakes hands,
+#   - answers tcl:handextended, tcl:status, tcl:colorbegin and tcl:colorraw
+#     the same way
+#     (reading instructions up to '!', or until 8 ms pass without a byte,
+#     like Serial.readBytesUntil with Serial.setTimeout(8)),
+#   - then decodes '*' color frames with framecodec.ColorFrameDecoder,
+#     the same decoder the firmware mirrors.
+#
+# Timing is modelled on top of that:
+#
+#   - bytes come in at baudrate / 10 bytes a second, however fast the host
+#     writes them,
+#   - every complete frame keeps the firmware busy sending NUM_LEDS colors
+#     over SPI (SPI_SECONDS_PER_LED) after converting them with float math
+#     (COLOR_MATH_SECONDS_PER_LED), unless it is in raw color mode.  Both
+#     are estimates for a 16 MHz AVR, tune them to match a real board.
+#   - while busy, bytes wait in the 64 byte receive buffer of the arduino,
+#     and bytes that do not fit are dropped, corrupting the frame they
+#     belong to.
+#
+# A pty drains instantly, so open the port with openSerial(), which gives an
+# EmulatedSerial whose flush() and outWaiting() follow the modelled link
+# instead.
+
+# Key functions:
+
+#   openSerial(timeout):
+#     Open the host side of the emulated port.
+
+#   stats( ):
+#     Bytes received and dropped, frames started and shown, the rate frames
+#     were shown at and the latency from the first byte of a frame arriving
+#     until its colors were sent to the leds.
+
+#   stop( ):
+#     Stop the emulator and close the pty.
+
+# Size of the arduino's serial receive buffer
+RX_BUFFER_SIZE = 64
+
+# How many bytes the emulator takes from the pty at a time
+CHUNK_BYTES = 16
+
+class EmulatedSerial(serial.Serial):
+
+    def __init__(self, emulator, *args, **kwargs):
+
+        self.emulator = emulator
+        self.bytesSent = 0
+        serial.Serial.__init__(self, *args, **kwargs)
+
+    def write(self, data):
+
+        written = serial.Serial.write(self, data)
+        self.bytesSent += written if written is not None else len(data)
+        return written
+
+    def outWaiting(self):
+        return max(0, self.bytesSent - self.emulator.bytesReceived)
+
+    def flush(self):
+
+        # wait until the emulated arduino has received everything written
+        serial.Serial.flush(self)
+        self.emulator.waitReceived(self.bytesSent)
+
+class TCLFirmwareEmulator(threading.Thread):
+
+    SPI_SECONDS_PER_LED = 20e-6
+    COLOR_MATH_SECONDS_PER_LED = 450e-6
+    INSTRUCTION_TIMEOUT = .008
+    MAX_INSTRUCTION_LENGTH = 64
+
+    def __init__(self, numleds=50, baudrate=115200, pingSeconds=1.):
+
+        threading.Thread.__init__(self, name="TCLFirmwareEmulator")
+        self.daemon = True
+
+        self.numleds = numleds
+        self.baudrate = baudrate
+        self.byteSeconds = 10. / baudrate
+        self.pingSeconds = pingSeconds
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.condition = threading.Condition()
+        self.running = True
+
+        # handshake state
+        self.handshakeMade = False
+        self.receivingColor = False
+        self.rawColor = False
+        self.programName = "Unknown"
+        self.instruction = bytearray()
+        self.instructionAt = 0.
+
+        # link and color state.  Times are when things happen on the
+        # emulated arduino, which can run a little ahead of the clock.
+        self.decoder = framecodec.ColorFrameDecoder(numleds)
+        self.colorbytes = bytearray(3 * numleds)
+        self.rxbuffer = collections.deque()
+        self.linkTime = 0.
+        self.busyUntil = 0.
+        self.frameStartedAt = None
+
+        self.bytesReceived = 0
+        self.bytesDropped = 0
+        self.framesStarted = 0
+        self.framesShown = 0
+        self.firstShownAt = None
+        self.lastShownAt = None
+        self.totalLatency = 0.
+        self.maxLatency = 0.
+
+    def frameSeconds(self):
+
+        # how long the firmware is busy showing one frame, raw colors skip
+        # the float math
+        if self.rawColor:
+            return self.numleds * self.SPI_SECONDS_PER_LED
+
+        return self.numleds * (self.SPI_SECONDS_PER_LED +
+                               self.COLOR_MATH_SECONDS_PER_LED)
+
+    def openSerial(self, timeout=.05):
+        return EmulatedSerial(self, self.port, self.baudrate,
+                              bytesize=serial.EIGHTBITS, timeout=timeout)
+
+    def waitReceived(self, numbytes):
+
+        with self.condition:
+            while self.running and self.bytesReceived < numbytes:
+                self.condition.wait(.1)
+
+    def stats(self):
+
+        with self.condition:
+            shownSeconds = (self.lastShownAt or 0.) - (self.firstShownAt or 0.)
+            return {
+                'received': self.bytesReceived,
+                'dropped': self.bytesDropped,
+                'started': self.framesStarted,
+                'shown': self.framesShown,
+                'fps': ((self.framesShown - 1) / shownSeconds
+                        if shownSeconds > 0. else 0.),
+                'avglatency': self.totalLatency / max(self.framesShown, 1),
+                'maxlatency': self.maxLatency,
+            }
+
+    def _reply(self, text):
+        os.write(self.master, text)
+
+    def _processInstruction(self):
+
+        # the same as processSerialInstruction in TCLUtils.h
+        tokens = str(self.instruction).strip().split(":")
+        self.instruction = bytearray()
+
+        if len(tokens) >= 2 and tokens[0] == "tcl":
+
+            if tokens[1] == "handextended" and len(tokens) == 3:
+                self.handshakeMade = True
+                self.programName = tokens[2]
+                self._reply("tcl:handreceived:%s\n" % self.programName)
+
+            if self.handshakeMade:
+                if tokens[1] == "status":
+                    self._reply("tcl:handshakeconfirmed:1\n")
+                    self._reply("tcl:handshakeprogram: %s\n" %
+                                self.programName)
+
+                if tokens[1] == "colorbegin":
+                    self.receivingColor = True
+                    self._reply("tcl:colorbeginreceived:%s\n" %
+                                self.programName)
+
+                if tokens[1] == "colorraw":
+                    self.receivingColor = True
+                    self.rawColor = True
+                    self._reply("tcl:colorrawreceived:%s\n" %
+                                self.programName)
+
+        self._reply("\r\n")
+
+    def _consume(self, inByte, arrival, now):
+
+        # The firmware reads one byte at time now
+        if not self.receivingColor:
+
+            if (self.instruction and
+                    now - self.instructionAt > self.INSTRUCTION_TIMEOUT):
+                self._processInstruction()
+
+            if inByte == ord('!'):
+                self._processInstruction()
+            else:
+                self.instruction.append(inByte)
+                self.instructionAt = now
+                if len(self.instruction) >= self.MAX_INSTRUCTION_LENGTH:
+                    self._processInstruction()
+            return
+
+        if inByte == framecodec.FRAME_START:
+            self.framesStarted += 1
+            self.frameStartedAt = arrival
+
+        for frame in self.decoder.decode(chr(inByte)):
+
+            self.colorbytes = frame
+            self.busyUntil = now + self.frameSeconds()
+
+            latency = self.busyUntil - (self.frameStartedAt or arrival)
+            with self.condition:
+                self.framesShown += 1
+                self.totalLatency += latency
+                self.maxLatency = max(self.maxLatency, latency)
+                if self.firstShownAt is None:
+                    self.firstShownAt = self.busyUntil
+                self.lastShownAt = self.busyUntil
+
+    def _drain(self, now):
+
+        # Whenever the firmware is not busy it works through the bytes
+        # waiting in its receive buffer
+        while self.rxbuffer and self.busyUntil <= now:
+            inByte, arrival = self.rxbuffer.popleft()
+            self._consume(inByte, arrival, max(self.busyUntil, arrival))
+
+    def _arrive(self, inByte, arrival):
+
+        self._drain(arrival)
+
+        if arrival < self.busyUntil or self.rxbuffer:
+            if len(self.rxbuffer) >= RX_BUFFER_SIZE:
+                self.bytesDropped += 1
+            else:
+                self.rxbuffer.append((inByte, arrival))
+        else:
+            self._consume(inByte, arrival, arrival)
+
+    def run(self):
+
+        nextPing = time.time()
+
+        while self.running:
+
+            now = time.time()
+            if not self.handshakeMade and now >= nextPing:
+                self._reply("tcl:ready\n")
+                nextPing += self.pingSeconds
+
+            ready, _, _ = select.select([self.master], [], [], .01)
+            if not ready:
+                self._drain(time.time())
+                if (self.instruction and time.time() - self.instructionAt >
+                        self.INSTRUCTION_TIMEOUT):
+                    self._processInstruction()
+                continue
+
+            try:
+                chunk = bytearray(os.read(self.master, CHUNK_BYTES))
+            except OSError:
+                break
+
+            start = max(self.linkTime, time.time())
+            for idx, inByte in enumerate(chunk):
+                self._arrive(inByte, start + (idx + 1) * self.byteSeconds)
+            self.linkTime = start + len(chunk) * self.byteSeconds
+
+            # the bytes are only received once they made it down the link
+            wait = self.linkTime - time.time()
+            if wait > 0.:
+                time.sleep(wait)
+
+            with self.condition:
+                self.bytesReceived += len(chunk)
+                self.condition.notify_all()
+
+    def stop(self, timeout=1.):
+
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+
+        if self.ident is not None:
+            self.join(timeout)
+
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == "__main__":
+
+    # Run an emulated arduino until interrupted and print its stats every
+    # second.  Point a program at the port it prints.
+    emulator = TCLFirmwareEmulator()
+    emulator.start()
+    print "Emulating PySerialTCLConnect on [ %s ]" % emulator.port
+
+    try:
+        while True:
+            time.sleep(1.)
+            print emulator.stats()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
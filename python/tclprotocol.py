@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+import threading
+
+# ------------------------------------------------------------------------
+# TCL REPLIES
+
+# The PySerialTCLConnect firmware answers messages with lines like
+#
+#   tcl:<instruction>:<args>\n
+#
+# and says tcl:ready\n every second until a program shakes hands with it.
+# TCLReplyParser takes the bytes coming from the arduino in whatever pieces
+# they arrive, splits them into lines and hands every reply to whoever is
+# waiting for it, without ever waiting on the serial port itself.
+#
+# There is no asyncio in python 2, so a reply that is waited for is a
+# ReplyFuture: a threading.Event that can be waited on with a timeout,
+# checked with done(), or given callbacks.
+
+# Key functions:
+
+#   feed(data):
+#     Consume bytes read from the serial port.  Every complete line is
+#     parsed right away, a partial line is kept until the rest arrives.
+
+#   expect(instruction):
+#     Returns a ReplyFuture that resolves when a reply with that instruction
+#     arrives (or any tcl reply when instruction is None).  Call it before
+#     sending the message, so the reply cannot be missed.
+
+#   onMessage(instruction, callback):
+#     Call callback(instruction, args) for every reply with that
+#     instruction, e.g. "ready".
+
+# The last reply the arduino sends to each message
+EXPECTED_REPLIES = {
+    'handextended': 'handreceived',
+    'handreceived': 'handshakeconfirmed',
+    'status': 'handshakeprogram',
+    'colorbegin': 'colorbeginreceived',
+    'colorraw': 'colorrawreceived',
+}
+
+# Longest line kept while waiting for its end, anything longer is noise
+MAX_LINE_LENGTH = 256
+
+# "Struct" class used to pass around serial state
+class TCLSerialOutput(object):
+
+    def __init__(self):
+
+        self.handshakeConfirmed = False
+        self.handshakeProgram   = "Unknown"
+        self.serialHadOutput    = False
+        self.serialMessage      = ""
+        self.beginColor         = False
+        self.rawColor           = False
+
+def splitReply(line):
+
+    # Returns the instruction and args of a tcl reply line, or None and the
+    # line for anything else
+    tokens = line.split(":", 2)
+
+    if len(tokens) > 1 and tokens[0] == "tcl":
+        return tokens[1], tokens[2] if len(tokens) > 2 else ""
+
+    return None, line
+
+def foldReply(output, instruction, args, line):
+
+    # Fold one reply line into a TCLSerialOutput
+    if instruction is None:
+        output.serialMessage += line + "\n"
+
+    elif instruction == "handreceived":
+        print "Success! -> " + args
+        output.handshakeConfirmed = True
+        output.handshakeProgram = args
+        output.serialHadOutput = True
+
+    elif instruction == "handshakeconfirmed":
+
+        # a garbled flag is kept like any line that is not a reply, rather
+        # than raising on the reader thread
+        try:
+            handshake = int(args)
+        except ValueError:
+            output.serialMessage += line + "\n"
+            return
+
+        if handshake:
+            print "Handshake Confirmed!"
+        else:
+            print "Handshake Not Made!"
+
+        output.handshakeConfirmed = handshake
+        output.serialHadOutput = True
+
+    elif instruction == "colorbeginreceived":
+        output.handshakeProgram = args
+        output.serialHadOutput = True
+        output.beginColor = True
+
+    elif instruction == "colorrawreceived":
+        output.handshakeProgram = args
+        output.serialHadOutput = True
+        output.beginColor = True
+        output.rawColor = True
+
+    elif instruction == "handshakeprogram":
+        output.handshakeProgram = args
+        print "Handshake Made With: " + output.handshakeProgram
+        output.serialHadOutput = True
+
+class ReplyFuture(object):
+
+    def __init__(self, instruction):
+
+        self.instruction = instruction
+        self.output = TCLSerialOutput()
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+
+        # The TCLSerialOutput of all of the lines that arrived until the
+        # reply, also when it timed out before the reply came
+        self.wait(timeout)
+        return self.output
+
+    def addCallback(self, callback):
+
+        # callback(future) is called once the reply arrives, right away if
+        # it already did
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _resolve(self):
+
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+class TCLReplyParser(object):
+
+    def __init__(self):
+
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.callbacks = {}
+
+    def expect(self, instruction=None):
+
+        future = ReplyFuture(instruction)
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def cancel(self, future):
+
+        with self.lock:
+            if future in self.pending:
+                self.pending.remove(future)
+
+    def onMessage(self, instruction, callback):
+
+        with self.lock:
+            self.callbacks.setdefault(instruction, []).append(callback)
+
+    def feed(self, data):
+
+        self.buffer.extend(data)
+
+        start = 0
+        end = self.buffer.find(b"\n")
+        while end >= 0:
+            line = str(self.buffer[start:end]).strip("\r")
+            if line:
+                self._handleLine(line)
+            start = end + 1
+            end = self.buffer.find(b"\n", start)
+
+        del self.buffer[:start]
+        if len(self.buffer) > MAX_LINE_LENGTH:
+            del self.buffer[:]
+
+    def _handleLine(self, line):
+
+        instruction, args = splitReply(line)
+
+        with self.lock:
+            pending = list(self.pending)
+            callbacks = list(self.callbacks.get(instruction, []))
+
+        for future in pending:
+            foldReply(future.output, instruction, args, line)
+
+            if instruction is not None and future.instruction in (None,
+                                                                  instruction):
+                self.cancel(future)
+                future._resolve()
+
+        for callback in callbacks:
+            callback(instruction, args)
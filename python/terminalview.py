@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+import time
+import curses
+import threading
+import numpy
+
+# ------------------------------------------------------------------------
+# TERMINAL VIEW
+
+# Draws the ascii view of the perpitcharray in the terminal from its own
+# thread, so drawing never holds up the audio analysis or the light output.
+#
+# The render loop calls publish() with its perpitcharray, which only copies
+# it into the front half of a double buffer.  The view thread draws at most
+# fps times a second, always the newest frame, and only redraws the cells
+# whose character changed since the last time it drew.  curses is only ever
+# touched from the view thread, which takes over the terminal when it starts
+# and hands it back when it stops.
+
+# Key functions:
+
+#   publish(perpitcharray, rampname):
+#     Hand the newest frame and the name of its color ramp to the view.
+
+#   stats( ):
+#     Counters for published and drawn frames and the number of cells drawn.
+
+#   stop( ):
+#     Stops the thread and hands the terminal back.
+
+# The character drawn for a led, by power
+LEVEL_THRESHOLDS = [.1, .2, .3, .4]
+LEVEL_CHARS = numpy.frombuffer(b"-*O0@", dtype=numpy.uint8)
+
+# Rows start with "<pitch>\t| ", the tab takes that to column 8
+FIRST_LED_COLUMN = 10
+
+class TerminalView(threading.Thread):
+
+    def __init__(self, numbands, numleds, fps=10.):
+
+        threading.Thread.__init__(self, name="TerminalView")
+        self.daemon = True
+
+        self.period = 1. / fps
+        self.condition = threading.Condition()
+
+        self.frontbuffer = numpy.zeros([numbands, numleds], dtype=numpy.float32)
+        self.backbuffer = numpy.zeros([numbands, numleds], dtype=numpy.float32)
+        self.rampname = ""
+        self.pending = False
+        self.running = True
+
+        # the characters and ramp name currently on screen
+        self.drawn = None
+        self.drawnRampName = None
+
+        self.framesPublished = 0
+        self.framesDrawn = 0
+        self.cellsDrawn = 0
+
+    def publish(self, perpitcharray, rampname):
+
+        with self.condition:
+
+            if self.frontbuffer.shape != perpitcharray.shape:
+                self.frontbuffer = numpy.zeros(perpitcharray.shape,
+                                               dtype=numpy.float32)
+
+            self.frontbuffer[...] = perpitcharray
+            self.rampname = rampname
+            self.pending = True
+            self.framesPublished += 1
+
+            self.condition.notify()
+
+    def stats(self):
+
+        with self.condition:
+            return {
+                'published': self.framesPublished,
+                'drawn': self.framesDrawn,
+                'cells': self.cellsDrawn,
+            }
+
+    def _initScreen(self):
+
+        # Take over the terminal
+        self.stdscr = curses.initscr()
+        curses.start_color()
+        curses.noecho()
+        curses.cbreak()
+
+    def _closeScreen(self):
+
+        # Hand the terminal back
+        curses.echo()
+        curses.nocbreak()
+        curses.endwin()
+
+    def _getColorPair(self, idx, numbands):
+
+        coloridx = idx+1
+        fg, bg = curses.pair_content(coloridx)
+        if (fg + bg) == 0:
+
+            nidx = float(idx)/numbands
+            fg = int(7 * nidx + 1)
+            bg = curses.COLOR_BLACK
+
+            curses.init_pair(coloridx, fg, bg)
+
+        return curses.color_pair(coloridx)
+
+    def _draw(self, perpitcharray, rampname):
+
+        # leds are drawn from the last one down to the second one
+        chars = LEVEL_CHARS[numpy.digitize(perpitcharray[:, :0:-1],
+                                           LEVEL_THRESHOLDS)]
+        numbands = chars.shape[0]
+
+        if rampname != self.drawnRampName:
+            self.stdscr.addstr(0, 0, "Color Ramp Name: %s" % rampname)
+            self.stdscr.clrtoeol()
+            self.drawnRampName = rampname
+
+        if self.drawn is None or self.drawn.shape != chars.shape:
+
+            # draw every row in full the first time or when the size changes
+            for pitchIdx in range(numbands):
+                ascii = "%i\t| %s |" % (pitchIdx, chars[pitchIdx].tostring())
+                self.stdscr.addstr(pitchIdx+1, 0, ascii,
+                                   self._getColorPair(pitchIdx, numbands))
+
+            self.drawn = chars
+            self.cellsDrawn += chars.size
+
+        else:
+
+            rows, cols = numpy.nonzero(chars != self.drawn)
+            for row, col in zip(rows, cols):
+                self.stdscr.addch(row+1, FIRST_LED_COLUMN + col,
+                                  int(chars[row, col]),
+                                  self._getColorPair(row, numbands))
+
+            self.drawn[rows, cols] = chars[rows, cols]
+            self.cellsDrawn += rows.shape[0]
+
+        self.stdscr.refresh()
+        self.framesDrawn += 1
+
+    def run(self):
+
+        self._initScreen()
+
+        try:
+            nextDraw = time.time()
+            while True:
+
+                with self.condition:
+
+                    while self.running and not self.pending:
+                        self.condition.wait()
+
+                    if not self.running:
+                        return
+
+                    self.frontbuffer, self.backbuffer = (self.backbuffer,
+                                                         self.frontbuffer)
+                    self.pending = False
+                    rampname = self.rampname
+
+                self._draw(self.backbuffer, rampname)
+
+                # frames published until the next draw replace each other
+                nextDraw = max(nextDraw + self.period, time.time())
+                with self.condition:
+                    while self.running and time.time() < nextDraw:
+                        self.condition.wait(nextDraw - time.time())
+
+        finally:
+            self._closeScreen()
+
+    def stop(self, timeout=1.):
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        if self.ident is not None:
+            self.join(timeout)